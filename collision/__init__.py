@@ -0,0 +1 @@
+from .host import HostCollider, find_collisions
@@ -11,5 +11,22 @@ class Bounds(Reducer):
     program_type = BoundsProgram
 
     def __init__(self, ctx, ngroups, group_size, coord_dtype=dtype(('float32', 3)),
-                 program=None):
-        super().__init__(ctx, ngroups, group_size, coord_dtype, program)
+                 program=None, pool=None):
+        super().__init__(ctx, ngroups, group_size, coord_dtype, program, pool)
+
+class SphereBoundsProgram(ReductionProgram):
+    # Bounds of the spheres, then the largest radius (in every component)
+    accumulator = [("INFINITY", "min", "x0 - x1"), ("-INFINITY", "max", "x0 + x1"),
+                   ("0", "max", "x1")]
+
+    def __init__(self, ctx, coord_dtype=dtype(('float32', 3))):
+        coord_dtype = dtype(coord_dtype)
+        super().__init__(ctx, coord_dtype, extra_dtypes=[coord_dtype.base])
+
+class SphereBounds(Reducer):
+    # Reduces (coords_buf, radii_buf) in one pass
+    program_type = SphereBoundsProgram
+
+    def __init__(self, ctx, ngroups, group_size, coord_dtype=dtype(('float32', 3)),
+                 program=None, pool=None):
+        super().__init__(ctx, ngroups, group_size, coord_dtype, program, pool)
@@ -0,0 +1,130 @@
+import os
+import re
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+import pyopencl as cl
+
+include_re = re.compile(r'^\s*#\s*include\s*["<]([^">]+)[">]', re.MULTILINE)
+
+def resolve_includes(src, includes, seen=None):
+    if seen is None:
+        seen = {}
+    for name in include_re.findall(src):
+        for include_dir in map(Path, includes):
+            path = include_dir / name
+            if path.is_file():
+                break
+        else:
+            # Left to the compiler, e.g. a system header
+            continue
+        if path in seen:
+            continue
+        seen[path] = path.read_text()
+        resolve_includes(seen[path], includes, seen)
+    return seen
+
+def device_id(device):
+    return '\0'.join([device.platform.name, device.platform.version,
+                      device.name, device.vendor, device.version,
+                      device.driver_version])
+
+
+class ProgramCache:
+    suffix = '.bin'
+
+    def __init__(self, path, max_size=256 * 2 ** 20):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    @classmethod
+    def default(cls):
+        if os.environ.get('COLLISION_NO_CACHE'):
+            return None
+        path = os.environ.get('COLLISION_CACHE_DIR')
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')
+            path = Path(cache_home) / 'collision'
+        max_size = int(os.environ.get('COLLISION_CACHE_SIZE', 256 * 2 ** 20))
+        return cls(path, max_size)
+
+    def key(self, src, options, includes, device):
+        h = sha256()
+        for part in [src, options, device_id(device)]:
+            h.update(part.encode())
+            h.update(b'\0')
+        # Sort by name so the key doesn't depend on include directory order
+        for path, contents in sorted(resolve_includes(src, includes).items(),
+                                     key=lambda item: item[0].name):
+            h.update(path.name.encode())
+            h.update(b'\0')
+            h.update(contents.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def entry(self, key):
+        return self.path / (key + self.suffix)
+
+    def load(self, key):
+        try:
+            binary = self.entry(key).read_bytes()
+        except OSError:
+            return None
+        # Refresh mtime, eviction is least-recently-used
+        try:
+            os.utime(self.entry(key))
+        except OSError:
+            pass
+        return binary
+
+    def store(self, key, binary):
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(dir=self.path, delete=False) as f:
+                f.write(binary)
+            # Atomic, so concurrent workers never see a partial binary
+            os.replace(f.name, self.entry(key))
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.path.glob('*' + self.suffix):
+            try:
+                entries.append((path.stat(), path))
+            except OSError:
+                pass
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime_ns):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= stat.st_size
+
+    def clear(self):
+        for path in self.path.glob('*' + self.suffix):
+            path.unlink()
+
+    def build(self, ctx, src, options, includes):
+        devices = ctx.devices
+        keys = [self.key(src, options, includes, device) for device in devices]
+        binaries = [self.load(key) for key in keys]
+
+        if all(binary is not None for binary in binaries):
+            try:
+                return cl.Program(ctx, devices, binaries).build(options)
+            except (cl.Error, ValueError):
+                # Stale or corrupt binary, fall through to rebuild
+                pass
+
+        program = cl.Program(ctx, src).build(options)
+        program_devices = program.get_info(cl.program_info.DEVICES)
+        for device, binary in zip(program_devices,
+                                  program.get_info(cl.program_info.BINARIES)):
+            if binary:
+                self.store(self.key(src, options, includes, device), binary)
+        return program
@@ -5,13 +5,24 @@
 
 #define VTYPE CAT(DTYPE,3)
 
+#include "segment.cl"
+
+#ifndef CODE_BITS
+#define CODE_BITS 32
+#endif
+
 kernel void range(global unsigned int * const idxs) {
     idxs[get_global_id(0)] = get_global_id(0);
 }
 
+#if CODE_BITS == 64
+#define CODE_TYPE ulong
+#else
+#define CODE_TYPE uint
+#endif
+
 // Interleaves bits with 2 zero bits
-// TODO: Expand for long
-unsigned int expandBits(unsigned int v) {
+unsigned int expandBits32(unsigned int v) {
     v = (v * 0x00010001u) & 0xFF0000FFu;
     v = (v * 0x00000101u) & 0x0F00F00Fu;
     v = (v * 0x00000011u) & 0xC30C30C3u;
@@ -19,18 +30,30 @@ unsigned int expandBits(unsigned int v) {
     return v;
 }
 
-unsigned int morton(VTYPE pos, const VTYPE min, const VTYPE max) {
-    const DTYPE scale = (1 << (sizeof(unsigned int) * 8 / 3)) - 1;
+unsigned long expandBits64(unsigned long v) {
+    v &= 0x1FFFFFul;
+    v = (v | v << 32) & 0x001F00000000FFFFul;
+    v = (v | v << 16) & 0x001F0000FF0000FFul;
+    v = (v | v << 8) & 0x100F00F00F00F00Ful;
+    v = (v | v << 4) & 0x10C30C30C30C30C3ul;
+    v = (v | v << 2) & 0x1249249249249249ul;
+    return v;
+}
+
+#define expandBits CAT(expandBits, CODE_BITS)
+
+CODE_TYPE morton(VTYPE pos, const VTYPE min, const VTYPE max) {
+    const DTYPE scale = (1ul << (sizeof(CODE_TYPE) * 8 / 3)) - 1;
     pos = (pos - min) / (max - min);
     pos = clamp(pos * scale, 0.0f, scale);
 
-    unsigned int xx = expandBits((unsigned int) pos.x);
-    unsigned int yy = expandBits((unsigned int) pos.y);
-    unsigned int zz = expandBits((unsigned int) pos.z);
+    CODE_TYPE xx = expandBits((CODE_TYPE) pos.x);
+    CODE_TYPE yy = expandBits((CODE_TYPE) pos.y);
+    CODE_TYPE zz = expandBits((CODE_TYPE) pos.z);
     return (xx << 2) + (yy << 1) + zz;
 }
 
-kernel void calculateCodes(global unsigned int * const codes,
+kernel void calculateCodes(global CODE_TYPE * const codes,
                            const global VTYPE * const coords,
                            const global VTYPE * const range,
                            const unsigned int n) {
@@ -39,6 +62,71 @@ kernel void calculateCodes(global unsigned int * const codes,
     codes[get_global_id(0)] = morton(coords[get_global_id(0)], range[0], range[1]);
 }
 
+// As calculateCodes, while reducing the range of the coordinates in the same pass, e.g.
+// for the next frame. Given radii, the range is of the spheres, followed by the largest
+// radius. Each group writes its (2 or 3) bounds, to be combined by a Reducer.
+kernel void calculateCodesBounds(global CODE_TYPE * const codes,
+                                 const global VTYPE * const coords,
+                                 const global DTYPE * const radii,
+                                 const global VTYPE * const range,
+                                 global VTYPE * const group_bounds,
+                                 local VTYPE (* const scratch)[3],
+                                 const unsigned int n) {
+    const VTYPE min = range[0], max = range[1];
+    VTYPE lo = (VTYPE)(INFINITY), hi = (VTYPE)(-INFINITY), r_max = (VTYPE)(0);
+
+    for (size_t i = get_global_id(0); i < n; i += get_global_size(0)) {
+        const VTYPE coord = coords[i];
+        const DTYPE r = radii != NULL ? radii[i] : 0;
+        codes[i] = morton(coord, min, max);
+        lo = fmin(lo, coord - r);
+        hi = fmax(hi, coord + r);
+        r_max = fmax(r_max, (VTYPE)(r));
+    }
+
+    scratch[get_local_id(0)][0] = lo;
+    scratch[get_local_id(0)][1] = hi;
+    scratch[get_local_id(0)][2] = r_max;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (size_t o = get_local_size(0) / 2; o > 0; o /= 2) {
+        if (get_local_id(0) < o) {
+            scratch[get_local_id(0)][0] = fmin(scratch[get_local_id(0)][0],
+                                               scratch[get_local_id(0) + o][0]);
+            scratch[get_local_id(0)][1] = fmax(scratch[get_local_id(0)][1],
+                                               scratch[get_local_id(0) + o][1]);
+            scratch[get_local_id(0)][2] = fmax(scratch[get_local_id(0)][2],
+                                               scratch[get_local_id(0) + o][2]);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if (get_local_id(0) == 0) {
+        const size_t n_bounds = radii != NULL ? 3 : 2;
+        for (size_t i = 0; i < n_bounds; i++)
+            group_bounds[get_group_id(0) * n_bounds + i] = scratch[0][i];
+    }
+}
+
+// 30-bit codes regardless of CODE_BITS, leaving the high bits of 64-bit codes for scenes
+unsigned int morton32(VTYPE pos, const VTYPE min, const VTYPE max) {
+    const DTYPE scale = (1u << 10) - 1;
+    pos = (pos - min) / (max - min);
+    pos = clamp(pos * scale, 0.0f, scale);
+
+    unsigned int xx = expandBits32((unsigned int) pos.x);
+    unsigned int yy = expandBits32((unsigned int) pos.y);
+    unsigned int zz = expandBits32((unsigned int) pos.z);
+    return (xx << 2) + (yy << 1) + zz;
+}
+
+kernel void calculateSceneCodes(global unsigned int * const codes,
+                                const global VTYPE * const coords,
+                                const global VTYPE * const range,
+                                const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    codes[get_global_id(0)] = morton32(coords[get_global_id(0)], range[0], range[1]);
+}
+
 struct Node {
     unsigned int parent;
     unsigned int right_edge;
@@ -62,7 +150,7 @@ kernel void fillInternal(global struct Node * const nodes,
     nodes[leaf_start + get_global_id(0)].right_edge = get_global_id(0);
 }
 
-char delta(const global unsigned int * const codes, const unsigned int n,
+char delta(const global CODE_TYPE * const codes, const unsigned int n,
            const unsigned int i, const bool forward, const unsigned int offset) {
     if (forward && (i + offset) >= n)
         return -1;
@@ -73,12 +161,12 @@ char delta(const global unsigned int * const codes, const unsigned int n,
     if (codes[i] != codes[j])
         return clz(codes[i] ^ codes[j]);
     else
-        return sizeof(unsigned int) * 8 + clz(i ^ j);
+        return sizeof(CODE_TYPE) * 8 + clz(i ^ j);
 }
 
 // http://dx.doi.org/10.2312/EGGH/HPG12/033-037
 // No access at DOI link, but searchable
-kernel void generateBVH(const global unsigned int * const codes,
+kernel void generateBVH(const global CODE_TYPE * const codes,
                         global struct Node * const nodes,
                         const unsigned int n) {
     if (get_global_id(0) >= (n - 1))
@@ -120,6 +208,33 @@ kernel void generateBVH(const global unsigned int * const codes,
     nodes[child_b].parent = i;
 }
 
+// With scene ids in the high bits of codes, the leaves of each scene form a subtree.
+// Its root is the highest ancestor of the scene's first leaf that spans no other leaves.
+kernel void sceneRoots(global unsigned int * const roots,
+                       const global unsigned int * const offsets,
+                       const unsigned int n_scenes,
+                       const global struct Node * const nodes,
+                       const unsigned int n) {
+    const unsigned int scene = get_global_id(0);
+    if (scene >= n_scenes)
+        return;
+    const unsigned int start = offsets[scene], end = offsets[scene + 1];
+    if (start == end) {
+        roots[scene] = UINT_MAX;
+        return;
+    }
+
+    unsigned int idx = (n - 1) + start;
+    while (idx != 0) {
+        const unsigned int parent = nodes[idx].parent;
+        // Parent spans leaves before start or at/after end
+        if (nodes[parent].internal.children[0] != idx || nodes[parent].right_edge >= end)
+            break;
+        idx = parent;
+    }
+    roots[scene] = idx;
+}
+
 struct Bound {
     VTYPE min;
     VTYPE max;
@@ -149,7 +264,8 @@ kernel void internalBounds(global struct Bound * const bounds,
     const size_t leaf_start = n - 1;
     size_t node_idx = leaf_start + get_global_id(0);
 
-    do {
+    // A single leaf is the root, and has no parent
+    while (node_idx != 0) {
         node_idx = nodes[node_idx].parent;
         // Mark internal node as visited, and only process after children
         if (atomic_inc(&flags[node_idx]) < 1)
@@ -158,7 +274,21 @@ kernel void internalBounds(global struct Bound * const bounds,
         const global unsigned int * child_idxs = nodes[node_idx].internal.children;
         bounds[node_idx].min = min(bounds[child_idxs[0]].min, bounds[child_idxs[1]].min);
         bounds[node_idx].max = max(bounds[child_idxs[0]].max, bounds[child_idxs[1]].max);
-    } while (node_idx != 0);
+    }
+}
+
+DTYPE surfaceArea(const struct Bound b) {
+    const VTYPE d = b.max - b.min;
+    return d.x * d.y + d.y * d.z + d.z * d.x;
+}
+
+// Per internal node, relative to the root. Summed, a measure of tree quality.
+kernel void surfaceAreas(global DTYPE * const areas,
+                         const global struct Bound * const bounds,
+                         const unsigned int n) {
+    if (get_global_id(0) >= (n - 1))
+        return;
+    areas[get_global_id(0)] = surfaceArea(bounds[get_global_id(0)]) / surfaceArea(bounds[0]);
 }
 
 bool checkOverlap(const struct Bound a, const struct Bound b) {
@@ -169,8 +299,250 @@ bool isLeaf(const unsigned int idx, const unsigned int n) {
     return idx >= (n - 1);
 }
 
+// Depth-first traversal with an explicit stack, shared by all stack traversals. Callers
+// test the children of the current node, and pass in which to descend into.
+// Each internal node of an LBVH has a longer common prefix than its parent, of up to
+// CODE_BITS bits of code and 32 bits of index (for duplicate codes), bounding its depth.
+// The stack holds a node per level at most, and the NULL node. Treelet optimisation may
+// deepen the tree beyond this, in which case nodes that don't fit are skipped (missing
+// collisions) rather than overflowing; stackless traversal has no such limit.
+#define STACK_SIZE (CODE_BITS + 32 + 1)
+
+struct Traversal {
+    unsigned int stack[STACK_SIZE];
+    unsigned char stack_ptr;
+    unsigned int idx;
+};
+
+// Starts at root, or is already done if root is a leaf (i.e. has no children to test)
+void traversalStart(struct Traversal * const t, const unsigned int root,
+                    const unsigned int n) {
+    t->stack_ptr = 0;
+    t->stack[t->stack_ptr++] = UINT_MAX; // push NULL node (i.e. invalid node)
+    t->idx = isLeaf(root, n) ? UINT_MAX : root;
+}
+
+// Moves to the next node, and is done once idx is UINT_MAX
+void traversalPop(struct Traversal * const t) {
+    t->idx = t->stack[--t->stack_ptr];
+}
+
+// Descends into children[first] if traversed, pushing the other child if both are. Returns
+// whether it descended, otherwise the caller must pop.
+bool traversalDescend(struct Traversal * const t, const unsigned int children[2],
+                      const bool traverse[2], const unsigned char first) {
+    if (!traverse[0] && !traverse[1])
+        return false;
+    const unsigned char next = traverse[first] ? first : !first;
+    t->idx = children[next];
+    if (traverse[!next] && t->stack_ptr < STACK_SIZE)
+        t->stack[t->stack_ptr++] = children[!next];
+    return true;
+}
+
+// Visits the children of each node in turn, descending into both or popping
+void traversalNext(struct Traversal * const t, const unsigned int children[2],
+                   const bool traverse[2]) {
+    if (!traversalDescend(t, children, traverse, 0))
+        traversalPop(t);
+}
+
+#ifndef TREELET_SIZE
+#define TREELET_SIZE 5
+#endif
+
+struct Bound treeletBounds(const struct Bound * const leaf_bounds, const unsigned int set) {
+    struct Bound b = {(VTYPE)(INFINITY), (VTYPE)(-INFINITY)};
+    for (unsigned char i = 0; i < TREELET_SIZE; i++) {
+        if (set & (1 << i)) {
+            b.min = min(b.min, leaf_bounds[i].min);
+            b.max = max(b.max, leaf_bounds[i].max);
+        }
+    }
+    return b;
+}
+
+// Replaces the treelet below root with the topology of least total internal node area,
+// reusing its internal nodes. As subtrees need no longer span a contiguous range of
+// leaves, right_edge becomes the largest leaf index below a node, which is all that
+// traversal requires of it.
+void restructureTreelet(global struct Node * const nodes,
+                        global struct Bound * const bounds,
+                        const unsigned int root, const unsigned int n) {
+    unsigned int leaves[TREELET_SIZE];
+    unsigned int internal[TREELET_SIZE - 1];
+    unsigned char n_leaves = 2, n_internal = 0;
+    leaves[0] = nodes[root].internal.children[0];
+    leaves[1] = nodes[root].internal.children[1];
+
+    // Grow the treelet by expanding its leaf of largest area
+    while (n_leaves < TREELET_SIZE) {
+        char largest = -1;
+        DTYPE largest_area = -INFINITY;
+        for (unsigned char i = 0; i < n_leaves; i++) {
+            if (isLeaf(leaves[i], n))
+                continue;
+            const DTYPE area = surfaceArea(bounds[leaves[i]]);
+            if (area > largest_area) {
+                largest = i;
+                largest_area = area;
+            }
+        }
+        if (largest < 0)
+            break;
+        const unsigned int idx = leaves[largest];
+        internal[n_internal++] = idx;
+        leaves[largest] = nodes[idx].internal.children[0];
+        leaves[n_leaves++] = nodes[idx].internal.children[1];
+    }
+    // Two leaves have only one topology
+    if (n_leaves < 3)
+        return;
+
+    struct Bound leaf_bounds[TREELET_SIZE];
+    unsigned int leaf_edges[TREELET_SIZE];
+    for (unsigned char i = 0; i < n_leaves; i++) {
+        leaf_bounds[i] = bounds[leaves[i]];
+        leaf_edges[i] = nodes[leaves[i]].right_edge;
+    }
+
+    // Subsets of leaves are numbered below their supersets, so are done first
+    const unsigned int full = (1 << n_leaves) - 1;
+    DTYPE costs[1 << TREELET_SIZE];
+    unsigned char partitions[1 << TREELET_SIZE];
+    for (unsigned int set = 1; set <= full; set++) {
+        if (popcount(set) == 1) {
+            costs[set] = 0;
+            continue;
+        }
+        // Only partitions holding the lowest leaf, so each split is tried once
+        const unsigned int lowest = set & -set;
+        DTYPE best = INFINITY;
+        unsigned char best_partition = lowest;
+        for (unsigned int part = (set - 1) & set; part > 0; part = (part - 1) & set) {
+            if (!(part & lowest))
+                continue;
+            const DTYPE cost = costs[part] + costs[set ^ part];
+            if (cost < best) {
+                best = cost;
+                best_partition = part;
+            }
+        }
+        costs[set] = surfaceArea(treeletBounds(leaf_bounds, set)) + best;
+        partitions[set] = best_partition;
+    }
+
+    // Emit from the root down, so only the root keeps its place
+    unsigned int stack_idxs[TREELET_SIZE - 1];
+    unsigned char stack_sets[TREELET_SIZE - 1];
+    unsigned char stack_ptr = 0, next_internal = 0;
+    stack_idxs[stack_ptr] = root;
+    stack_sets[stack_ptr++] = full;
+    while (stack_ptr > 0) {
+        const unsigned int idx = stack_idxs[--stack_ptr];
+        const unsigned char set = stack_sets[stack_ptr];
+        const unsigned char parts[2] = {partitions[set], set ^ partitions[set]};
+
+        for (unsigned char c = 0; c < 2; c++) {
+            unsigned int child;
+            if (popcount(parts[c]) == 1) {
+                child = leaves[31 - clz((unsigned int) parts[c])];
+            } else {
+                child = internal[next_internal++];
+                stack_idxs[stack_ptr] = child;
+                stack_sets[stack_ptr++] = parts[c];
+            }
+            nodes[idx].internal.children[c] = child;
+            nodes[child].parent = idx;
+        }
+
+        unsigned int right_edge = 0;
+        for (unsigned char i = 0; i < n_leaves; i++)
+            if (set & (1 << i))
+                right_edge = max(right_edge, leaf_edges[i]);
+        bounds[idx] = treeletBounds(leaf_bounds, set);
+        nodes[idx].right_edge = right_edge;
+    }
+}
+
+// Bottom-up, as in internalBounds, so each treelet is built from optimised subtrees
+// http://dx.doi.org/10.1145/2492045.2492055
+kernel void optimizeTreelets(global struct Node * const nodes,
+                             global struct Bound * const bounds,
+                             global unsigned int * const flags,
+                             const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    const size_t leaf_start = n - 1;
+    size_t node_idx = leaf_start + get_global_id(0);
+
+    do {
+        node_idx = nodes[node_idx].parent;
+        if (atomic_inc(&flags[node_idx]) < 1)
+            break;
+        mem_fence(CLK_GLOBAL_MEM_FENCE);
+        restructureTreelet(nodes, bounds, node_idx, n);
+    } while (node_idx != 0);
+}
+
 #pragma OPENCL EXTENSION cl_khr_int64_base_atomics : enable
 
+// Collisions are id pairs, or (scene, id, id) triples unless scene is UINT_MAX
+void writeCollision(global unsigned int * const collisions, const unsigned int idx,
+                    const unsigned int scene, const unsigned int a, const unsigned int b) {
+    if (scene == UINT_MAX) {
+        collisions[idx*2+0] = a;
+        collisions[idx*2+1] = b;
+    } else {
+        collisions[idx*3+0] = scene;
+        collisions[idx*3+1] = a;
+        collisions[idx*3+2] = b;
+    }
+}
+
+// Finds collisions of a single query within the subtree at root. With next, collisions
+// are written atomically, otherwise from offset onwards.
+unsigned int traverseQuery(global unsigned int * const collisions,
+                           global unsigned int * const next,
+                           const unsigned int offset,
+                           const unsigned int n_collisions,
+                           const global struct Node * const nodes,
+                           const global struct Bound * const bounds,
+                           const unsigned int n, const unsigned int query_idx,
+                           const unsigned int root, const unsigned int scene) {
+    size_t leaf_start = n - 1;
+    const struct Bound query = bounds[leaf_start + query_idx];
+    const unsigned int query_id = nodes[leaf_start + query_idx].leaf.id;
+    unsigned int count = 0;
+
+    // A leaf root is only the query itself
+    struct Traversal t;
+    traversalStart(&t, root, n);
+    while (t.idx != UINT_MAX) {
+        const unsigned int children[2] = {nodes[t.idx].internal.children[0],
+                                          nodes[t.idx].internal.children[1]};
+        bool traverse[2];
+        for (unsigned char i = 0; i < 2; i++) {
+            const unsigned int child = children[i];
+            // Don't report self-collisions, and only in one direction
+            const bool overlap = checkOverlap(query, bounds[child])
+                                 && !(nodes[child].right_edge <= query_idx);
+            traverse[i] = overlap && !isLeaf(child, n);
+            if (overlap && isLeaf(child, n)) {
+                const unsigned int collision_idx = (next != NULL) ? atomic_inc(next)
+                                                                  : offset + count;
+                count++;
+                if (collisions != NULL && collision_idx < n_collisions)
+                    writeCollision(collisions, collision_idx, scene,
+                                   query_id, nodes[child].leaf.id);
+            }
+        }
+        traversalNext(&t, children, traverse);
+    }
+
+    return count;
+}
+
 kernel void traverse(global unsigned int * const collisions,
                      global unsigned int * const next,
                      const unsigned int n_collisions,
@@ -179,48 +551,400 @@ kernel void traverse(global unsigned int * const collisions,
                      const unsigned int n) {
     if (get_global_id(0) >= n)
         return;
+    traverseQuery(collisions, next, 0, n_collisions, nodes, bounds, n, get_global_id(0),
+                  0, UINT_MAX);
+}
+
+// Per query, traverses only the subtree of its scene. Collisions are (scene, id, id).
+kernel void traverseScenes(global unsigned int * const collisions,
+                           global unsigned int * const next,
+                           const unsigned int n_collisions,
+                           const global unsigned int * const roots,
+                           const global unsigned int * const offsets,
+                           const unsigned int n_scenes,
+                           const global struct Node * const nodes,
+                           const global struct Bound * const bounds,
+                           const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    // Scenes keep their offsets after sorting
+    const unsigned int scene = findSegment(offsets, n_scenes, get_global_id(0));
+    traverseQuery(collisions, next, 0, n_collisions, nodes, bounds, n, get_global_id(0),
+                  roots[scene], scene);
+}
+
+// Counts are indexed by query id rather than leaf, so the output is sorted by query id
+kernel void countCollisions(global unsigned int * const counts,
+                            const global struct Node * const nodes,
+                            const global struct Bound * const bounds,
+                            const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    const unsigned int query_id = nodes[(n - 1) + get_global_id(0)].leaf.id;
+    counts[query_id] = traverseQuery(NULL, NULL, 0, 0, nodes, bounds, n, get_global_id(0),
+                                     0, UINT_MAX);
+}
+
+// Offsets are the exclusive prefix sum of counts
+kernel void writeCollisions(global unsigned int * const collisions,
+                            const global unsigned int * const offsets,
+                            const unsigned int n_collisions,
+                            const global struct Node * const nodes,
+                            const global struct Bound * const bounds,
+                            const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    const unsigned int query_id = nodes[(n - 1) + get_global_id(0)].leaf.id;
+    traverseQuery(collisions, NULL, offsets[query_id], n_collisions,
+                  nodes, bounds, n, get_global_id(0), 0, UINT_MAX);
+}
+
+// Rope (skip) links: the next node in pre-order once a node's subtree is done
+kernel void calculateRopes(global unsigned int * const ropes,
+                           const global struct Node * const nodes,
+                           const unsigned int n) {
+    if (get_global_id(0) >= (2 * n - 1))
+        return;
+
+    unsigned int idx = get_global_id(0);
+    while (idx != 0) {
+        const unsigned int parent = nodes[idx].parent;
+        if (nodes[parent].internal.children[0] == idx) {
+            ropes[get_global_id(0)] = nodes[parent].internal.children[1];
+            return;
+        }
+        idx = parent;
+    }
+    ropes[get_global_id(0)] = UINT_MAX;
+}
+
+// Stackless traversal, following ropes. With next, collisions are written atomically,
+// otherwise from offset onwards.
+unsigned int traverseRopesQuery(global unsigned int * const collisions,
+                                global unsigned int * const next,
+                                const unsigned int offset,
+                                const unsigned int n_collisions,
+                                const global struct Node * const nodes,
+                                const global unsigned int * const ropes,
+                                const global struct Bound * const bounds,
+                                const unsigned int n, const unsigned int query_idx) {
     size_t leaf_start = n - 1;
-    const unsigned int query_idx = get_global_id(0);
     const struct Bound query = bounds[leaf_start + query_idx];
-
-    unsigned int stack[64];
-    unsigned char stack_ptr = 0;
-    stack[stack_ptr++] = UINT_MAX; // push NULL node (i.e. invalid node)
+    const unsigned int query_id = nodes[leaf_start + query_idx].leaf.id;
+    unsigned int count = 0;
 
     // Root node
     unsigned int idx = 0;
     do {
-        const unsigned int child_a = nodes[idx].internal.children[0];
-        const unsigned int child_b = nodes[idx].internal.children[1];
-        bool overlap_a = checkOverlap(query, bounds[child_a]);
-        bool overlap_b = checkOverlap(query, bounds[child_b]);
-
         // Don't report self-collisions, and only in one direction
-        overlap_a &= !(nodes[child_a].right_edge <= query_idx);
-        overlap_b &= !(nodes[child_b].right_edge <= query_idx);
-
-        if (overlap_a && isLeaf(child_a, n)) {
-            const unsigned int collision_idx = atomic_inc(next);
-            if (collision_idx < n_collisions) {
-                collisions[collision_idx*2+0] = nodes[leaf_start+query_idx].leaf.id;
-                collisions[collision_idx*2+1] = nodes[child_a].leaf.id;
+        const bool overlap = (nodes[idx].right_edge > query_idx &&
+                              checkOverlap(query, bounds[idx]));
+
+        if (overlap && isLeaf(idx, n)) {
+            const unsigned int collision_idx = (next != NULL) ? atomic_inc(next)
+                                                              : offset + count;
+            count++;
+            if (collisions != NULL && collision_idx < n_collisions) {
+                collisions[collision_idx*2+0] = query_id;
+                collisions[collision_idx*2+1] = nodes[idx].leaf.id;
             }
         }
-        if (overlap_b && isLeaf(child_b, n)) {
-            const unsigned int collision_idx = atomic_inc(next);
-            if (collision_idx < n_collisions) {
-                collisions[collision_idx*2+0] = nodes[leaf_start+query_idx].leaf.id;
-                collisions[collision_idx*2+1] = nodes[child_b].leaf.id;
-            }
+        idx = (overlap && !isLeaf(idx, n)) ? nodes[idx].internal.children[0] : ropes[idx];
+    } while (idx != UINT_MAX);
+
+    return count;
+}
+
+kernel void traverseRopes(global unsigned int * const collisions,
+                          global unsigned int * const next,
+                          const unsigned int n_collisions,
+                          const global struct Node * const nodes,
+                          const global unsigned int * const ropes,
+                          const global struct Bound * const bounds,
+                          const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    traverseRopesQuery(collisions, next, 0, n_collisions,
+                       nodes, ropes, bounds, n, get_global_id(0));
+}
+
+kernel void countCollisionsRopes(global unsigned int * const counts,
+                                 const global struct Node * const nodes,
+                                 const global unsigned int * const ropes,
+                                 const global struct Bound * const bounds,
+                                 const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    const unsigned int query_id = nodes[(n - 1) + get_global_id(0)].leaf.id;
+    counts[query_id] = traverseRopesQuery(NULL, NULL, 0, 0,
+                                          nodes, ropes, bounds, n, get_global_id(0));
+}
+
+kernel void writeCollisionsRopes(global unsigned int * const collisions,
+                                 const global unsigned int * const offsets,
+                                 const unsigned int n_collisions,
+                                 const global struct Node * const nodes,
+                                 const global unsigned int * const ropes,
+                                 const global struct Bound * const bounds,
+                                 const unsigned int n) {
+    if (get_global_id(0) >= n)
+        return;
+    const unsigned int query_id = nodes[(n - 1) + get_global_id(0)].leaf.id;
+    traverseRopesQuery(collisions, NULL, offsets[query_id], n_collisions,
+                       nodes, ropes, bounds, n, get_global_id(0));
+}
+
+void writeExternal(global unsigned int * const collisions,
+                   global unsigned int * const next,
+                   const unsigned int n_collisions,
+                   const unsigned int query_idx, const unsigned int id) {
+    const unsigned int collision_idx = atomic_inc(next);
+    if (collision_idx < n_collisions) {
+        collisions[collision_idx*2+0] = query_idx;
+        collisions[collision_idx*2+1] = id;
+    }
+}
+
+// Overlaps of an external query with all leaves, so there are no self-collisions to skip
+void traverseExternal(global unsigned int * const collisions,
+                      global unsigned int * const next,
+                      const unsigned int n_collisions,
+                      const global struct Node * const nodes,
+                      const global struct Bound * const bounds,
+                      const unsigned int n,
+                      const struct Bound query, const unsigned int query_idx) {
+    // Root node, tested directly if it is the only leaf
+    const unsigned int root = 0;
+    if (isLeaf(root, n) && checkOverlap(query, bounds[root]))
+        writeExternal(collisions, next, n_collisions, query_idx, nodes[root].leaf.id);
+
+    struct Traversal t;
+    traversalStart(&t, root, n);
+    while (t.idx != UINT_MAX) {
+        const unsigned int children[2] = {nodes[t.idx].internal.children[0],
+                                          nodes[t.idx].internal.children[1]};
+        bool traverse[2];
+        for (unsigned char i = 0; i < 2; i++) {
+            const unsigned int child = children[i];
+            const bool overlap = checkOverlap(query, bounds[child]);
+            traverse[i] = overlap && !isLeaf(child, n);
+            if (overlap && isLeaf(child, n))
+                writeExternal(collisions, next, n_collisions, query_idx, nodes[child].leaf.id);
         }
-        const bool traverse_a = (overlap_a && !isLeaf(child_a, n));
-        const bool traverse_b = (overlap_b && !isLeaf(child_b, n));
-        if (!traverse_a && !traverse_b)
-            idx = stack[--stack_ptr];
-        else {
-            idx = (traverse_a) ? child_a : child_b;
-            if (traverse_a && traverse_b)
-                stack[stack_ptr++] = child_b;
+        traversalNext(&t, children, traverse);
+    }
+}
+
+kernel void query(global unsigned int * const collisions,
+                  global unsigned int * const next,
+                  const unsigned int n_collisions,
+                  const global VTYPE * const query_coords,
+                  const global DTYPE * const query_radii,
+                  const unsigned int n_queries,
+                  const global struct Node * const nodes,
+                  const global struct Bound * const bounds,
+                  const unsigned int n) {
+    const unsigned int query_idx = get_global_id(0);
+    if (query_idx >= n_queries)
+        return;
+
+    struct Bound query;
+    query.min = query_coords[query_idx] - query_radii[query_idx];
+    query.max = query_coords[query_idx] + query_radii[query_idx];
+    traverseExternal(collisions, next, n_collisions, nodes, bounds, n, query, query_idx);
+}
+
+kernel void queryBounds(global unsigned int * const collisions,
+                        global unsigned int * const next,
+                        const unsigned int n_collisions,
+                        const global struct Bound * const query_bounds,
+                        const unsigned int n_queries,
+                        const global struct Node * const nodes,
+                        const global struct Bound * const bounds,
+                        const unsigned int n) {
+    const unsigned int query_idx = get_global_id(0);
+    if (query_idx >= n_queries)
+        return;
+
+    traverseExternal(collisions, next, n_collisions, nodes, bounds, n,
+                     query_bounds[query_idx], query_idx);
+}
+
+#ifndef MAX_K
+#define MAX_K 32
+#endif
+
+// Squared distance from a point to the closest point of a bound
+DTYPE boundDistance2(const VTYPE p, const struct Bound b) {
+    const VTYPE d = fmax(fmax(b.min - p, p - b.max), (VTYPE) (0));
+    return dot(d, d);
+}
+
+// Whether a leaf's point is closer than the radius, writing its id to idx if so
+unsigned int radiusLeaf(global unsigned int * const indices, const unsigned int idx,
+                        const unsigned int n_indices, const global VTYPE * const coords,
+                        const unsigned int id, const VTYPE query, const DTYPE radius2,
+                        const unsigned int skip_id) {
+    const VTYPE d = coords[id] - query;
+    if (id == skip_id || dot(d, d) >= radius2)
+        return 0;
+    if (indices != NULL && idx < n_indices)
+        indices[idx] = id;
+    return 1;
+}
+
+// Finds points closer than radius to query, writing their ids from offset onwards. The
+// tree's bounds only prune, distances are measured to the points in coords.
+unsigned int radiusQuery(global unsigned int * const indices,
+                         const unsigned int offset,
+                         const unsigned int n_indices,
+                         const global VTYPE * const coords,
+                         const global struct Node * const nodes,
+                         const global struct Bound * const bounds,
+                         const unsigned int n,
+                         const VTYPE query, const DTYPE radius, const unsigned int skip_id) {
+    const DTYPE radius2 = radius * radius;
+    unsigned int count = 0;
+
+    // Root node, tested directly if it is the only leaf
+    const unsigned int root = 0;
+    if (isLeaf(root, n))
+        count += radiusLeaf(indices, offset + count, n_indices, coords, nodes[root].leaf.id,
+                            query, radius2, skip_id);
+
+    struct Traversal t;
+    traversalStart(&t, root, n);
+    while (t.idx != UINT_MAX) {
+        const unsigned int children[2] = {nodes[t.idx].internal.children[0],
+                                          nodes[t.idx].internal.children[1]};
+        bool traverse[2];
+        for (unsigned char i = 0; i < 2; i++) {
+            const unsigned int child = children[i];
+            traverse[i] = !isLeaf(child, n) && boundDistance2(query, bounds[child]) < radius2;
+            if (isLeaf(child, n))
+                count += radiusLeaf(indices, offset + count, n_indices, coords,
+                                    nodes[child].leaf.id, query, radius2, skip_id);
         }
-    } while (idx != UINT_MAX);
+        traversalNext(&t, children, traverse);
+    }
+
+    return count;
+}
+
+kernel void countNeighbours(global unsigned int * const counts,
+                            const global VTYPE * const coords,
+                            const global VTYPE * const query_coords,
+                            const unsigned int n_queries,
+                            const DTYPE radius, const unsigned int exclude_self,
+                            const global struct Node * const nodes,
+                            const global struct Bound * const bounds,
+                            const unsigned int n) {
+    const unsigned int query_idx = get_global_id(0);
+    if (query_idx >= n_queries)
+        return;
+    counts[query_idx] = radiusQuery(NULL, 0, 0, coords, nodes, bounds, n,
+                                    query_coords[query_idx], radius,
+                                    exclude_self ? query_idx : UINT_MAX);
+}
+
+kernel void writeNeighbours(global unsigned int * const indices,
+                            const global unsigned int * const offsets,
+                            const unsigned int n_indices,
+                            const global VTYPE * const coords,
+                            const global VTYPE * const query_coords,
+                            const unsigned int n_queries,
+                            const DTYPE radius, const unsigned int exclude_self,
+                            const global struct Node * const nodes,
+                            const global struct Bound * const bounds,
+                            const unsigned int n) {
+    const unsigned int query_idx = get_global_id(0);
+    if (query_idx >= n_queries)
+        return;
+    radiusQuery(indices, offsets[query_idx], n_indices, coords, nodes, bounds, n,
+                query_coords[query_idx], radius, exclude_self ? query_idx : UINT_MAX);
+}
+
+// Inserts a leaf's point among the best found so far if it is closer than the worst of
+// them, dropping the previous k-th neighbour if full. Returns the new worst distance.
+DTYPE nearestLeaf(DTYPE * const best_distances, unsigned int * const best_ids,
+                  unsigned int * const found, const unsigned int k,
+                  const global VTYPE * const coords, const unsigned int id,
+                  const VTYPE query, const unsigned int skip_id, const DTYPE worst) {
+    const VTYPE d = coords[id] - query;
+    const DTYPE distance = dot(d, d);
+    if (id == skip_id || distance >= worst)
+        return worst;
+
+    // Insertion sort
+    unsigned int j = min(*found, k - 1);
+    *found = min(*found + 1, k);
+    for (; j > 0 && best_distances[j-1] > distance; j--) {
+        best_distances[j] = best_distances[j-1];
+        best_ids[j] = best_ids[j-1];
+    }
+    best_distances[j] = distance;
+    best_ids[j] = id;
+    return (*found == k) ? best_distances[k-1] : worst;
+}
+
+// Finds the k closest points, nearest first. Missing neighbours (when n < k) have id
+// UINT_MAX and infinite distance.
+kernel void nearestNeighbours(global unsigned int * const indices,
+                              global DTYPE * const distances,
+                              const unsigned int k,
+                              const global VTYPE * const coords,
+                              const global VTYPE * const query_coords,
+                              const unsigned int n_queries,
+                              const unsigned int exclude_self,
+                              const global struct Node * const nodes,
+                              const global struct Bound * const bounds,
+                              const unsigned int n) {
+    const unsigned int query_idx = get_global_id(0);
+    if (query_idx >= n_queries)
+        return;
+    const VTYPE query = query_coords[query_idx];
+    const unsigned int skip_id = exclude_self ? query_idx : UINT_MAX;
+
+    // Sorted by distance, worst is the k-th distance once full
+    DTYPE best_distances[MAX_K];
+    unsigned int best_ids[MAX_K];
+    unsigned int found = 0;
+    DTYPE worst = INFINITY;
+
+    // Root node, tested directly if it is the only leaf
+    const unsigned int root = 0;
+    if (isLeaf(root, n))
+        worst = nearestLeaf(best_distances, best_ids, &found, k, coords,
+                            nodes[root].leaf.id, query, skip_id, worst);
+
+    struct Traversal t;
+    traversalStart(&t, root, n);
+    while (t.idx != UINT_MAX) {
+        const unsigned int children[2] = {nodes[t.idx].internal.children[0],
+                                          nodes[t.idx].internal.children[1]};
+        DTYPE child_distances[2] = {INFINITY, INFINITY};
+        for (unsigned char i = 0; i < 2; i++) {
+            const unsigned int child = children[i];
+            if (isLeaf(child, n))
+                worst = nearestLeaf(best_distances, best_ids, &found, k, coords,
+                                    nodes[child].leaf.id, query, skip_id, worst);
+            else
+                child_distances[i] = boundDistance2(query, bounds[child]);
+        }
+
+        // Nearest child first, once the leaves have narrowed the search
+        const bool traverse[2] = {child_distances[0] < worst, child_distances[1] < worst};
+        const unsigned char near = child_distances[1] < child_distances[0];
+        if (!traversalDescend(&t, children, traverse, near)) {
+            // Pop until a node that may still hold a closer point
+            do {
+                traversalPop(&t);
+            } while (t.idx != UINT_MAX && boundDistance2(query, bounds[t.idx]) >= worst);
+        }
+    }
+
+    for (unsigned int i = 0; i < k; i++) {
+        indices[query_idx * k + i] = (i < found) ? best_ids[i] : UINT_MAX;
+        distances[query_idx * k + i] = (i < found) ? sqrt(best_distances[i]) : INFINITY;
+    }
 }
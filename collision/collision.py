@@ -2,137 +2,292 @@ from numpy import dtype, zeros, array, iinfo
 from pathlib import Path
 from itertools import accumulate, chain, tee
 import pyopencl as cl
-from .misc import SimpleProgram, roundUp, dtype_decl, np_float_dtypes
-from .radix import RadixSorter
-from .bounds import Bounds
+from .misc import SimpleProgram, roundUp, dtype_decl, dtype_sizeof, np_float_dtypes
+from .radix import RadixSorter, SegmentedSorter
+from .bounds import Bounds, SphereBounds
+from .summer import Summer
+from .scan import PrefixScanner
+from .pool import BufferPool
 
 Node = dtype([('parent', 'uint32'), ('right_edge', 'uint32'), ('data', 'uint32', 2)])
 
 NO_NODE = iinfo(Node.fields['parent'][0]).max
 
+# 10 or 21 bits per axis
+code_dtypes = set(map(dtype, ['uint32', 'uint64']))
+
 class CollisionProgram(SimpleProgram):
     src = Path(__file__).parent / "collision.cl"
     kernel_args = {'range': [None],
                    'calculateCodes': [None, None, None, dtype('uint32')],
+                   'calculateCodesBounds': [None, None, None, None, None, None,
+                                            dtype('uint32')],
+                   'calculateSceneCodes': [None, None, None, dtype('uint32')],
+                   'sceneRoots': [None, None, dtype('uint32'), None, dtype('uint32')],
+                   'traverseScenes': [None, None, dtype('uint32'), None, None, dtype('uint32'),
+                                      None, None, dtype('uint32')],
                    'fillInternal': [None, None, dtype('uint32')],
                    'generateBVH': [None, None, dtype('uint32')],
                    'leafBounds': [None, None, None, None, dtype('uint32')],
                    'internalBounds': [None, None, None, dtype('uint32')],
-                   'traverse': [None, None, dtype('uint32'), None, None, dtype('uint32')]}
+                   'surfaceAreas': [None, None, dtype('uint32')],
+                   'optimizeTreelets': [None, None, None, dtype('uint32')],
+                   'countCollisions': [None, None, None, dtype('uint32')],
+                   'writeCollisions': [None, None, dtype('uint32'), None, None, dtype('uint32')],
+                   'traverse': [None, None, dtype('uint32'), None, None, dtype('uint32')],
+                   'calculateRopes': [None, None, dtype('uint32')],
+                   'countCollisionsRopes': [None, None, None, None, dtype('uint32')],
+                   'writeCollisionsRopes': [None, None, dtype('uint32'),
+                                            None, None, None, dtype('uint32')],
+                   'traverseRopes': [None, None, dtype('uint32'),
+                                     None, None, None, dtype('uint32')],
+                   'query': [None, None, dtype('uint32'), None, None, dtype('uint32'),
+                             None, None, dtype('uint32')],
+                   'queryBounds': [None, None, dtype('uint32'), None, dtype('uint32'),
+                                   None, None, dtype('uint32')],
+                   'nearestNeighbours': [None, None, dtype('uint32'), None, None,
+                                         dtype('uint32'), dtype('uint32'),
+                                         None, None, dtype('uint32')]}
+    # Largest k for nearest-neighbour queries, sets per-thread storage
+    max_k = 32
+    # Leaves of each treelet restructured by optimizeTreelets, at most 8. Each thread
+    # searches all topologies of its treelet alone, in O(3^n).
+    treelet_size = 5
 
-    def __init__(self, ctx, coord_dtype=dtype('float32')):
+    def __init__(self, ctx, coord_dtype=dtype('float32'), code_dtype=dtype('uint32')):
         coord_dtype = dtype(coord_dtype)
+        code_dtype = dtype(code_dtype)
         if coord_dtype not in np_float_dtypes:
             raise ValueError("Invalid dtype: {}".format(coord_dtype))
+        if code_dtype not in code_dtypes:
+            raise ValueError("Invalid code dtype: {}".format(code_dtype))
         self.coord_dtype = coord_dtype
+        self.code_dtype = code_dtype
+        # Radius is passed as a coordinate
+        self.kernel_args = dict(
+            self.kernel_args,
+            countNeighbours=[None, None, None, dtype('uint32'), coord_dtype, dtype('uint32'),
+                             None, None, dtype('uint32')],
+            writeNeighbours=[None, None, dtype('uint32'), None, None, dtype('uint32'),
+                             coord_dtype, dtype('uint32'), None, None, dtype('uint32')],
+        )
 
-        super().__init__(ctx, ["-DDTYPE={}".format(dtype_decl(coord_dtype))])
+        super().__init__(ctx, ["-DDTYPE={}".format(dtype_decl(coord_dtype)),
+                               "-DCODE_BITS={}".format(code_dtype.itemsize * 8),
+                               "-DMAX_K={}".format(self.max_k),
+                               "-DTREELET_SIZE={}".format(self.treelet_size)])
 
 
-class Collider:
-    code_dtype = dtype('uint32')
+class ColliderBase:
+    # The BVH shared by Collider and BatchedCollider. Subclasses set up a sorter, and a
+    # reducer for the scene bounds, before allocating.
     flag_dtype = dtype('uint32') # Smallest atomic
     counter_dtype = dtype('uint32')
     id_dtype = dtype('uint32')
 
-    def __init__(self, ctx, size, ngroups, group_size, coord_dtype=dtype('float32'),
-                 program=None, sorter_programs=(None, None), reducer_program=None):
+    def __init__(self, ctx, size, group_size, coord_dtype, program, pool):
         self.size = size
         self.group_size = group_size
+        self._built = False
 
-        self.sorter = RadixSorter(
-            ctx, self.padded_size, group_size,
-            key_dtype=self.code_dtype, value_dtype=self.id_dtype,
-            program=sorter_programs[0], scan_program=sorter_programs[1]
-        )
-        self.reducer = Bounds(ctx, ngroups, group_size,
-                              coord_dtype=dtype((coord_dtype, 3)),
-                              program=reducer_program)
+        # Shared by all scratch buffers, including those of the sorter and reducer
+        self.pool = pool or BufferPool(ctx)
         if program is None:
-            program = CollisionProgram(ctx, coord_dtype)
+            program = CollisionProgram(ctx, coord_dtype, self.code_dtype)
         else:
             if program.context != ctx:
                 raise ValueError("Collider and program context must match")
             if program.coord_dtype != coord_dtype:
                 raise ValueError("Collider and program coord_dtype must match")
+            if program.code_dtype != self.code_dtype:
+                raise ValueError("Collider and program code_dtype must match")
         self.program = program
 
-        # Can't sort in-place
-        self._ids_bufs = [cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.padded_size * self.id_dtype.itemsize
-        ) for _ in range(2)]
-        self._codes_bufs = [cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.padded_size * self.code_dtype.itemsize
-        ) for _ in range(2)]
+        self._nodes_buf = self._bounds_buf = self._flags_buf = None
+        self._scene_bounds_buf = None
 
-        self._nodes_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.n_nodes * Node.itemsize
+    def _allocate(self):
+        pool = self.pool
+        self._nodes_buf = pool.allocate(self.n_nodes * Node.itemsize, self._nodes_buf)
+        self._bounds_buf = pool.allocate(
+            self.n_nodes * 2 * 4 * self.program.coord_dtype.itemsize, self._bounds_buf
         )
-        # Dual-use: storing per-node and scene bounds
-        self._bounds_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.n_nodes * 2 * 4 * self.program.coord_dtype.itemsize
+        self._flags_buf = pool.allocate(
+            self.n_nodes * self.flag_dtype.itemsize, self._flags_buf
         )
-        self._flags_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.n_nodes * self.flag_dtype.itemsize
+        # Not pooled, as the host may write given bounds into it. Only depends on the reducer.
+        if self._scene_bounds_buf is None:
+            self._scene_bounds_buf = cl.Buffer(
+                self.program.context, cl.mem_flags.READ_WRITE,
+                dtype_sizeof(self.reducer.program.acc_dtype)
+            )
+
+    @property
+    def n_nodes(self):
+        return self.size * 2 - 1
+
+    def _build_tree(self, cq, codes_buf, ids_buf, coords_buf, radii_buf, wait_for):
+        # From the sorted codes and ids, returns the topology events and the bounds event
+        fill_internal = self.program.kernels['fillInternal'](
+            cq, (roundUp(self.size, self.group_size),), None,
+            self._nodes_buf, ids_buf, self.size,
+            wait_for=wait_for
         )
+        generate_bvh = self.program.kernels['generateBVH'](
+            cq, (roundUp(self.size-1, self.group_size),), None,
+            codes_buf, self._nodes_buf, self.size,
+            wait_for=wait_for
+        )
+        topology = [fill_internal, generate_bvh]
+        return topology, self._calc_bounds(cq, coords_buf, radii_buf, topology)
 
-    def resize(self, size=None, ngroups=None, group_size=None, radix_bits=None):
-        ctx = self.program.context
-        old_padded_size = self.padded_size
-        old_n_nodes = self.n_nodes
+    def _calc_bounds(self, cq, coords_buf, radii_buf, wait_for):
+        clear_flags = cl.enqueue_fill_buffer(
+            cq, self._flags_buf, zeros(1, dtype=self.flag_dtype),
+            0, self.n_nodes * self.flag_dtype.itemsize
+        )
+        calc_bounds = self.program.kernels['leafBounds'](
+            cq, (roundUp(self.size, self.group_size),), None,
+            self._bounds_buf, coords_buf, radii_buf, self._nodes_buf, self.size,
+            wait_for=wait_for
+        )
+        return self.program.kernels['internalBounds'](
+            cq, (roundUp(self.size, self.group_size),), None,
+            self._bounds_buf, self._flags_buf, self._nodes_buf, self.size,
+            wait_for=[clear_flags, calc_bounds]
+        )
+
+    def refit(self, cq, coords_buf, radii_buf, wait_for=None):
+        if wait_for is None:
+            wait_for = []
+        if not self._built:
+            raise ValueError("Collider must be built before it can be refit")
+        # Wait here, as first use of external buffer
+        return self._calc_bounds(cq, coords_buf, radii_buf, wait_for)
+
+
+class Collider(ColliderBase):
+    def __init__(self, ctx, size, ngroups, group_size, coord_dtype=dtype('float32'),
+                 program=None, sorter_programs=(None, None), reducer_program=None,
+                 rebuild_interval=None, max_cost_ratio=None, code_dtype=dtype('uint32'),
+                 ordered=False, stackless=False, sphere_bounds=False,
+                 optimize_treelets=False, pool=None):
+        self.code_dtype = dtype(code_dtype)
+        if self.code_dtype not in code_dtypes:
+            raise ValueError("Invalid code dtype: {}".format(self.code_dtype))
+        super().__init__(ctx, size, group_size, coord_dtype, program, pool)
+
+        # Policy for update(), which refits the BVH unless a rebuild is due. A build happens
+        # every rebuild_interval frames, or once a refit tree costs more than max_cost_ratio
+        # times the last build. The latter blocks on reading back tree_cost every frame.
+        if rebuild_interval is not None and rebuild_interval < 1:
+            raise ValueError("Invalid rebuild interval: {}".format(rebuild_interval))
+        self.rebuild_interval = rebuild_interval
+        self.max_cost_ratio = max_cost_ratio
+        self._frames_since_build = 0
+        self._build_cost = None
+        self._summer = None
+        # Bounds of the coordinates of the last build, which the next may reuse
+        self._has_scene_bounds = False
+        # Last work to read or write the scene bounds, which a new build must wait for
+        self._scene_bounds_event = None
 
+        # Count and scan collisions per query instead of using a global atomic. The
+        # output is then deterministic, sorted by the id of the first of each pair.
+        self.ordered = ordered
+        self._scanner = None
+        self._neighbour_scanner = self._neighbour_counts_buf = None
+        # Traverse by following rope (skip) links instead of a per-thread stack
+        self.stackless = stackless
+        # Quantise codes within the bounds of the spheres rather than their centres, also
+        # finding the largest radius in the same pass
+        self.sphere_bounds = sphere_bounds
+        # Restructure small treelets of each build to reduce their surface area, which
+        # costs build time but speeds up traversal of poorly Morton-ordered scenes
+        self.optimize_treelets = optimize_treelets
+
+        self.sorter = RadixSorter(
+            ctx, self.padded_size, group_size,
+            key_dtype=self.code_dtype, value_dtype=self.id_dtype,
+            program=sorter_programs[0], scan_program=sorter_programs[1], pool=self.pool
+        )
+        reducer_type = SphereBounds if sphere_bounds else Bounds
+        self.reducer = reducer_type(ctx, ngroups, group_size,
+                                    coord_dtype=dtype((coord_dtype, 3)),
+                                    program=reducer_program, pool=self.pool)
+        if bool(self.reducer.program.extra_dtypes) != sphere_bounds:
+            raise ValueError("Reducer program must match sphere_bounds")
+
+        self._ids_bufs = [None, None]
+        self._codes_bufs = [None, None]
+        self._areas_buf = self._counts_buf = self._ropes_buf = None
+        self._allocate()
+
+        # Grown as needed by traverse_exact
+        self.collisions_capacity = 0
+        self.collisions_buf = None
+        self._n_collisions_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_READ_ONLY,
+            self.counter_dtype.itemsize
+        )
+
+    def resize(self, size=None, ngroups=None, group_size=None, radix_bits=None):
         if size is not None:
             self.size = size
         if group_size is not None:
             self.group_size = group_size
 
-        self.sorter.resize(roundUp(self.size, self.group_size), group_size, radix_bits)
+        self.sorter.resize(self.padded_size, group_size, radix_bits)
         self.reducer.resize(ngroups, group_size)
 
-        if old_padded_size != self.padded_size:
-            self._ids_bufs = [cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.padded_size * self.id_dtype.itemsize
-            ) for _ in range(2)]
-            self._codes_bufs = [cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.padded_size * self.code_dtype.itemsize
-            ) for _ in range(2)]
+        self._allocate()
+        # Topology no longer matches
+        self._built = False
+        if self._summer is not None:
+            self._summer.resize(ngroups, group_size)
+        if self._scanner is not None:
+            self._scanner.resize(self.counts_len, self.group_size)
 
-        if old_n_nodes != self.n_nodes:
-            self._nodes_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.n_nodes * Node.itemsize
-            )
-            self._bounds_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.n_nodes * 2 * 4 * self.program.coord_dtype.itemsize
+    def _allocate(self):
+        super()._allocate()
+        pool = self.pool
+        # Can't sort in-place
+        self._ids_bufs = [pool.allocate(self.padded_size * self.id_dtype.itemsize, buf)
+                          for buf in self._ids_bufs]
+        self._codes_bufs = [pool.allocate(self.padded_size * self.code_dtype.itemsize, buf)
+                            for buf in self._codes_bufs]
+        self._areas_buf = pool.allocate(
+            self.size * self.program.coord_dtype.itemsize, self._areas_buf
+        )
+        if self.stackless:
+            self._ropes_buf = pool.allocate(
+                self.n_nodes * self.id_dtype.itemsize, self._ropes_buf
             )
-            self._flags_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.n_nodes * self.flag_dtype.itemsize
+        if self._scanner is not None:
+            self._counts_buf = pool.allocate(
+                self.counts_len * self.counter_dtype.itemsize, self._counts_buf
             )
 
     @property
-    def n_nodes(self):
-        return self.size * 2 - 1
+    def counts_len(self):
+        # Extra element to hold the total after an exclusive scan
+        return self.size + 1
 
     @property
     def padded_size(self):
         # Sorter requires n % (2 * group_size) == 0
         return roundUp(self.size, 2 * self.group_size)
 
-    def get_collisions(self, cq, coords_buf, radii_buf, n_collisions_buf, collisions_buf,
-                       n_collisions, wait_for=None):
+    def build(self, cq, coords_buf, radii_buf, wait_for=None, scene_bounds=None):
+        # Codes are relative to scene bounds reduced from the coordinates, unless given as
+        # (min, max) corners or 'previous' for those of the last build's coordinates. Given
+        # bounds save a pass over the coordinates, as this build's are found while the codes
+        # are calculated. They need not contain every point (codes are clamped), but the
+        # closer they are, the better the tree.
         if wait_for is None:
             wait_for = []
-        if collisions_buf is None and n_collisions > 0:
-            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+        if scene_bounds is not None:
+            set_scene_bounds = self._set_scene_bounds(cq, scene_bounds)
 
         fill_codes = []
         if self.padded_size != self.size:
@@ -144,55 +299,519 @@ class Collider:
             cq, (self.padded_size,), None,
             self._ids_bufs[0]
         )
-        clear_flags = cl.enqueue_fill_buffer(
-            cq, self._flags_buf, zeros(1, dtype=self.flag_dtype),
-            0, self.n_nodes * self.flag_dtype.itemsize
+
+        if scene_bounds is None:
+            # Wait here, as first use of external buffer
+            calc_scene_bounds = self.reducer.reduce(
+                cq, self.size, (coords_buf, radii_buf) if self.sphere_bounds else coords_buf,
+                self._scene_bounds_buf, wait_for=wait_for
+            )
+            calc_codes = self.program.kernels['calculateCodes'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                self._codes_bufs[0], coords_buf, self._scene_bounds_buf, self.size,
+                wait_for=[calc_scene_bounds] + fill_codes
+            )
+        else:
+            reducer = self.reducer
+            ngroups = reducer.launch_groups(self.size)
+            calc_codes = self.program.kernels['calculateCodesBounds'](
+                cq, (ngroups * reducer.group_size,), (reducer.group_size,),
+                self._codes_bufs[0], coords_buf, radii_buf if self.sphere_bounds else None,
+                self._scene_bounds_buf, reducer.group_buf,
+                cl.LocalMemory(reducer.group_size * 3 * 4 * self.program.coord_dtype.itemsize),
+                self.size, wait_for=wait_for + set_scene_bounds + fill_codes
+            )
+            # Only overwrites the scene bounds once all codes are calculated
+            calc_scene_bounds = reducer.reduce_groups(
+                cq, self._scene_bounds_buf, wait_for=[calc_codes], ngroups=ngroups
+            )
+            calc_codes = cl.enqueue_marker(cq, wait_for=[calc_codes, calc_scene_bounds])
+        self._has_scene_bounds = True
+        self._scene_bounds_event = calc_codes
+
+        sort_codes = self.sorter.sort(
+            cq, *self._codes_bufs, *self._ids_bufs, wait_for=[calc_codes, fill_ids],
+            copy_result=False
+        )
+        # Consume the sorted result in-place, without copying
+        sorted_idx = self.sorter.output_index
+
+        topology, calc_bounds = self._build_tree(
+            cq, self._codes_bufs[sorted_idx], self._ids_bufs[sorted_idx],
+            coords_buf, radii_buf, [sort_codes]
+        )
+        # Treelets of two leaves have only one topology
+        if self.optimize_treelets and self.size > 2:
+            clear_flags = cl.enqueue_fill_buffer(
+                cq, self._flags_buf, zeros(1, dtype=self.flag_dtype),
+                0, self.n_nodes * self.flag_dtype.itemsize, wait_for=[calc_bounds]
+            )
+            calc_bounds = self.program.kernels['optimizeTreelets'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                self._nodes_buf, self._bounds_buf, self._flags_buf, self.size,
+                wait_for=[clear_flags]
+            )
+            topology = [calc_bounds]
+        if self.stackless:
+            calc_ropes = self.program.kernels['calculateRopes'](
+                cq, (roundUp(self.n_nodes, self.group_size),), None,
+                self._ropes_buf, self._nodes_buf, self.size,
+                wait_for=topology
+            )
+            calc_bounds = cl.enqueue_marker(cq, wait_for=[calc_bounds, calc_ropes])
+
+        self._built = True
+        self._frames_since_build = 0
+        # Costed by update(), if needed
+        self._build_cost = None
+        return calc_bounds
+
+    def _set_scene_bounds(self, cq, scene_bounds):
+        if isinstance(scene_bounds, str):
+            if scene_bounds != 'previous':
+                raise ValueError("Invalid scene bounds: {}".format(scene_bounds))
+            if not self._has_scene_bounds:
+                raise ValueError("Collider must be built before reusing its scene bounds")
+            return [self._scene_bounds_event]
+
+        bounds = zeros((2, 4), dtype=self.program.coord_dtype)
+        try:
+            bounds[:, :3] = scene_bounds
+        except ValueError:
+            raise ValueError("Scene bounds must be (min, max) corners")
+        # The previous build may still be using the scene bounds
+        wait_for = [self._scene_bounds_event] if self._has_scene_bounds else None
+        return [cl.enqueue_copy(cq, self._scene_bounds_buf, bounds, wait_for=wait_for,
+                                is_blocking=True)]
+
+    def get_scene_bounds(self, cq, wait_for=None):
+        # (min, max) corners of the last build, followed by the largest radius (repeated
+        # per axis) with sphere_bounds
+        if not self._has_scene_bounds:
+            raise ValueError("Collider must be built before reading its scene bounds")
+        bounds = zeros((len(self.reducer.program.accumulator), 4), dtype=self.program.coord_dtype)
+        cl.enqueue_copy(cq, bounds, self._scene_bounds_buf, is_blocking=True,
+                        wait_for=(wait_for or []) + [self._scene_bounds_event])
+        return bounds[:, :3]
+
+    def refit(self, cq, coords_buf, radii_buf, wait_for=None):
+        calc_bounds = super().refit(cq, coords_buf, radii_buf, wait_for)
+        self._frames_since_build += 1
+        return calc_bounds
+
+    def tree_cost(self, cq, wait_for=None):
+        # Sum of internal node surface areas, relative to the root
+        if self.size < 2:
+            return 0.0
+        if self._summer is None:
+            self._summer = Summer(self.program.context, self.reducer.ngroups,
+                                  self.reducer.group_size, self.program.coord_dtype,
+                                  pool=self.pool)
+            self._cost_buf = cl.Buffer(
+                self.program.context, cl.mem_flags.READ_WRITE,
+                self.program.coord_dtype.itemsize
+            )
+        calc_areas = self.program.kernels['surfaceAreas'](
+            cq, (roundUp(self.size - 1, self.group_size),), None,
+            self._areas_buf, self._bounds_buf, self.size,
+            wait_for=wait_for
+        )
+        calc_cost = self._summer.reduce(
+            cq, self.size - 1, self._areas_buf, self._cost_buf, wait_for=[calc_areas]
+        )
+        (cost_map, _) = cl.enqueue_map_buffer(
+            cq, self._cost_buf, cl.map_flags.READ,
+            0, 1, self.program.coord_dtype,
+            wait_for=[calc_cost], is_blocking=True
+        )
+        cost = float(cost_map[0])
+        del cost_map
+        return cost
+
+    def update(self, cq, coords_buf, radii_buf, wait_for=None, scene_bounds=None):
+        rebuild = not self._built
+        if self.rebuild_interval is not None:
+            # Counting this frame
+            rebuild |= self._frames_since_build + 1 >= self.rebuild_interval
+        if self.max_cost_ratio is not None and self._build_cost is None and not rebuild:
+            # Built outside update(), so cost the tree now unless it has since been refit
+            if self._frames_since_build == 0:
+                self._build_cost = self.tree_cost(cq, wait_for)
+            else:
+                rebuild = True
+
+        if not rebuild:
+            e = self.refit(cq, coords_buf, radii_buf, wait_for=wait_for)
+            if self.max_cost_ratio is None:
+                return e
+            if self.tree_cost(cq, [e]) <= self._build_cost * self.max_cost_ratio:
+                return e
+
+        e = self.build(cq, coords_buf, radii_buf, wait_for=wait_for,
+                       scene_bounds=scene_bounds)
+        if self.max_cost_ratio is not None:
+            self._build_cost = self.tree_cost(cq, [e])
+        return e
+
+    def count_collisions(self, cq, n_collisions_buf, wait_for=None):
+        if wait_for is None:
+            wait_for = []
+        ctx = self.program.context
+
+        if self._scanner is None:
+            self._scanner = PrefixScanner(ctx, self.counts_len, self.group_size,
+                                          self.sorter.scanner.program, self.pool)
+            self._counts_buf = self.pool.allocate(
+                self.counts_len * self.counter_dtype.itemsize
+            )
+
+        clear_counts = cl.enqueue_fill_buffer(
+            cq, self._counts_buf, zeros(1, dtype=self.counter_dtype),
+            0, self.counts_len * self.counter_dtype.itemsize
+        )
+        if self.stackless:
+            count_collisions = self.program.kernels['countCollisionsRopes'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                self._counts_buf, self._nodes_buf, self._ropes_buf, self._bounds_buf,
+                self.size, wait_for=[clear_counts] + wait_for,
+            )
+        else:
+            count_collisions = self.program.kernels['countCollisions'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                self._counts_buf, self._nodes_buf, self._bounds_buf, self.size,
+                wait_for=[clear_counts] + wait_for,
+            )
+        calc_offsets = self._scanner.prefix_sum(cq, self._counts_buf, [count_collisions])
+        return cl.enqueue_copy(
+            cq, n_collisions_buf, self._counts_buf, byte_count=self.counter_dtype.itemsize,
+            src_offset=self.size * self.counter_dtype.itemsize, wait_for=[calc_offsets]
+        )
+
+    def write_collisions(self, cq, collisions_buf, n_collisions, wait_for=None):
+        # Requires offsets from count_collisions
+        if self.stackless:
+            return self.program.kernels['writeCollisionsRopes'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                collisions_buf, self._counts_buf, n_collisions,
+                self._nodes_buf, self._ropes_buf, self._bounds_buf, self.size,
+                wait_for=wait_for,
+            )
+        return self.program.kernels['writeCollisions'](
+            cq, (roundUp(self.size, self.group_size),), None,
+            collisions_buf, self._counts_buf, n_collisions,
+            self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=wait_for,
+        )
+
+    def traverse(self, cq, n_collisions_buf, collisions_buf, n_collisions, wait_for=None):
+        if wait_for is None:
+            wait_for = []
+        if collisions_buf is None and n_collisions > 0:
+            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+
+        if self.ordered:
+            count_collisions = self.count_collisions(cq, n_collisions_buf, wait_for)
+            if n_collisions == 0:
+                return count_collisions
+            return self.write_collisions(cq, collisions_buf, n_collisions,
+                                         wait_for=[count_collisions])
+
+        clear_n_collisions = cl.enqueue_fill_buffer(
+            cq, n_collisions_buf, zeros(1, dtype=self.counter_dtype),
+            0, self.counter_dtype.itemsize
         )
+        if self.stackless:
+            return self.program.kernels['traverseRopes'](
+                cq, (roundUp(self.size, self.group_size),), None,
+                collisions_buf, n_collisions_buf, n_collisions,
+                self._nodes_buf, self._ropes_buf, self._bounds_buf, self.size,
+                wait_for=[clear_n_collisions] + wait_for,
+            )
+        find_collisions = self.program.kernels['traverse'](
+            cq, (roundUp(self.size, self.group_size),), None,
+            collisions_buf, n_collisions_buf, n_collisions,
+            self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=[clear_n_collisions] + wait_for,
+        )
+
+        return find_collisions
+
+    def query(self, cq, query_coords_buf, query_radii_buf, n_queries,
+              n_collisions_buf, collisions_buf, n_collisions, wait_for=None):
+        # Pairs are (query index, id), in undefined order
+        return self._query(cq, 'query', [query_coords_buf, query_radii_buf], n_queries,
+                           n_collisions_buf, collisions_buf, n_collisions, wait_for)
+
+    def query_bounds(self, cq, query_bounds_buf, n_queries,
+                     n_collisions_buf, collisions_buf, n_collisions, wait_for=None):
+        # As query(), but for (min, max) boxes laid out like the node bounds
+        return self._query(cq, 'queryBounds', [query_bounds_buf], n_queries,
+                           n_collisions_buf, collisions_buf, n_collisions, wait_for)
+
+    def _query(self, cq, kernel, query_bufs, n_queries,
+               n_collisions_buf, collisions_buf, n_collisions, wait_for):
+        if wait_for is None:
+            wait_for = []
+        if not self._built:
+            raise ValueError("Collider must be built before it can be queried")
+        if collisions_buf is None and n_collisions > 0:
+            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+
         clear_n_collisions = cl.enqueue_fill_buffer(
             cq, n_collisions_buf, zeros(1, dtype=self.counter_dtype),
             0, self.counter_dtype.itemsize
         )
+        if n_queries == 0:
+            return clear_n_collisions
+        return self.program.kernels[kernel](
+            cq, (roundUp(n_queries, self.group_size),), None,
+            collisions_buf, n_collisions_buf, n_collisions, *query_bufs, n_queries,
+            self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=[clear_n_collisions] + wait_for,
+        )
 
-        # Wait here, as first use of external buffer
-        calc_scene_bounds = self.reducer.reduce(
-            cq, self.size, coords_buf, self._bounds_buf, wait_for=wait_for
+    def count_neighbours(self, cq, coords_buf, query_coords_buf, n_queries, radius,
+                         offsets_buf, exclude_self=False, wait_for=None):
+        # CSR offsets of the points (as built) closer than radius to each query. There are
+        # n_queries + 1 offsets, the last is the total. With exclude_self, query i skips
+        # point i, e.g. when querying the built points themselves.
+        if wait_for is None:
+            wait_for = []
+        if not self._built:
+            raise ValueError("Collider must be built before it can be queried")
+        ctx = self.program.context
+
+        counts_len = n_queries + 1
+        if self._neighbour_scanner is None:
+            self._neighbour_scanner = PrefixScanner(ctx, counts_len, self.group_size,
+                                                    self.sorter.scanner.program, self.pool)
+        else:
+            self._neighbour_scanner.resize(counts_len, self.group_size)
+        self._neighbour_counts_buf = self.pool.allocate(
+            counts_len * self.counter_dtype.itemsize, self._neighbour_counts_buf
         )
 
-        calc_codes = self.program.kernels['calculateCodes'](
-            cq, (roundUp(self.size, self.group_size),), None,
-            self._codes_bufs[0], coords_buf, self._bounds_buf, self.size,
-            wait_for=[calc_scene_bounds] + fill_codes
+        clear_counts = cl.enqueue_fill_buffer(
+            cq, self._neighbour_counts_buf, zeros(1, dtype=self.counter_dtype),
+            0, counts_len * self.counter_dtype.itemsize
+        )
+        count_neighbours = self.program.kernels['countNeighbours'](
+            cq, (roundUp(n_queries, self.group_size),), None,
+            self._neighbour_counts_buf, coords_buf, query_coords_buf, n_queries,
+            radius, exclude_self, self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=[clear_counts] + wait_for,
+        )
+        calc_offsets = self._neighbour_scanner.prefix_sum(
+            cq, self._neighbour_counts_buf, [count_neighbours]
+        )
+        return cl.enqueue_copy(
+            cq, offsets_buf, self._neighbour_counts_buf,
+            byte_count=(n_queries + 1) * self.counter_dtype.itemsize,
+            wait_for=[calc_offsets]
         )
 
-        sort_codes = self.sorter.sort(
-            cq, *self._codes_bufs, *self._ids_bufs, wait_for=[calc_codes, fill_ids]
+    def write_neighbours(self, cq, coords_buf, query_coords_buf, n_queries, radius,
+                         offsets_buf, indices_buf, n_indices, exclude_self=False,
+                         wait_for=None):
+        # Requires offsets from count_neighbours, with the same arguments
+        if not self._built:
+            raise ValueError("Collider must be built before it can be queried")
+        return self.program.kernels['writeNeighbours'](
+            cq, (roundUp(n_queries, self.group_size),), None,
+            indices_buf, offsets_buf, n_indices, coords_buf, query_coords_buf, n_queries,
+            radius, exclude_self, self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=wait_for,
         )
 
-        fill_internal = self.program.kernels['fillInternal'](
-            cq, (roundUp(self.size, self.group_size),), None,
-            self._nodes_buf, self._ids_bufs[1], self.size,
-            wait_for=[sort_codes]
+    def nearest_neighbours(self, cq, coords_buf, query_coords_buf, n_queries, k,
+                           indices_buf, distances_buf, exclude_self=False, wait_for=None):
+        # k ids and distances per query, nearest first
+        if not self._built:
+            raise ValueError("Collider must be built before it can be queried")
+        if not 0 < k <= self.program.max_k:
+            raise ValueError("Invalid k ({}), must be in 1..{}".format(k, self.program.max_k))
+        return self.program.kernels['nearestNeighbours'](
+            cq, (roundUp(n_queries, self.group_size),), None,
+            indices_buf, distances_buf, k, coords_buf, query_coords_buf, n_queries,
+            exclude_self, self._nodes_buf, self._bounds_buf, self.size,
+            wait_for=wait_for,
         )
-        generate_bvh = self.program.kernels['generateBVH'](
-            cq, (roundUp(self.size-1, self.group_size),), None,
-            self._codes_bufs[1], self._nodes_buf, self.size,
-            wait_for=[sort_codes]
+
+    def traverse_exact(self, cq, wait_for=None):
+        ctx = self.program.context
+
+        if self.ordered:
+            # Counting is a separate pass anyway, so never write before the size is known
+            find_collisions = self.count_collisions(cq, self._n_collisions_buf, wait_for)
+        else:
+            find_collisions = self.traverse(
+                cq, self._n_collisions_buf, self.collisions_buf, self.collisions_capacity,
+                wait_for=wait_for
+            )
+        (n_collisions_map, _) = cl.enqueue_map_buffer(
+            cq, self._n_collisions_buf, cl.map_flags.READ,
+            0, 1, self.counter_dtype,
+            wait_for=[find_collisions], is_blocking=True
         )
-        calc_bounds = self.program.kernels['leafBounds'](
-            cq, (roundUp(self.size, self.group_size),), None,
-            self._bounds_buf, coords_buf, radii_buf, self._nodes_buf, self.size,
-            wait_for=[fill_internal, generate_bvh]
+        n_collisions = int(n_collisions_map[0])
+        del n_collisions_map
+        # The build has finished, so buffers released by resizing can be re-used
+        self.pool.reclaim(cq)
+
+        # Overflowed, so only re-run traversal on the existing BVH
+        if n_collisions > self.collisions_capacity:
+            self.collisions_capacity = n_collisions
+            self.collisions_buf = cl.Buffer(
+                ctx, cl.mem_flags.READ_WRITE,
+                self.collisions_capacity * 2 * self.id_dtype.itemsize
+            )
+            if not self.ordered:
+                find_collisions = self.traverse(
+                    cq, self._n_collisions_buf, self.collisions_buf,
+                    self.collisions_capacity, wait_for=[find_collisions]
+                )
+        if self.ordered and n_collisions > 0:
+            find_collisions = self.write_collisions(
+                cq, self.collisions_buf, self.collisions_capacity, wait_for=[find_collisions]
+            )
+
+        return find_collisions, n_collisions
+
+    def collide(self, cq, coords_buf, radii_buf, wait_for=None):
+        build = self.build(cq, coords_buf, radii_buf, wait_for=wait_for)
+        return self.traverse_exact(cq, wait_for=[build])
+
+    def get_collisions(self, cq, coords_buf, radii_buf, n_collisions_buf, collisions_buf,
+                       n_collisions, wait_for=None, scene_bounds=None):
+        if collisions_buf is None and n_collisions > 0:
+            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+
+        build = self.build(cq, coords_buf, radii_buf, wait_for=wait_for,
+                           scene_bounds=scene_bounds)
+        return self.traverse(cq, n_collisions_buf, collisions_buf, n_collisions,
+                             wait_for=[build])
+
+
+class BatchedCollider(ColliderBase):
+    # Many independent scenes in one launch per stage. Scenes are concatenated, with
+    # scene s spanning [offsets[s], offsets[s + 1]) of the coordinates. Scene ids are
+    # placed above 30-bit Morton codes, so one build gives a BVH per scene (joined at
+    # the top). Codes are relative to the bounds of all scenes.
+    code_dtype = dtype('uint64')
+
+    def __init__(self, ctx, size, ngroups, group_size, coord_dtype=dtype('float32'),
+                 program=None, sorter_programs=(None, None), reducer_program=None,
+                 pool=None):
+        super().__init__(ctx, size, group_size, coord_dtype, program, pool)
+        self.n_scenes = 0
+
+        self.sorter = SegmentedSorter(
+            ctx, size, group_size, value_dtype=self.id_dtype,
+            program=sorter_programs[0], scan_program=sorter_programs[1], pool=self.pool
+        )
+        self.reducer = Bounds(ctx, ngroups, group_size,
+                              coord_dtype=dtype((coord_dtype, 3)),
+                              program=reducer_program, pool=self.pool)
+
+        self._ids_bufs = [None, None]
+        self._codes_buf = self._roots_buf = self._offsets_buf = None
+        self._allocate()
+
+    def resize(self, size=None, ngroups=None, group_size=None, radix_bits=None):
+        if size is not None:
+            self.size = size
+        if group_size is not None:
+            self.group_size = group_size
+
+        self.sorter.resize(size, group_size, radix_bits)
+        self.reducer.resize(ngroups, group_size)
+        self._allocate()
+        self._built = False
+
+    def _allocate(self):
+        super()._allocate()
+        pool = self.pool
+        self._ids_bufs = [pool.allocate(self.padded_size * self.id_dtype.itemsize, buf)
+                          for buf in self._ids_bufs]
+        self._codes_buf = pool.allocate(self.size * self.sorter.key_dtype.itemsize,
+                                        self._codes_buf)
+
+    @property
+    def padded_size(self):
+        return self.sorter.padded_size
+
+    def build(self, cq, coords_buf, radii_buf, offsets_buf, n_scenes, wait_for=None):
+        # offsets_buf holds n_scenes + 1 offsets, the last being size
+        if wait_for is None:
+            wait_for = []
+        if n_scenes < 1:
+            raise ValueError("Invalid number of scenes ({})".format(n_scenes))
+
+        fill_ids = self.program.kernels['range'](
+            cq, (self.padded_size,), None,
+            self._ids_bufs[0]
         )
-        calc_bounds = self.program.kernels['internalBounds'](
+
+        # Wait here, as first use of external buffer
+        calc_scene_bounds = self.reducer.reduce(
+            cq, self.size, coords_buf, self._scene_bounds_buf, wait_for=wait_for
+        )
+        calc_codes = self.program.kernels['calculateSceneCodes'](
             cq, (roundUp(self.size, self.group_size),), None,
-            self._bounds_buf, self._flags_buf, self._nodes_buf, self.size,
-            wait_for=[clear_flags, calc_bounds]
+            self._codes_buf, coords_buf, self._scene_bounds_buf, self.size,
+            wait_for=[calc_scene_bounds]
         )
-        find_collisions = self.program.kernels['traverse'](
+        sort_codes = self.sorter.sort(
+            cq, self._codes_buf, None, offsets_buf, n_scenes, *self._ids_bufs,
+            wait_for=[calc_codes, fill_ids], copy_result=False
+        )
+
+        topology, calc_bounds = self._build_tree(
+            cq, self.sorter.segmented_keys_buf, self._ids_bufs[self.sorter.output_index],
+            coords_buf, radii_buf, [sort_codes]
+        )
+
+        self._roots_buf = self.pool.allocate(n_scenes * self.id_dtype.itemsize,
+                                             self._roots_buf)
+        calc_roots = self.program.kernels['sceneRoots'](
+            cq, (roundUp(n_scenes, self.group_size),), None,
+            self._roots_buf, offsets_buf, n_scenes, self._nodes_buf, self.size,
+            wait_for=topology
+        )
+
+        self.n_scenes = n_scenes
+        self._offsets_buf = offsets_buf
+        self._built = True
+        return cl.enqueue_marker(cq, wait_for=[calc_bounds, calc_roots])
+
+    def traverse(self, cq, n_collisions_buf, collisions_buf, n_collisions, wait_for=None):
+        # Collisions are (scene, id, id) triples, with ids indexing all scenes. Uses the
+        # offsets from build(), which must be unchanged.
+        if wait_for is None:
+            wait_for = []
+        if not self._built:
+            raise ValueError("Collider must be built before it can be traversed")
+        if collisions_buf is None and n_collisions > 0:
+            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+
+        clear_n_collisions = cl.enqueue_fill_buffer(
+            cq, n_collisions_buf, zeros(1, dtype=self.counter_dtype),
+            0, self.counter_dtype.itemsize
+        )
+        return self.program.kernels['traverseScenes'](
             cq, (roundUp(self.size, self.group_size),), None,
             collisions_buf, n_collisions_buf, n_collisions,
+            self._roots_buf, self._offsets_buf, self.n_scenes,
             self._nodes_buf, self._bounds_buf, self.size,
-            wait_for=[clear_n_collisions, calc_bounds],
+            wait_for=[clear_n_collisions] + wait_for,
         )
 
-        return find_collisions
+    def get_collisions(self, cq, coords_buf, radii_buf, offsets_buf, n_scenes,
+                       n_collisions_buf, collisions_buf, n_collisions, wait_for=None):
+        if collisions_buf is None and n_collisions > 0:
+            raise ValueError("Invalid collisions_buf for n_collisions > 0")
+
+        build = self.build(cq, coords_buf, radii_buf, offsets_buf, n_scenes,
+                           wait_for=wait_for)
+        return self.traverse(cq, n_collisions_buf, collisions_buf, n_collisions,
+                             wait_for=[build])
@@ -0,0 +1,138 @@
+from numpy import dtype, asarray, broadcast_to, empty, frombuffer
+import pyopencl as cl
+from .collision import Collider
+from .misc import nextPowerOf2
+
+def create_queue(ctx):
+    try:
+        properties = cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+        return cl.CommandQueue(ctx, properties=properties)
+    except cl.LogicError:
+        return cl.CommandQueue(ctx)
+
+
+class HostCollider:
+    # Buffers only ever grow, so repeated calls don't allocate
+    def __init__(self, ctx, coord_dtype=dtype('float32'), ngroups=None, group_size=None,
+                 cq=None):
+        self.ctx = ctx
+        self.cq = cq or create_queue(ctx)
+        self.coord_dtype = dtype(coord_dtype)
+
+        max_group_size = min(device.max_work_group_size for device in ctx.devices)
+        if group_size is None:
+            group_size = min(128, nextPowerOf2(max_group_size + 1) // 2)
+        if ngroups is None:
+            ngroups = min(64, group_size)
+        self.ngroups = ngroups
+        self.group_size = group_size
+
+        self.collider = None
+        self.capacity = 0
+        self.collisions_capacity = 0
+        # Sub-buffers (i.e. the pairs after the count) must be aligned
+        self._align = max(device.mem_base_addr_align for device in ctx.devices) // 8
+
+    def reserve(self, size):
+        if size <= self.capacity:
+            return
+        ctx = self.ctx
+        # Host-accessible staging, zero-copy where the device shares host memory
+        flags = cl.mem_flags.READ_ONLY | cl.mem_flags.ALLOC_HOST_PTR
+        self._coords_buf = cl.Buffer(ctx, flags, size * 4 * self.coord_dtype.itemsize)
+        self._radii_buf = cl.Buffer(ctx, flags, size * self.coord_dtype.itemsize)
+        self.capacity = size
+
+    def reserve_collisions(self, n_collisions):
+        if n_collisions <= self.collisions_capacity and self.collisions_capacity:
+            return
+        n_collisions = max(n_collisions, 1)
+        # Count and pairs in one buffer, so both are read back with a single map
+        self._output_buf = cl.Buffer(
+            self.ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+            self._align + n_collisions * 2 * Collider.id_dtype.itemsize
+        )
+        self._n_collisions_buf = self._output_buf.get_sub_region(
+            0, Collider.counter_dtype.itemsize
+        )
+        self._collisions_buf = self._output_buf.get_sub_region(
+            self._align, n_collisions * 2 * Collider.id_dtype.itemsize
+        )
+        self.collisions_capacity = n_collisions
+
+    def upload(self, coords, radii):
+        cq = self.cq
+        (coords_map, _) = cl.enqueue_map_buffer(
+            cq, self._coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, (len(coords), 4), self.coord_dtype,
+            is_blocking=True
+        )
+        coords_map[..., :3] = coords
+        (radii_map, _) = cl.enqueue_map_buffer(
+            cq, self._radii_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, len(radii), self.coord_dtype,
+            is_blocking=True
+        )
+        radii_map[...] = radii
+        del coords_map, radii_map
+
+    def find_collisions(self, coords, radii):
+        coords = asarray(coords, dtype=self.coord_dtype)
+        if coords.ndim != 2 or coords.shape[1] != 3:
+            raise ValueError("Invalid coords shape: {}".format(coords.shape))
+        radii = broadcast_to(asarray(radii, dtype=self.coord_dtype), (len(coords),))
+        size = len(coords)
+        if size < 2:
+            return empty((0, 2), dtype=Collider.id_dtype)
+
+        if self.collider is None:
+            self.collider = Collider(self.ctx, size, self.ngroups, self.group_size,
+                                     self.coord_dtype)
+        elif self.collider.size != size:
+            self.collider.resize(size)
+        self.reserve(size)
+        self.reserve_collisions(self.collisions_capacity)
+        self.upload(coords, radii)
+
+        cq = self.cq
+        e = self.collider.build(cq, self._coords_buf, self._radii_buf)
+        while True:
+            e = self.collider.traverse(
+                cq, self._n_collisions_buf, self._collisions_buf,
+                self.collisions_capacity, wait_for=[e]
+            )
+            (output_map, _) = cl.enqueue_map_buffer(
+                cq, self._output_buf, cl.map_flags.READ,
+                0, self._align + self.collisions_capacity * 2 * Collider.id_dtype.itemsize,
+                dtype('uint8'), wait_for=[e], is_blocking=True
+            )
+            n_collisions = int(frombuffer(output_map, Collider.counter_dtype, 1)[0])
+            if n_collisions <= self.collisions_capacity:
+                collisions = (frombuffer(output_map, Collider.id_dtype, n_collisions * 2,
+                                         self._align)
+                              .reshape(n_collisions, 2).copy())
+                del output_map
+                # All work has finished, so buffers released by resizing can be re-used
+                self.collider.pool.reclaim(cq)
+                return collisions
+            del output_map
+            # Overflowed, only traverse the existing BVH again
+            self.reserve_collisions(n_collisions)
+
+
+_default_ctx = None
+_colliders = {}
+
+def find_collisions(coords, radii, ctx=None):
+    global _default_ctx
+    if ctx is None:
+        if _default_ctx is None:
+            _default_ctx = cl.create_some_context(interactive=False)
+        ctx = _default_ctx
+
+    coords = asarray(coords)
+    coord_dtype = coords.dtype if coords.dtype.kind == 'f' else dtype('float32')
+    key = (ctx.int_ptr, coord_dtype)
+    if key not in _colliders:
+        _colliders[key] = HostCollider(ctx, coord_dtype)
+    return _colliders[key].find_collisions(coords, radii)
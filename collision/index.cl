@@ -11,3 +11,24 @@ kernel void scatter(global const VALUE_TYPE * const in_values,
     const size_t i = get_global_id(0);
     out_values[indices[i]] = in_values[i];
 }
+
+// Compaction: 1 per kept value, with an extra element for the total after scanning
+kernel void flag_offsets(global INDEX_TYPE * const offsets,
+                         global const unsigned int * const flags,
+                         const unsigned int n) {
+    const size_t i = get_global_id(0);
+    offsets[i] = (i < n && flags[i]) ? 1 : 0;
+}
+
+kernel void compact(global const VALUE_TYPE * const in_values,
+                    global const unsigned int * const flags,
+                    global const INDEX_TYPE * const offsets,
+                    global VALUE_TYPE * const out_values,
+                    global INDEX_TYPE * const count,
+                    const unsigned int n) {
+    const size_t i = get_global_id(0);
+    if (i == n)
+        count[0] = offsets[n];
+    else if (flags[i])
+        out_values[offsets[i]] = in_values[i];
+}
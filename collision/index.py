@@ -2,12 +2,16 @@ from numpy import dtype
 from pathlib import Path
 import pyopencl as cl
 from .misc import SimpleProgram, np_unsigned_dtypes, dtype_decl
+from .scan import PrefixScanProgram, PrefixScanner
+from .pool import BufferPool
 
 np_unsigned_dtypes = set(map(dtype, np_unsigned_dtypes))
 
 class IndexProgram(SimpleProgram):
     src = Path(__file__).parent / "index.cl"
-    kernel_args = {'gather': [None, None, None], 'scatter': [None, None, None]}
+    kernel_args = {'gather': [None, None, None], 'scatter': [None, None, None],
+                   'flag_offsets': [None, None, dtype('uint32')],
+                   'compact': [None, None, None, None, None, dtype('uint32')]}
 
     def __init__(self, ctx, value_dtype=dtype('uint32'), index_dtype=dtype('uint32')):
         self.value_dtype = dtype(value_dtype)
@@ -53,3 +57,66 @@ class Indexer:
             wait_for=wait_for
         )
         return index
+
+
+class Compactor:
+    # Keeps the values with non-zero flags, in order. The number kept is written to a
+    # device buffer, so it can be used without reading it back.
+    flag_dtype = dtype('uint32')
+
+    def __init__(self, ctx, size, group_size, value_dtype=dtype('uint32'),
+                 index_dtype=dtype('uint32'), program=None, scan_program=None, pool=None):
+        self.size = size
+        self.indexer = Indexer(ctx, value_dtype, index_dtype, program)
+        self.program = self.indexer.program
+        if scan_program is None:
+            scan_program = PrefixScanProgram(ctx, index_dtype)
+        elif scan_program.value_dtype != self.program.index_dtype:
+            raise ValueError("Scan program and index dtypes must match")
+        self.pool = pool or BufferPool(ctx)
+
+        # Extra element to hold the total after an exclusive scan
+        self.scanner = PrefixScanner(ctx, size + 1, group_size, scan_program, self.pool)
+        self._offsets_buf = self.pool.allocate(
+            (size + 1) * self.program.index_dtype.itemsize
+        )
+        self.count_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE,
+                                   self.program.index_dtype.itemsize)
+
+    def resize(self, size=None, group_size=None):
+        if size is not None:
+            self.size = size
+        self.scanner.resize(self.size + 1, group_size)
+        self._offsets_buf = self.pool.allocate(
+            (self.size + 1) * self.program.index_dtype.itemsize, self._offsets_buf
+        )
+
+    def compact(self, cq, values_buf, flags_buf, out_buf, count_buf=None, wait_for=None):
+        # out_buf must fit all values. The count goes to count_buf, or self.count_buf.
+        if count_buf is None:
+            count_buf = self.count_buf
+
+        calc_flags = self.program.kernels['flag_offsets'](
+            cq, (self.size + 1,), None,
+            self._offsets_buf, flags_buf, self.size,
+            wait_for=wait_for
+        )
+        calc_offsets = self.scanner.prefix_sum(cq, self._offsets_buf, [calc_flags])
+        return self.program.kernels['compact'](
+            cq, (self.size + 1,), None,
+            values_buf, flags_buf, self._offsets_buf, out_buf, count_buf, self.size,
+            wait_for=[calc_offsets]
+        )
+
+    def read_count(self, cq, count_buf=None, wait_for=None):
+        # Blocking
+        if count_buf is None:
+            count_buf = self.count_buf
+        (count_map, _) = cl.enqueue_map_buffer(
+            cq, count_buf, cl.map_flags.READ,
+            0, 1, self.program.index_dtype,
+            wait_for=wait_for, is_blocking=True
+        )
+        count = int(count_map[0])
+        del count_map
+        return count
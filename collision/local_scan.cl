@@ -1,25 +1,154 @@
+// Defaults to summing unsigned ints, as used by the radix sort
+#ifndef SCAN_TYPE
+#define SCAN_TYPE unsigned int
+#endif
+#ifndef SCAN_OP
+#define SCAN_OP ADD
+#endif
+#ifndef SCAN_IDENTITY
+#define SCAN_IDENTITY 0
+#endif
+
+#define ADD(x, y) ((x) + (y))
+
 // n <= 2 * local_size and a power of two
-void up_sweep(local unsigned int * data, const size_t n) {
+void up_sweep(local SCAN_TYPE * data, const size_t n) {
     for (size_t i = n / 2, o = 1; i > 0; i /= 2, o *= 2) {
         if (get_local_id(0) < i) {
             size_t a = o * (2 * get_local_id(0) + 1) - 1;
             size_t b = o * (2 * get_local_id(0) + 2) - 1;
-            data[b] += data[a];
+            data[b] = SCAN_OP(data[a], data[b]);
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
 }
 
-void down_sweep(local unsigned int * data, const size_t n) {
+void down_sweep(local SCAN_TYPE * data, const size_t n) {
     for (size_t i = 1, o = n / 2; i < n; i *= 2, o /= 2) {
         if (get_local_id(0) < i) {
             size_t a = o * (2 * get_local_id(0) + 1) - 1;
             size_t b = o * (2 * get_local_id(0) + 2) - 1;
 
-            unsigned int tmp = data[a];
+            SCAN_TYPE tmp = data[a];
             data[a] = data[b];
-            data[b] += tmp;
+            data[b] = SCAN_OP(data[b], tmp);
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
 }
+
+// Scans of a whole group's 2 * local_size values. By default, these use the sweeps above.
+// SCAN_PADDING skips a slot every NUM_BANKS values, so the doubling strides of the sweeps
+// fall in different local memory banks. SCAN_SUBGROUPS scans pairs of values with
+// sub-group collectives instead, then combines the sub-group totals.
+// Callers index the group's values with LOCAL_INDEX, and allocate LOCAL_LEN(n) values.
+#define LOG_NUM_BANKS 5
+#define PAD(i) ((i) + ((i) >> LOG_NUM_BANKS))
+
+#if defined(SCAN_PADDING)
+#define LOCAL_INDEX(i) PAD(i)
+#define LOCAL_LEN(n) PAD(n)
+#elif defined(SCAN_SUBGROUPS)
+#define LOCAL_INDEX(i) (i)
+// Room for a total per sub-group, and the group total
+#define LOCAL_LEN(n) ((n) + (n) / 2 + 1)
+#else
+#define LOCAL_INDEX(i) (i)
+#define LOCAL_LEN(n) (n)
+#endif
+
+// Sub-group collectives of SCAN_OP, named in full as min and max may be macros
+#ifndef SUB_GROUP_SCAN
+#define SUB_GROUP_SCAN sub_group_scan_exclusive_add
+#endif
+#ifndef SUB_GROUP_REDUCE
+#define SUB_GROUP_REDUCE sub_group_reduce_add
+#endif
+
+void padded_up_sweep(local SCAN_TYPE * data, const size_t n) {
+    for (size_t i = n / 2, o = 1; i > 0; i /= 2, o *= 2) {
+        if (get_local_id(0) < i) {
+            size_t a = o * (2 * get_local_id(0) + 1) - 1;
+            size_t b = o * (2 * get_local_id(0) + 2) - 1;
+            data[PAD(b)] = SCAN_OP(data[PAD(a)], data[PAD(b)]);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+void padded_down_sweep(local SCAN_TYPE * data, const size_t n) {
+    for (size_t i = 1, o = n / 2; i < n; i *= 2, o /= 2) {
+        if (get_local_id(0) < i) {
+            size_t a = o * (2 * get_local_id(0) + 1) - 1;
+            size_t b = o * (2 * get_local_id(0) + 2) - 1;
+
+            SCAN_TYPE tmp = data[PAD(a)];
+            data[PAD(a)] = data[PAD(b)];
+            data[PAD(b)] = SCAN_OP(data[PAD(b)], tmp);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+#ifdef SCAN_SUBGROUPS
+#pragma OPENCL EXTENSION cl_khr_subgroups : enable
+
+SCAN_TYPE group_exclusive_scan(local SCAN_TYPE * data, const size_t n) {
+    local SCAN_TYPE * const totals = data + n;
+    const size_t i = 2 * get_local_id(0);
+    const unsigned int sub_group = get_sub_group_id();
+    const unsigned int n_sub_groups = get_num_sub_groups();
+
+    const SCAN_TYPE a = data[i];
+    const SCAN_TYPE pair = SCAN_OP(a, data[i + 1]);
+    const SCAN_TYPE prefix = SUB_GROUP_SCAN(pair);
+    if (get_sub_group_local_id() == get_sub_group_size() - 1)
+        totals[sub_group] = SCAN_OP(prefix, pair);
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // There may be more sub-group totals than work-items per sub-group, so the first
+    // sub-group scans them a sub-group's width at a time
+    if (sub_group == 0) {
+        const unsigned int width = get_sub_group_size();
+        SCAN_TYPE carry = SCAN_IDENTITY;
+        for (unsigned int start = 0; start < n_sub_groups; start += width) {
+            const unsigned int j = start + get_sub_group_local_id();
+            const SCAN_TYPE total = j < n_sub_groups ? totals[j] : SCAN_IDENTITY;
+            const SCAN_TYPE total_prefix = SUB_GROUP_SCAN(total);
+            if (j < n_sub_groups)
+                totals[j] = SCAN_OP(carry, total_prefix);
+            carry = SCAN_OP(carry, SUB_GROUP_REDUCE(total));
+        }
+        if (get_sub_group_local_id() == 0)
+            totals[n_sub_groups] = carry;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    const SCAN_TYPE offset = SCAN_OP(totals[sub_group], prefix);
+    const SCAN_TYPE group_total = totals[n_sub_groups];
+    data[i] = offset;
+    data[i + 1] = SCAN_OP(offset, a);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    return group_total;
+}
+#else
+// n == 2 * local_size, returns the total to all work-items
+SCAN_TYPE group_exclusive_scan(local SCAN_TYPE * data, const size_t n) {
+#ifdef SCAN_PADDING
+    padded_up_sweep(data, n);
+#else
+    up_sweep(data, n);
+#endif
+    const SCAN_TYPE total = data[LOCAL_INDEX(n - 1)];
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (get_local_id(0) == 0)
+        data[LOCAL_INDEX(n - 1)] = SCAN_IDENTITY;
+    barrier(CLK_LOCAL_MEM_FENCE);
+#ifdef SCAN_PADDING
+    padded_down_sweep(data, n);
+#else
+    down_sweep(data, n);
+#endif
+    return total;
+}
+#endif
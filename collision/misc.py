@@ -2,14 +2,22 @@ import pyopencl as cl
 from numpy import dtype
 from functools import reduce
 import operator as op
+from .cache import ProgramCache
 
 class Program:
+    # Set to None to always build from source
+    cache = ProgramCache.default()
+
     def __init__(self, ctx, src, options=None, includes=None):
         options = options or []
-        if includes is not None:
+        includes = includes or []
+        if includes:
             options.append(' '.join(map("-I {}".format, includes)))
 
-        self.program = cl.Program(ctx, src).build(' '.join(options))
+        if self.cache is None:
+            self.program = cl.Program(ctx, src).build(' '.join(options))
+        else:
+            self.program = self.cache.build(ctx, src, ' '.join(options), includes)
         self.kernels = {name: getattr(self.program, name) for name in self.kernel_args}
         for name, kernel in self.kernels.items():
             kernel.set_scalar_arg_dtypes(self.kernel_args[name])
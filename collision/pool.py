@@ -0,0 +1,64 @@
+import pyopencl as cl
+
+class BufferPool:
+    # shrink_factor=None never shrinks a buffer, otherwise a buffer is replaced once it
+    # is more than shrink_factor times larger than needed. Growth over-allocates.
+    # Released buffers may still be in use by enqueued work, as nothing tracks its events.
+    # They are only re-used after reclaim(cq), which first waits for the queue to finish.
+    def __init__(self, ctx, flags=cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
+                 shrink_factor=None, growth=1.0):
+        if shrink_factor is not None and shrink_factor < growth:
+            raise ValueError("Shrink factor ({}) must be at least growth ({})"
+                             .format(shrink_factor, growth))
+        if growth < 1.0:
+            raise ValueError("Growth ({}) must be at least 1".format(growth))
+        self.context = ctx
+        self.flags = flags
+        self.shrink_factor = shrink_factor
+        self.growth = growth
+        self._free = []
+        self._pending = []
+
+    def fits(self, buf, nbytes):
+        if buf.size < nbytes:
+            return False
+        return self.shrink_factor is None or buf.size <= nbytes * self.shrink_factor
+
+    def allocate(self, nbytes, buf=None):
+        # Buffers can't be empty
+        nbytes = max(nbytes, 1)
+        if buf is not None:
+            if self.fits(buf, nbytes):
+                return buf
+            self.release(buf)
+
+        candidates = [b for b in self._free if self.fits(b, nbytes)]
+        if candidates:
+            buf = min(candidates, key=lambda b: b.size)
+            self._free.remove(buf)
+            return buf
+        return cl.Buffer(self.context, self.flags, int(nbytes * self.growth))
+
+    def release(self, buf):
+        if buf is not None:
+            self._pending.append(buf)
+
+    def reclaim(self, cq):
+        # Call once all work using the pool is enqueued on cq, ideally where it has finished
+        if not self._pending:
+            return
+        cq.finish()
+        self._free.extend(self._pending)
+        self._pending = []
+
+    def clear(self):
+        self._free = []
+        self._pending = []
+
+    @property
+    def free_size(self):
+        return sum(buf.size for buf in self._free)
+
+    @property
+    def pending_size(self):
+        return sum(buf.size for buf in self._pending)
@@ -1,8 +1,37 @@
 #include "local_scan.cl"
+#include "segment.cl"
 
-KEY_TYPE radix_key(KEY_TYPE key, unsigned char radix_bits, unsigned char pass) {
-    KEY_TYPE mask = (1 << radix_bits) - 1;
-    return (key >> (pass * radix_bits)) & mask;
+#define CAT_HELPER(X,Y) X##Y
+#define CAT(X,Y) CAT_HELPER(X,Y)
+
+#ifndef KEY_BITS_TYPE
+#define KEY_BITS_TYPE KEY_TYPE
+#endif
+
+// Maps keys to unsigned bits in sort order. Keys are stored unchanged, so nothing
+// needs to be undone on store.
+KEY_BITS_TYPE key_bits(const KEY_TYPE key) {
+#if defined(SIGNED_KEYS) || defined(FLOAT_KEYS)
+    KEY_BITS_TYPE bits = CAT(as_, KEY_BITS_TYPE)(key);
+    const KEY_BITS_TYPE sign = (KEY_BITS_TYPE) 1 << (sizeof(KEY_BITS_TYPE) * 8 - 1);
+#ifdef FLOAT_KEYS
+    // Sign-magnitude, so negative keys are in reverse order
+    bits ^= (bits & sign) ? (KEY_BITS_TYPE) ~0 : sign;
+#else
+    bits ^= sign;
+#endif
+#else
+    KEY_BITS_TYPE bits = key;
+#endif
+#ifdef DESCENDING
+    bits = ~bits;
+#endif
+    return bits;
+}
+
+unsigned int radix_key(const KEY_TYPE key, unsigned char radix_bits, unsigned char pass) {
+    const KEY_BITS_TYPE mask = (1 << radix_bits) - 1;
+    return (key_bits(key) >> (pass * radix_bits)) & mask;
 }
 
 // Radix-1 sort a region of 2 * local_size
@@ -11,18 +40,10 @@ unsigned int local_bin(const local KEY_TYPE * const keys,
     size_t size = get_local_size(0) * 2;
 
     for (size_t i = get_local_id(0); i < size; i += get_local_size(0))
-        count[i] = radix_key(keys[i], 1, pass);
+        count[LOCAL_INDEX(i)] = radix_key(keys[i], 1, pass);
 
     barrier(CLK_LOCAL_MEM_FENCE);
-    up_sweep(count, size);
-
-    unsigned int sum = count[size - 1];
-    barrier(CLK_LOCAL_MEM_FENCE);
-    if (get_local_id(0) == 0)
-        count[size - 1] = 0;
-
-    barrier(CLK_LOCAL_MEM_FENCE);
-    down_sweep(count, size);
+    const unsigned int sum = group_exclusive_scan(count, size);
 
     return size - sum;
 }
@@ -36,8 +57,9 @@ void local_scatter(const local KEY_TYPE * const keys,
     size_t size = get_local_size(0) * 2;
 
     for (size_t i = get_local_id(0); i < size; i += get_local_size(0)) {
-        KEY_TYPE key = radix_key(keys[i], 1, pass);
-        unsigned int new_key = key ? offset + count[i] : i - count[i];
+        const unsigned int key = radix_key(keys[i], 1, pass);
+        const unsigned int c = count[LOCAL_INDEX(i)];
+        unsigned int new_key = key ? offset + c : i - c;
 
         out_keys[new_key] = keys[i];
         if (values != NULL)
@@ -130,10 +152,171 @@ kernel void scatter(const global KEY_TYPE * const keys,
     down_sweep(local_histogram, histogram_len);
 
     for (size_t i = get_local_id(0); i < group_size; i += get_local_size(0)) {
-        const KEY_TYPE key = radix_key(keys[group_start+i], radix_bits, pass);
+        const unsigned int key = radix_key(keys[group_start+i], radix_bits, pass);
         const unsigned int new_idx = local_offset[key] + i - local_histogram[key];
         out_keys[new_idx] = keys[group_start+i];
         if (values != NULL && out_values != NULL)
             out_values[new_idx] = values[group_start+i];
     }
 }
+
+// Onesweep: digit counts for all passes are found up front, then each pass is a single
+// scatter where partitions find their offsets by looking back at earlier partitions.
+// Status entries hold a flag in the top two bits, so sizes must be < 2^30.
+#define FLAG_AGGREGATE (1u << 30)
+#define FLAG_PREFIX (2u << 30)
+#define FLAG_MASK (3u << 30)
+
+kernel void global_histogram(const global KEY_TYPE * const keys,
+                             global unsigned int * const histograms,
+                             local unsigned int * const local_histograms,
+                             const unsigned char radix_bits, const unsigned char num_passes) {
+    const size_t group_size = get_local_size(0) * 2;
+    const size_t group_start = group_size * get_group_id(0);
+    const size_t histograms_len = (1 << radix_bits) * num_passes;
+
+    for (size_t i = get_local_id(0); i < histograms_len; i += get_local_size(0))
+        local_histograms[i] = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (size_t i = get_local_id(0); i < group_size; i += get_local_size(0)) {
+        const KEY_TYPE key = keys[group_start + i];
+        for (unsigned char pass = 0; pass < num_passes; pass++)
+            atomic_inc(&local_histograms[(pass << radix_bits) +
+                                         radix_key(key, radix_bits, pass)]);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (size_t i = get_local_id(0); i < histograms_len; i += get_local_size(0))
+        if (local_histograms[i])
+            atomic_add(&histograms[i], local_histograms[i]);
+}
+
+kernel void onesweep(const global KEY_TYPE * const keys,
+                     global KEY_TYPE * const out_keys,
+                     const global VALUE_TYPE * const values,
+                     global VALUE_TYPE * const out_values,
+                     const global unsigned int * const histograms,
+                     global unsigned int * status,
+                     local KEY_TYPE * in_local_keys,
+                     local KEY_TYPE * out_local_keys,
+                     local VALUE_TYPE * in_local_values,
+                     local VALUE_TYPE * out_local_values,
+                     local unsigned int * const count,
+                     local unsigned int * const local_histogram,
+                     local unsigned int * const local_offset,
+                     const unsigned char radix_bits, const unsigned char pass) {
+    // # of elements processed by workgroup
+    const size_t group_size = get_local_size(0) * 2;
+    const size_t histogram_len = 1 << radix_bits;
+    local unsigned int partition;
+    event_t copy;
+
+    // Each pass has a partition counter, then an entry per partition and digit
+    status += pass * (1 + histogram_len * get_num_groups(0));
+    // Partitions are numbered in launch order, so earlier ones are always making progress
+    if (get_local_id(0) == 0)
+        partition = atomic_inc(status);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    const size_t group_start = group_size * partition;
+    global unsigned int * const partition_status = status + 1 + histogram_len * partition;
+
+    copy = async_work_group_copy(in_local_keys, keys + group_start, group_size, 0);
+    if (values != NULL)
+        copy = async_work_group_copy(in_local_values, values + group_start, group_size, copy);
+    else
+        in_local_values = out_local_values = NULL;
+    for (size_t i = get_local_id(0); i < histogram_len; i+= get_local_size(0))
+        local_histogram[i] = 0;
+    wait_group_events(1, &copy);
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (unsigned char i = 0; i < radix_bits; i++) {
+        const unsigned int offset = local_bin(in_local_keys, count, radix_bits * pass + i);
+
+        local_scatter(in_local_keys, out_local_keys, in_local_values, out_local_values,
+                      count, offset, radix_bits * pass + i);
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        local KEY_TYPE * const tmp = in_local_keys;
+        in_local_keys = out_local_keys;
+        out_local_keys = tmp;
+
+        if (values != NULL) {
+            local VALUE_TYPE * const tmp = in_local_values;
+            in_local_values = out_local_values;
+            out_local_values = tmp;
+        }
+    }
+
+    for (size_t i = get_local_id(0); i < group_size; i += get_local_size(0))
+        atomic_inc(&local_histogram[radix_key(in_local_keys[i], radix_bits, pass)]);
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Publish counts first, so later partitions aren't held up by our look-back
+    for (size_t i = get_local_id(0); i < histogram_len; i += get_local_size(0))
+        atomic_xchg(&partition_status[i],
+                    (partition ? FLAG_AGGREGATE : FLAG_PREFIX) | local_histogram[i]);
+
+    for (size_t i = get_local_id(0); i < histogram_len; i += get_local_size(0)) {
+        unsigned int prefix = 0;
+        for (size_t p = partition; p > 0; p--) {
+            global unsigned int * const previous = status + 1 + histogram_len * (p - 1) + i;
+            unsigned int value;
+            do {
+                value = atomic_or(previous, 0);
+            } while (!(value & FLAG_MASK));
+            prefix += value & ~FLAG_MASK;
+            if (value & FLAG_PREFIX)
+                break;
+        }
+        if (partition)
+            atomic_xchg(&partition_status[i], FLAG_PREFIX | (prefix + local_histogram[i]));
+        local_offset[i] = prefix;
+        // Scratch space for the start of each digit across all partitions
+        count[i] = histograms[(pass << radix_bits) + i];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    up_sweep(count, histogram_len);
+    if (get_local_id(0) == 0)
+        count[histogram_len - 1] = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    down_sweep(count, histogram_len);
+
+    up_sweep(local_histogram, histogram_len);
+    if (get_local_id(0) == 0)
+        local_histogram[histogram_len - 1] = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    down_sweep(local_histogram, histogram_len);
+
+    for (size_t i = get_local_id(0); i < histogram_len; i += get_local_size(0))
+        local_offset[i] += count[i] - local_histogram[i];
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Local keys are sorted by digit, so the rank within a digit is i - local_histogram[key]
+    for (size_t i = get_local_id(0); i < group_size; i += get_local_size(0)) {
+        const unsigned int key = radix_key(in_local_keys[i], radix_bits, pass);
+        const unsigned int new_idx = local_offset[key] + i;
+        out_keys[new_idx] = in_local_keys[i];
+        if (values != NULL)
+            out_values[new_idx] = in_local_values[i];
+    }
+}
+
+// Segmented sort: segment ids above 32-bit keys, with padding (i >= n) last
+kernel void segment_keys(global ulong * const out_keys,
+                         const global unsigned int * const keys,
+                         const global unsigned int * const offsets,
+                         const unsigned int n_segments, const unsigned int n) {
+    const unsigned int i = get_global_id(0);
+    if (i >= n)
+        out_keys[i] = ((ulong) n_segments << 32) | UINT_MAX;
+    else
+        out_keys[i] = ((ulong) findSegment(offsets, n_segments, i) << 32) | keys[i];
+}
+
+kernel void split_keys(global unsigned int * const out_keys,
+                       const global ulong * const keys) {
+    out_keys[get_global_id(0)] = (unsigned int) keys[get_global_id(0)];
+}
@@ -1,42 +1,95 @@
-from numpy import dtype
+from numpy import dtype, zeros
 from pathlib import Path
 import pyopencl as cl
-from .misc import SimpleProgram, nextPowerOf2, roundUp, np_unsigned_dtypes, dtype_decl
-from .scan import PrefixScanProgram, PrefixScanner
+from .misc import (SimpleProgram, nextPowerOf2, roundUp, np_integer_dtypes,
+                   np_unsigned_dtypes, dtype_decl, dtype_sizeof)
+from .scan import (PrefixScanProgram, PrefixScanner, ceildiv, group_scan_build_options,
+                   group_scan_len)
+from .pool import BufferPool
+from .reduce import ReductionProgram, Reducer
 
 np_unsigned_dtypes = set(map(dtype, np_unsigned_dtypes))
+np_signed_dtypes = set(map(dtype, np_integer_dtypes))
+np_float_key_dtypes = set(map(dtype, ['float32', 'float64']))
 
 class RadixProgram(SimpleProgram):
     src = Path(__file__).parent / "radix.cl"
     kernel_args = {'block_sort': [None, None, None, None, None, None, None, None, None,
                                   dtype('uint8'), dtype('uint8')],
                    'scatter': [None, None, None, None, None, None, None, None,
-                               dtype('uint8'), dtype('uint8')]}
+                               dtype('uint8'), dtype('uint8')],
+                   'global_histogram': [None, None, None, dtype('uint8'), dtype('uint8')],
+                   'onesweep': [None, None, None, None, None, None, None, None, None, None,
+                                None, None, None, dtype('uint8'), dtype('uint8')],
+                   'segment_keys': [None, None, None, dtype('uint32'), dtype('uint32')],
+                   'split_keys': [None, None]}
 
-    def __init__(self, ctx, key_dtype=dtype('uint32'), value_dtype=dtype('uint32')):
+    def __init__(self, ctx, key_dtype=dtype('uint32'), value_dtype=dtype('uint32'),
+                 descending=False, group_scan='sweep'):
         self.key_dtype = dtype(key_dtype)
         self.value_dtype = dtype(value_dtype)
-        if self.key_dtype not in np_unsigned_dtypes:
+        self.descending = descending
+        self.group_scan = group_scan
+        options = group_scan_build_options(ctx, group_scan).copy()
+        if self.key_dtype in np_signed_dtypes:
+            options.append("-DSIGNED_KEYS")
+        elif self.key_dtype in np_float_key_dtypes:
+            options.append("-DFLOAT_KEYS")
+        elif self.key_dtype not in np_unsigned_dtypes:
             raise ValueError("Invalid key dtype: {}".format(self.key_dtype))
+        if descending:
+            options.append("-DDESCENDING")
+        # Unsigned integer of the same size, which digits are taken from
+        self.bits_dtype = dtype('u{}'.format(self.key_dtype.itemsize))
 
         super().__init__(ctx, [
             "-DKEY_TYPE='{}'".format(dtype_decl(self.key_dtype)),
+            "-DKEY_BITS_TYPE='{}'".format(dtype_decl(self.bits_dtype)),
             "-DVALUE_TYPE='{}'".format(dtype_decl(self.value_dtype))
-        ])
+        ] + options)
 
-class RadixSorter:
+class KeyRangeProgram(ReductionProgram):
+    # Bits set in any key, and bits set in all keys
+    accumulator = [("0", "OR"), ("~0", "AND")]
+
+    def __init__(self, ctx, key_dtype=dtype('uint32')):
+        super().__init__(ctx, key_dtype)
+
+class KeyRange(Reducer):
+    program_type = KeyRangeProgram
+
+    def __init__(self, ctx, ngroups, group_size, key_dtype=dtype('uint32'),
+                 program=None, pool=None):
+        super().__init__(ctx, ngroups, group_size, key_dtype, program, pool)
+
+
+def copy_sorted(cq, size, keys_bufs, values_bufs, key_size, value_size, wait_for):
+    # Result is back in the input buffers after an even number of passes
+    copies = [cl.enqueue_copy(
+        cq, keys_bufs[1], keys_bufs[0], wait_for=wait_for, byte_count=size * key_size,
+    )]
+    if values_bufs[0] is not None:
+        # Copying the whole buffer is faster than a 3-vector rect
+        copies.append(cl.enqueue_copy(
+            cq, values_bufs[1], values_bufs[0], wait_for=wait_for,
+            byte_count=size * value_size,
+        ))
+    return cl.enqueue_marker(cq, wait_for=copies)
+
+
+class SorterBase:
+    # Program validation, sizing, key ranges and local memory shared by the radix sorters
     histogram_dtype = dtype('uint32')
 
-    def __init__(self, ctx, size, group_size, radix_bits=4,
-                 key_dtype=dtype('uint32'), value_dtype=dtype('uint32'),
-                 program=None, scan_program=None):
+    def __init__(self, ctx, size, group_size, radix_bits, key_dtype, value_dtype,
+                 program, pool, skip_constant, range_program, descending):
         self.check_size(size, group_size, radix_bits, key_dtype)
         self.size = size
         self.group_size = group_size
         self.radix_bits = radix_bits
 
         if program is None:
-            program = RadixProgram(ctx, key_dtype, value_dtype)
+            program = RadixProgram(ctx, key_dtype, value_dtype, descending)
         else:
             if program.context != ctx:
                 raise ValueError("Sorter and program contexts must match")
@@ -44,19 +97,20 @@ class RadixSorter:
                 raise ValueError("Sorter and program key dtypes must match")
             if program.value_dtype != value_dtype:
                 raise ValueError("Sorter and program value dtypes must match")
+            if program.descending != descending:
+                raise ValueError("Sorter and program order must match")
         self.program = program
-        if scan_program is None:
-            scan_program = PrefixScanProgram(ctx)
-        self.scanner = PrefixScanner(ctx, self.histogram_len, self.group_size, scan_program)
+        self.pool = pool or BufferPool(ctx)
 
-        self._histogram_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.histogram_len * self.histogram_dtype.itemsize
-        )
-        self._offset_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            self.histogram_len * self.histogram_dtype.itemsize
-        )
+        # Skip passes where all keys share a digit, at the cost of a blocking pre-pass
+        self.key_range = None
+        if skip_constant:
+            self.key_range = KeyRange(ctx, group_size, group_size, self.program.bits_dtype,
+                                      range_program, self.pool)
+            self._range_buf = cl.Buffer(
+                ctx, cl.mem_flags.READ_WRITE, 2 * self.program.bits_dtype.itemsize
+            )
+        self.output_index = self.num_passes % 2
 
     @staticmethod
     def check_size(size, group_size, radix_bits, key_dtype):
@@ -73,15 +127,14 @@ class RadixSorter:
             raise ValueError("2 ^ radix_bits ({}) must be less than 2 * group_size ({})"
                              .format(radix_bits, group_size))
 
-    def resize(self, size=None, group_size=None, radix_bits=None):
-        ctx = self.program.context
+    def _resize(self, size, group_size, radix_bits):
+        # Returns the previous (size, group_size, radix_bits), to restore on failure
         if size is None:
             size = self.size
         if group_size is None:
             group_size = self.group_size
         if radix_bits is None:
             radix_bits = self.radix_bits
-        old_histogram_len = self.histogram_len
         old_params = (self.size, self.group_size, self.radix_bits)
 
         self.check_size(size, group_size, radix_bits, self.program.key_dtype)
@@ -89,58 +142,131 @@ class RadixSorter:
         self.size = size
         self.group_size = group_size
         self.radix_bits = radix_bits
-
-        try:
-            self.scanner.resize(self.histogram_len, self.group_size)
-        except:
-            self.size, self.group_size, self.radix_bits = old_params
-            raise
-
-        if self.histogram_len != old_histogram_len:
-            self._histogram_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.histogram_len * self.histogram_dtype.itemsize
-            )
-            self._offset_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.histogram_len * self.histogram_dtype.itemsize
-            )
+        if self.key_range is not None:
+            self.key_range.resize(self.group_size, self.group_size)
+        self.output_index = self.num_passes % 2
+        return old_params
 
     @property
     def num_passes(self):
         return (self.program.key_dtype.itemsize * 8) // self.radix_bits
 
     @property
-    def histogram_len(self):
-        length = (2 ** self.radix_bits) * self.size // 2 // self.group_size
-        return roundUp(length, 2 * self.group_size) # Round up for scanner
+    def value_size(self):
+        # 3-vectors are laid out as 4-vectors
+        if self.program.value_dtype.shape != (3,):
+            return self.program.value_dtype.itemsize
+        return dtype((self.program.value_dtype.base, 4)).itemsize
 
-    def sort(self, cq, keys_buf, out_keys_buf,
-             in_values_buf=None, out_values_buf=None, wait_for=None):
-        wait_for = wait_for or []
+    def varying_passes(self, cq, keys_buf, wait_for=None):
+        # Blocks until the key range is known
+        calc_range = self.key_range.reduce(cq, self.size, keys_buf, self._range_buf,
+                                           wait_for=wait_for)
+        (range_map, _) = cl.enqueue_map_buffer(
+            cq, self._range_buf, cl.map_flags.READ,
+            0, 2, self.program.bits_dtype,
+            wait_for=[calc_range], is_blocking=True
+        )
+        varying = int(range_map[0] ^ range_map[1])
+        del range_map
 
-        if self.program.value_dtype.shape != (3,):
-            value_size = self.program.value_dtype.itemsize
+        # Other flips are constant, but negative floats have all bits flipped
+        sign_bit = self.program.bits_dtype.itemsize * 8 - 1
+        if self.program.key_dtype in np_float_key_dtypes and varying >> sign_bit:
+            return list(range(self.num_passes))
+
+        mask = 2 ** self.radix_bits - 1
+        return [radix_pass for radix_pass in range(self.num_passes)
+                if (varying >> (radix_pass * self.radix_bits)) & mask]
+
+    def _passes(self, cq, keys_buf, passes, wait_for):
+        # Given passes, else only those that vary with skip_constant, else all of them
+        if passes is not None:
+            passes = list(passes)
+        elif self.key_range is not None:
+            passes = self.varying_passes(cq, keys_buf, wait_for)
         else:
-            value_dtype = self.program.value_dtype.base
-            value_size = dtype((value_dtype, 4)).itemsize
+            passes = list(range(self.num_passes))
+        self.output_index = len(passes) % 2
+        return passes
+
+    def _local_memory(self):
+        # Keys, values, digit counts and a histogram of a group's block
         local_keys = cl.LocalMemory(
             self.group_size * 2 * self.program.key_dtype.itemsize
         )
         local_values = cl.LocalMemory(
-            self.group_size * 2 * value_size
+            self.group_size * 2 * self.value_size
         )
         local_count = cl.LocalMemory(
-            self.group_size * 2 * self.histogram_dtype.itemsize
+            group_scan_len(self.group_size * 2, self.program.group_scan)
+            * self.histogram_dtype.itemsize
         )
-        local_histogram = local_offset = cl.LocalMemory(
+        local_histogram = cl.LocalMemory(
             2 ** self.radix_bits * self.histogram_dtype.itemsize
         )
+        return local_keys, local_values, local_count, local_histogram
+
+
+class RadixSorter(SorterBase):
+    def __init__(self, ctx, size, group_size, radix_bits=4,
+                 key_dtype=dtype('uint32'), value_dtype=dtype('uint32'),
+                 program=None, scan_program=None, pool=None,
+                 skip_constant=False, range_program=None, descending=False):
+        super().__init__(ctx, size, group_size, radix_bits, key_dtype, value_dtype,
+                         program, pool, skip_constant, range_program, descending)
+        if scan_program is None:
+            scan_program = PrefixScanProgram(ctx)
+        self.scanner = PrefixScanner(ctx, self.histogram_len, self.group_size, scan_program,
+                                     self.pool)
+
+        self._histogram_buf = self.pool.allocate(
+            self.histogram_len * self.histogram_dtype.itemsize
+        )
+        self._offset_buf = self.pool.allocate(
+            self.histogram_len * self.histogram_dtype.itemsize
+        )
+
+    def resize(self, size=None, group_size=None, radix_bits=None):
+        old_params = self._resize(size, group_size, radix_bits)
+        try:
+            self.scanner.resize(self.histogram_len, self.group_size)
+        except:
+            self._resize(*old_params)
+            raise
+
+        self._histogram_buf = self.pool.allocate(
+            self.histogram_len * self.histogram_dtype.itemsize, self._histogram_buf
+        )
+        self._offset_buf = self.pool.allocate(
+            self.histogram_len * self.histogram_dtype.itemsize, self._offset_buf
+        )
+
+    @property
+    def histogram_len(self):
+        return (2 ** self.radix_bits) * self.size // 2 // self.group_size
+
+    def sort(self, cq, keys_buf, out_keys_buf, in_values_buf=None, out_values_buf=None,
+             wait_for=None, copy_result=True, passes=None):
+        # Without copy_result, output_index is which of (in, out) buffers hold the result.
+        # Passes can be restricted to digits known to vary.
+        wait_for = wait_for or []
+        local_keys, local_values, local_count, local_histogram = self._local_memory()
+        local_offset = local_histogram
+
+        # Alternate between buffers, rather than copying back after each pass
+        keys_bufs = [keys_buf, out_keys_buf]
+        values_bufs = [in_values_buf, out_values_buf]
+        if in_values_buf is None or out_values_buf is None:
+            values_bufs = [None, None]
 
-        for radix_pass in range(self.num_passes):
+        passes = self._passes(cq, keys_buf, passes, wait_for)
+        for i, radix_pass in enumerate(passes):
+            src, dst = i % 2, (i + 1) % 2
             block_sort = self.program.kernels['block_sort'](
                 cq, (self.size // 2,), (self.group_size,),
-                keys_buf, local_keys, local_keys, in_values_buf, local_values, local_values,
+                keys_bufs[src], local_keys, local_keys,
+                values_bufs[src], local_values, local_values,
                 self._histogram_buf, local_histogram, local_count,
                 self.radix_bits, radix_pass, wait_for=wait_for
             )
@@ -151,20 +277,197 @@ class RadixSorter:
             calc_scan = self.scanner.prefix_sum(cq, self._offset_buf, [copy_histogram])
             calc_scatter = self.program.kernels['scatter'](
                 cq, (self.size // 2,), (self.group_size,),
-                keys_buf, out_keys_buf, in_values_buf, out_values_buf,
+                keys_bufs[src], keys_bufs[dst], values_bufs[src], values_bufs[dst],
                 self._offset_buf, local_offset, self._histogram_buf, local_histogram,
                 self.radix_bits, radix_pass, wait_for=[calc_scan]
             )
-            fill_keys = cl.enqueue_copy(
-                cq, keys_buf, out_keys_buf, wait_for=[calc_scatter],
-                byte_count=self.size * self.program.key_dtype.itemsize,
+            wait_for = [calc_scatter]
+
+        if not copy_result or self.output_index == 1:
+            return cl.enqueue_marker(cq, wait_for=wait_for)
+        return copy_sorted(cq, self.size, keys_bufs, values_bufs,
+                           self.program.key_dtype.itemsize, self.value_size, wait_for)
+
+
+class OnesweepSorter(SorterBase):
+    # Drop-in for RadixSorter with one kernel per pass: digit counts for all passes are
+    # found up-front, and partitions find their offsets with a decoupled look-back. This
+    # relies on earlier work-groups making progress while later ones wait for them.
+    status_dtype = dtype('uint32')
+    max_size = 2 ** 30 # Top two bits of status are flags
+
+    def __init__(self, ctx, size, group_size, radix_bits=4,
+                 key_dtype=dtype('uint32'), value_dtype=dtype('uint32'),
+                 program=None, pool=None, descending=False,
+                 skip_constant=False, range_program=None):
+        super().__init__(ctx, size, group_size, radix_bits, key_dtype, value_dtype,
+                         program, pool, skip_constant, range_program, descending)
+
+        self._histograms_buf = self.pool.allocate(
+            self.histograms_len * self.histogram_dtype.itemsize
+        )
+        self._status_buf = self.pool.allocate(self.status_len * self.status_dtype.itemsize)
+
+    @classmethod
+    def check_size(cls, size, group_size, radix_bits, key_dtype):
+        SorterBase.check_size(size, group_size, radix_bits, key_dtype)
+        if size >= cls.max_size:
+            raise ValueError("Size ({}) must be less than {}".format(size, cls.max_size))
+
+    def resize(self, size=None, group_size=None, radix_bits=None):
+        self._resize(size, group_size, radix_bits)
+
+        self._histograms_buf = self.pool.allocate(
+            self.histograms_len * self.histogram_dtype.itemsize, self._histograms_buf
+        )
+        self._status_buf = self.pool.allocate(
+            self.status_len * self.status_dtype.itemsize, self._status_buf
+        )
+
+    @property
+    def num_partitions(self):
+        return self.size // 2 // self.group_size
+
+    @property
+    def histograms_len(self):
+        return (2 ** self.radix_bits) * self.num_passes
+
+    @property
+    def status_len(self):
+        # Per pass, a partition counter and an entry per partition and digit
+        return self.num_passes * (1 + (2 ** self.radix_bits) * self.num_partitions)
+
+    def sort(self, cq, keys_buf, out_keys_buf, in_values_buf=None, out_values_buf=None,
+             wait_for=None, copy_result=True, passes=None):
+        # As RadixSorter.sort. Digit counts are still found for all passes at once.
+        wait_for = wait_for or []
+        local_keys, local_values, local_count, local_histogram = self._local_memory()
+        local_offset = cl.LocalMemory(
+            2 ** self.radix_bits * self.histogram_dtype.itemsize
+        )
+
+        passes = self._passes(cq, keys_buf, passes, wait_for)
+        clear_histograms = cl.enqueue_fill_buffer(
+            cq, self._histograms_buf, zeros(1, dtype=self.histogram_dtype),
+            0, self.histograms_len * self.histogram_dtype.itemsize
+        )
+        clear_status = cl.enqueue_fill_buffer(
+            cq, self._status_buf, zeros(1, dtype=self.status_dtype),
+            0, self.status_len * self.status_dtype.itemsize
+        )
+        calc_histograms = self.program.kernels['global_histogram'](
+            cq, (self.size // 2,), (self.group_size,),
+            keys_buf, self._histograms_buf,
+            cl.LocalMemory(self.histograms_len * self.histogram_dtype.itemsize),
+            self.radix_bits, self.num_passes, wait_for=[clear_histograms] + wait_for
+        )
+
+        # Alternate between buffers, rather than copying back after each pass
+        keys_bufs = [keys_buf, out_keys_buf]
+        values_bufs = [in_values_buf, out_values_buf]
+        if in_values_buf is None or out_values_buf is None:
+            values_bufs = [None, None]
+        wait_for = [calc_histograms, clear_status]
+        for i, radix_pass in enumerate(passes):
+            src, dst = i % 2, (i + 1) % 2
+            calc_scatter = self.program.kernels['onesweep'](
+                cq, (self.size // 2,), (self.group_size,),
+                keys_bufs[src], keys_bufs[dst], values_bufs[src], values_bufs[dst],
+                self._histograms_buf, self._status_buf,
+                local_keys, local_keys, local_values, local_values,
+                local_count, local_histogram, local_offset,
+                self.radix_bits, radix_pass, wait_for=wait_for
             )
-            wait_for = [fill_keys]
-            if in_values_buf is not None and out_values_buf is not None:
-                # Copying the whole buffer is faster than a 3-vector rect
-                fill_values = cl.enqueue_copy(
-                    cq, in_values_buf, out_values_buf, wait_for=[calc_scatter],
-                    byte_count=self.size * value_size,
-                )
-                wait_for.append(fill_values)
-        return calc_scatter
+            wait_for = [calc_scatter]
+
+        if not copy_result or self.output_index == 1:
+            return cl.enqueue_marker(cq, wait_for=wait_for)
+        return copy_sorted(cq, self.size, keys_bufs, values_bufs,
+                           self.program.key_dtype.itemsize, self.value_size, wait_for)
+
+
+class SegmentedSorter:
+    # Sorts uint32 keys within each contiguous segment, for any number of segments in
+    # a single sort. Segment ids are placed above the keys, and only passes over bits
+    # that can be set are run. Keys and values are padded to padded_size.
+    key_dtype = dtype('uint32')
+    segmented_key_dtype = dtype('uint64')
+
+    def __init__(self, ctx, size, group_size, radix_bits=4, value_dtype=dtype('uint32'),
+                 program=None, scan_program=None, pool=None):
+        self.size = size
+        self.group_size = group_size
+        self.pool = pool or BufferPool(ctx)
+        self.sorter = RadixSorter(
+            ctx, self.padded_size, group_size, radix_bits,
+            self.segmented_key_dtype, value_dtype, program, scan_program, self.pool
+        )
+        self._keys_bufs = [None, None]
+        self._allocate()
+
+    def _allocate(self):
+        self._keys_bufs = [
+            self.pool.allocate(self.padded_size * self.segmented_key_dtype.itemsize, buf)
+            for buf in self._keys_bufs
+        ]
+
+    def resize(self, size=None, group_size=None, radix_bits=None):
+        if size is not None:
+            self.size = size
+        if group_size is not None:
+            self.group_size = group_size
+        self.sorter.resize(self.padded_size, group_size, radix_bits)
+        self._allocate()
+
+    @property
+    def program(self):
+        return self.sorter.program
+
+    @property
+    def padded_size(self):
+        return roundUp(self.size, 2 * self.group_size)
+
+    @property
+    def output_index(self):
+        return self.sorter.output_index
+
+    @property
+    def segmented_keys_buf(self):
+        # Sorted (segment, key) pairs from the last sort
+        return self._keys_bufs[self.output_index]
+
+    def passes(self, n_segments):
+        radix_bits = self.sorter.radix_bits
+        key_passes = self.key_dtype.itemsize * 8 // radix_bits
+        # Padding is given segment n_segments
+        segment_passes = ceildiv(n_segments.bit_length(), radix_bits)
+        return list(range(key_passes + segment_passes))
+
+    def sort(self, cq, keys_buf, out_keys_buf, offsets_buf, n_segments,
+             in_values_buf=None, out_values_buf=None, wait_for=None, copy_result=True):
+        # offsets_buf holds n_segments + 1 offsets, the last being size. out_keys_buf may
+        # be None, leaving the result only in segmented_keys_buf.
+        wait_for = wait_for or []
+        segment_keys = self.program.kernels['segment_keys'](
+            cq, (self.padded_size,), None,
+            self._keys_bufs[0], keys_buf, offsets_buf, n_segments, self.size,
+            wait_for=wait_for
+        )
+        calc_sort = self.sorter.sort(
+            cq, *self._keys_bufs, in_values_buf, out_values_buf,
+            wait_for=[segment_keys], copy_result=False, passes=self.passes(n_segments)
+        )
+
+        events = [calc_sort]
+        if out_keys_buf is not None:
+            events.append(self.program.kernels['split_keys'](
+                cq, (self.size,), None,
+                out_keys_buf, self.segmented_keys_buf, wait_for=[calc_sort]
+            ))
+        if (copy_result and self.output_index == 0 and
+            in_values_buf is not None and out_values_buf is not None):
+            events.append(cl.enqueue_copy(
+                cq, out_values_buf, in_values_buf, wait_for=[calc_sort],
+                byte_count=self.padded_size * dtype_sizeof(self.program.value_dtype),
+            ))
+        return cl.enqueue_marker(cq, wait_for=events)
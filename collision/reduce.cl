@@ -1,21 +1,16 @@
 // http://developer.amd.com/resources/articles-whitepapers/opencl-optimization-case-study-simple-reductions/
 
 #define ADD(x, y) ((x) + (y))
+#define OR(x, y) ((x) | (y))
+#define AND(x, y) ((x) & (y))
 
-kernel void bounds1(const global VALDTYPE * const values,
-                    const unsigned long n,
-                    global VALDTYPE (* const group_accs)[ACC_SIZE],
-                    local VALDTYPE (* const scratch)[ACC_SIZE]) {
-    VALDTYPE accumulator[ACC_SIZE] = {
-        {%- for initializer in acc_inits -%} (VALDTYPE)({{initializer}}), {% endfor -%}
-    };
-
-    for (size_t i = get_global_id(0); i < n; i += get_global_size(0)) {
-        {%- for fn in acc_funcs %}
-        accumulator[{{loop.index0}}] = {{ fn }}(accumulator[{{loop.index0}}], values[i]);
-        {%- endfor %}
-    }
+#ifndef ACCDTYPE
+#define ACCDTYPE VALDTYPE
+#endif
 
+// Combines each work-item's accumulator into scratch[0], for a power-of-two local size
+void reduce_local(local ACCDTYPE (* const scratch)[ACC_SIZE],
+                  const ACCDTYPE accumulator[ACC_SIZE]) {
     for (size_t i = 0; i < ACC_SIZE; i++)
         scratch[get_local_id(0)][i] = accumulator[i];
 
@@ -31,28 +26,57 @@ kernel void bounds1(const global VALDTYPE * const values,
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
+}
+
+// Inputs are loaded as x0, x1, ..., then mapped to a value for each accumulator
+kernel void bounds1(const global VALDTYPE * const values,
+                    {%- for input in extra_inputs %}
+                    const global {{ input }} * const values{{ loop.index }},
+                    {%- endfor %}
+                    const unsigned long n,
+                    global ACCDTYPE (* const group_accs)[ACC_SIZE],
+                    local ACCDTYPE (* const scratch)[ACC_SIZE]) {
+    ACCDTYPE accumulator[ACC_SIZE] = {
+        {%- for initializer in acc_inits -%} (ACCDTYPE)({{initializer}}), {% endfor -%}
+    };
+
+    for (size_t i = get_global_id(0); i < n; i += get_global_size(0)) {
+        const VALDTYPE x0 = values[i];
+        {%- for input in extra_inputs %}
+        const {{ input }} x{{ loop.index }} = values{{ loop.index }}[i];
+        {%- endfor %}
+        {%- for fn in acc_funcs %}
+        accumulator[{{loop.index0}}] = {{ fn }}(accumulator[{{loop.index0}}],
+                                                (ACCDTYPE)({{ acc_maps[loop.index0] }}));
+        {%- endfor %}
+    }
+
+    reduce_local(scratch, accumulator);
     if (get_local_id(0) == 0) {
         for (size_t i = 0; i < ACC_SIZE; i++)
             group_accs[get_group_id(0)][i] = scratch[0][i];
     }
 }
 
-kernel void bounds2(global VALDTYPE (* const group_accs)[ACC_SIZE],
-                    global VALDTYPE (* const output)[ACC_SIZE]) {
-    for (size_t o = get_local_size(0) / 2; o > 0; o /= 2) {
-        if (get_local_id(0) < o) {
-            {%- for fn in acc_funcs %}
-            group_accs[get_local_id(0)][{{loop.index0}}] = {{ fn }}(
-                group_accs[get_local_id(0)][{{loop.index0}}],
-                group_accs[get_local_id(0)+o][{{loop.index0}}]
-            );
-            {%- endfor %}
-        }
-        barrier(CLK_GLOBAL_MEM_FENCE);
+// Single group, of any power-of-two size, combining any number of group accumulators
+kernel void bounds2(const global ACCDTYPE (* const group_accs)[ACC_SIZE],
+                    const unsigned int ngroups,
+                    global ACCDTYPE (* const output)[ACC_SIZE],
+                    local ACCDTYPE (* const scratch)[ACC_SIZE]) {
+    ACCDTYPE accumulator[ACC_SIZE] = {
+        {%- for initializer in acc_inits -%} (ACCDTYPE)({{initializer}}), {% endfor -%}
+    };
+
+    for (size_t i = get_local_id(0); i < ngroups; i += get_local_size(0)) {
+        {%- for fn in acc_funcs %}
+        accumulator[{{loop.index0}}] = {{ fn }}(accumulator[{{loop.index0}}],
+                                                group_accs[i][{{loop.index0}}]);
+        {%- endfor %}
     }
 
+    reduce_local(scratch, accumulator);
     if (get_local_id(0) == 0) {
         for (size_t i = 0; i < ACC_SIZE; i++)
-            output[0][i] = group_accs[0][i];
+            output[0][i] = scratch[0][i];
     }
 }
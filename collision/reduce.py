@@ -1,30 +1,67 @@
 from numpy import dtype
 from pathlib import Path
 import pyopencl as cl
-from .misc import Program, dtype_decl, dtype_sizeof, np_float_dtypes
+from .misc import Program, dtype_decl, dtype_sizeof, np_float_dtypes, nextPowerOf2, roundUp
+from .pool import BufferPool
 
 from jinja2 import Environment, PackageLoader
 env = Environment(loader=PackageLoader('collision', ''))
 
 class ReductionProgram(Program):
     kernel_args = {'bounds1': [None, dtype('uint64'), None, None],
-                   'bounds2': [None, None]}
+                   'bounds2': [None, dtype('uint32'), None, None]}
     template = env.get_template('reduce.cl')
+    # (initial value, function) for each accumulator, optionally with a C expression of
+    # the inputs (x0, x1, ...) to accumulate. By default the first input is accumulated.
+    accumulator = None
 
-    def __init__(self, ctx, value_dtype):
+    def __init__(self, ctx, value_dtype, accumulator=None, accumulator_dtype=None,
+                 extra_dtypes=()):
+        # Extra inputs are read from their own buffers, at the same index as values
+        if accumulator is not None:
+            self.accumulator = list(accumulator)
+        if not self.accumulator:
+            raise ValueError("No accumulators given")
         self.value_dtype = dtype(value_dtype)
-        self.acc_dtype = dtype((value_dtype, len(self.accumulator)))
-        acc_inits, acc_funcs = zip(*self.accumulator)
-        src = self.template.render(acc_inits=acc_inits, acc_funcs=acc_funcs)
+        self.extra_dtypes = tuple(map(dtype, extra_dtypes))
+        if accumulator_dtype is None:
+            accumulator_dtype = self.value_dtype
+        self.accumulator_dtype = dtype(accumulator_dtype)
+        self.acc_dtype = dtype((self.accumulator_dtype, len(self.accumulator)))
+
+        if self.accumulator_dtype == self.value_dtype:
+            default_map = "x0"
+        else:
+            default_map = "convert_{}(x0)".format(dtype_decl(self.accumulator_dtype))
+        acc_inits, acc_funcs, acc_maps = [], [], []
+        for initializer, fn, *acc_map in self.accumulator:
+            if len(acc_map) > 1:
+                raise ValueError("Invalid accumulator: {}".format((initializer, fn, *acc_map)))
+            acc_inits.append(initializer)
+            acc_funcs.append(fn)
+            acc_maps.append(acc_map[0] if acc_map else default_map)
+
+        self.kernel_args = dict(
+            self.kernel_args,
+            bounds1=[None] * (1 + len(self.extra_dtypes)) + self.kernel_args['bounds1'][1:]
+        )
+        src = self.template.render(
+            acc_inits=acc_inits, acc_funcs=acc_funcs, acc_maps=acc_maps,
+            extra_inputs=list(map(dtype_decl, self.extra_dtypes))
+        )
         super().__init__(ctx, src, [
             "-DVALDTYPE={}".format(dtype_decl(self.value_dtype)),
+            "-DACCDTYPE={}".format(dtype_decl(self.accumulator_dtype)),
             "-DACC_SIZE={}".format(len(self.accumulator))
         ])
 
 class Reducer:
     program_type = ReductionProgram
+    # When ngroups is chosen automatically. A few groups per compute unit balances the
+    # load, while keeping the single-group second stage short.
+    groups_per_compute_unit = 4
 
-    def __init__(self, ctx, ngroups, group_size, value_dtype, program=None):
+    def __init__(self, ctx, ngroups, group_size, value_dtype, program=None, pool=None):
         if program is None:
             program = self.program_type(ctx, value_dtype)
         else:
@@ -34,43 +71,88 @@ class Reducer:
                 raise ValueError("Reducer and program value dtypes must match")
         self.program = program
 
+        self.pool = pool or BufferPool(ctx)
+
+        if ngroups is None:
+            ngroups = self.default_ngroups(ctx)
+        self.check_size(ngroups, group_size)
         self.ngroups = ngroups
         self.group_size = group_size
 
-        self._group_buf = cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
+        self._group_buf = self.pool.allocate(
             self.ngroups * dtype_sizeof(self.program.acc_dtype)
         )
 
+    @classmethod
+    def default_ngroups(cls, ctx):
+        return cls.groups_per_compute_unit * min(
+            device.max_compute_units for device in ctx.devices
+        )
+
+    @staticmethod
+    def check_size(ngroups, group_size):
+        if ngroups < 1:
+            raise ValueError("Invalid number of groups ({})".format(ngroups))
+        if group_size != nextPowerOf2(group_size):
+            raise ValueError("Group size ({}) must be a power of two".format(group_size))
+
     def resize(self, ngroups=None, group_size=None):
-        ctx = self.program.context
         if ngroups is None:
             ngroups = self.ngroups
         if group_size is None:
             group_size = self.group_size
 
-        old_group_size = self.group_size
+        self.check_size(ngroups, group_size)
         self.ngroups = ngroups
         self.group_size = group_size
 
-        if self.group_size != old_group_size:
-            self._group_buf = cl.Buffer(
-                ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-                self.ngroups * dtype_sizeof(self.program.acc_dtype)
-            )
+        self._group_buf = self.pool.allocate(
+            self.ngroups * dtype_sizeof(self.program.acc_dtype), self._group_buf
+        )
+
+    def launch_groups(self, size):
+        # No more groups than have values to reduce, but at least one to write a result
+        return max(1, min(self.ngroups, roundUp(size, self.group_size) // self.group_size))
+
+    @property
+    def group_buf(self):
+        # An accumulator per group, as combined by reduce_groups
+        return self._group_buf
 
     def reduce(self, cq, size, values_buf, output_buf, wait_for=None):
+        # With extra inputs, values_buf is a sequence of a buffer per input
+        values_bufs = values_buf if isinstance(values_buf, (list, tuple)) else [values_buf]
+        if len(values_bufs) != 1 + len(self.program.extra_dtypes):
+            raise ValueError("Expected {} input buffers, got {}".format(
+                1 + len(self.program.extra_dtypes), len(values_bufs)
+            ))
+
+        ngroups = self.launch_groups(size)
         e = self.program.kernels['bounds1'](
-            cq, (self.ngroups,), (self.group_size,),
-            values_buf, size, self._group_buf,
+            cq, (ngroups,), (self.group_size,),
+            *values_bufs, size, self._group_buf,
             cl.LocalMemory(self.group_size * dtype_sizeof(self.program.acc_dtype)),
             g_times_l=True, wait_for=wait_for
         )
+        return self.reduce_groups(cq, output_buf, wait_for=[e], ngroups=ngroups)
 
-        e = self.program.kernels['bounds2'](
-            cq, (1,), (self.ngroups,),
-            self._group_buf, output_buf,
-            g_times_l=True, wait_for=[e]
+    def reduce_groups(self, cq, output_buf, wait_for=None, ngroups=None):
+        # Combines the first ngroups accumulators of group_buf, by default all of them
+        if ngroups is None:
+            ngroups = self.ngroups
+        # One group, no larger than needed to cover ngroups
+        local_size = min(self.group_size, nextPowerOf2(ngroups))
+        return self.program.kernels['bounds2'](
+            cq, (local_size,), (local_size,),
+            self._group_buf, ngroups, output_buf,
+            cl.LocalMemory(local_size * dtype_sizeof(self.program.acc_dtype)),
+            wait_for=wait_for
         )
 
-        return e
+
+def make_reducer(ctx, ngroups, group_size, accumulator, value_dtype, accumulator_dtype=None,
+                 extra_dtypes=(), pool=None):
+    # A Reducer for any accumulators, as described by ReductionProgram. For example, sums
+    # of uint32 values into uint64, or min and max of coordinates padded by their radii.
+    program = ReductionProgram(ctx, value_dtype, accumulator, accumulator_dtype, extra_dtypes)
+    return Reducer(ctx, ngroups, group_size, value_dtype, program, pool)
@@ -1,36 +1,153 @@
 // Philippe Helluy. A portable implementation of the radix sort algorithm in OpenCL. 2011
 #include "local_scan.cl"
 
+// Only the last group is partial, and is padded with the identity
+void load_group(local SCAN_TYPE * const local_data, const global SCAN_TYPE * const data,
+                const size_t group_start, const size_t group_size, const unsigned int n) {
+#ifndef SCAN_PADDING
+    if (group_start + group_size <= n) {
+        event_t copy = async_work_group_copy(local_data, data + group_start, group_size, 0);
+        wait_group_events(1, &copy);
+        return;
+    }
+#endif
+    for (size_t i = get_local_id(0); i < group_size; i += get_local_size(0))
+        local_data[LOCAL_INDEX(i)] = (group_start + i < n) ? data[group_start + i] : SCAN_IDENTITY;
+}
+
+void store_group(global SCAN_TYPE * const data, const local SCAN_TYPE * const local_data,
+                 const size_t group_start, const size_t group_size, const unsigned int n) {
+#ifndef SCAN_PADDING
+    if (group_start + group_size <= n) {
+        event_t copy = async_work_group_copy(data + group_start, local_data, group_size, 0);
+        wait_group_events(1, &copy);
+        return;
+    }
+#endif
+    for (size_t i = get_local_id(0); i < group_size && group_start + i < n;
+         i += get_local_size(0))
+        data[group_start + i] = local_data[LOCAL_INDEX(i)];
+}
+
 // Cannot pass same buffer to two pointers (at least on nVidia)
-kernel void local_scan(global unsigned int * const data,
-                       local unsigned int * const local_data,
-                       global unsigned int * const block_sums) {
+kernel void local_scan(global SCAN_TYPE * const data,
+                       local SCAN_TYPE * const local_data,
+                       global SCAN_TYPE * const block_sums,
+                       const unsigned int n, const unsigned char inclusive) {
     // # of elements processed by workgroup
     const size_t group_size = get_local_size(0) * 2;
     const size_t group_start = group_size * get_group_id(0);
+    const size_t a = LOCAL_INDEX(get_local_id(0));
+    const size_t b = LOCAL_INDEX(get_local_id(0) + get_local_size(0));
 
-    event_t copy;
-    copy = async_work_group_copy(local_data, data + group_start, group_size, 0);
-    wait_group_events(1, &copy);
+    load_group(local_data, data, group_start, group_size, n);
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    up_sweep(local_data, group_size);
+    // Kept for inclusive scans
+    const SCAN_TYPE value_a = local_data[a];
+    const SCAN_TYPE value_b = local_data[b];
+    barrier(CLK_LOCAL_MEM_FENCE);
 
-    if (get_local_id(0) == 0) {
-        if (block_sums != NULL)
-            block_sums[get_group_id(0)] = local_data[group_size - 1];
-        local_data[group_size - 1] = 0;
+    const SCAN_TYPE total = group_exclusive_scan(local_data, group_size);
+    if (get_local_id(0) == 0 && block_sums != NULL)
+        block_sums[get_group_id(0)] = total;
+
+    if (inclusive) {
+        local_data[a] = SCAN_OP(local_data[a], value_a);
+        local_data[b] = SCAN_OP(local_data[b], value_b);
+        barrier(CLK_LOCAL_MEM_FENCE);
     }
-    barrier(CLK_LOCAL_MEM_FENCE);
 
-    down_sweep(local_data, group_size);
+    store_group(data, local_data, group_start, group_size, n);
+}
 
-    copy = async_work_group_copy(data + group_start, local_data, group_size, 0);
-    wait_group_events(1, &copy);
+kernel void block_scan(global SCAN_TYPE * const data,
+                       const global SCAN_TYPE * const block_sums,
+                       const unsigned int n) {
+    const size_t i = get_global_id(0) * 2;
+    const SCAN_TYPE prefix = block_sums[get_group_id(0)];
+    if (i + 0 < n)
+        data[i + 0] = SCAN_OP(prefix, data[i + 0]);
+    if (i + 1 < n)
+        data[i + 1] = SCAN_OP(prefix, data[i + 1]);
 }
 
-kernel void block_scan(global unsigned int * const data,
-                       const global unsigned int * const block_sums) {
-    data[get_global_id(0) * 2 + 0] += block_sums[get_group_id(0)];
-    data[get_global_id(0) * 2 + 1] += block_sums[get_group_id(0)];
+// Single-pass scan with decoupled look-back (Merrill & Garland, 2016). Partitions are
+// numbered in launch order, so every partition looked back on has started, which is
+// only enough on devices that guarantee forward progress between work-groups.
+#define FLAG_AGGREGATE 1u
+#define FLAG_PREFIX 2u
+
+kernel void single_pass_scan(global SCAN_TYPE * const data,
+                             local SCAN_TYPE * const local_data,
+                             global unsigned int * const status,
+                             global volatile SCAN_TYPE * const aggregates,
+                             global volatile SCAN_TYPE * const prefixes,
+                             const unsigned int n, const unsigned char inclusive) {
+    // status[0] counts partitions, then a flag per partition
+    global unsigned int * const flags = status + 1;
+    local unsigned int partition_idx;
+    local SCAN_TYPE partition_prefix;
+
+    if (get_local_id(0) == 0)
+        partition_idx = atomic_inc(status);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    const unsigned int partition = partition_idx;
+
+    const size_t group_size = get_local_size(0) * 2;
+    const size_t group_start = group_size * partition;
+    const size_t a = LOCAL_INDEX(get_local_id(0));
+    const size_t b = LOCAL_INDEX(get_local_id(0) + get_local_size(0));
+
+    load_group(local_data, data, group_start, group_size, n);
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    const SCAN_TYPE value_a = local_data[a];
+    const SCAN_TYPE value_b = local_data[b];
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    const SCAN_TYPE aggregate = group_exclusive_scan(local_data, group_size);
+
+    if (get_local_id(0) == 0) {
+        // Publish the aggregate first, so successors need not wait for the look-back
+        if (partition == 0)
+            prefixes[partition] = aggregate;
+        else
+            aggregates[partition] = aggregate;
+        mem_fence(CLK_GLOBAL_MEM_FENCE);
+        atomic_xchg(&flags[partition], partition ? FLAG_AGGREGATE : FLAG_PREFIX);
+
+        SCAN_TYPE prefix = SCAN_IDENTITY;
+        for (unsigned int previous = partition; previous > 0; previous--) {
+            unsigned int flag;
+            do {
+                flag = atomic_or(&flags[previous - 1], 0);
+            } while (!flag);
+            mem_fence(CLK_GLOBAL_MEM_FENCE);
+            if (flag & FLAG_PREFIX) {
+                prefix = SCAN_OP(prefixes[previous - 1], prefix);
+                break;
+            }
+            prefix = SCAN_OP(aggregates[previous - 1], prefix);
+        }
+
+        if (partition != 0) {
+            prefixes[partition] = SCAN_OP(prefix, aggregate);
+            mem_fence(CLK_GLOBAL_MEM_FENCE);
+            atomic_xchg(&flags[partition], FLAG_PREFIX);
+        }
+        partition_prefix = prefix;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    const SCAN_TYPE prefix = partition_prefix;
+    local_data[a] = SCAN_OP(prefix, local_data[a]);
+    local_data[b] = SCAN_OP(prefix, local_data[b]);
+    if (inclusive) {
+        local_data[a] = SCAN_OP(local_data[a], value_a);
+        local_data[b] = SCAN_OP(local_data[b], value_b);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    store_group(data, local_data, group_start, group_size, n);
 }
@@ -1,112 +1,184 @@
 from numpy import dtype, zeros
 from pathlib import Path
 import pyopencl as cl
-from itertools import tee, zip_longest
-from .misc import SimpleProgram, roundUp, nextPowerOf2
+from .misc import SimpleProgram, nextPowerOf2, dtype_decl
+from .pool import BufferPool
 
 def ceildiv(a, b):
     return (a + b - 1) // b
 
+# Identity and function per operator, by C type
+scan_identities = {
+    'add': dict.fromkeys(['uint', 'int', 'ulong', 'long', 'float', 'double'], '0'),
+    'min': {'uint': 'UINT_MAX', 'int': 'INT_MAX', 'ulong': 'ULONG_MAX', 'long': 'LONG_MAX',
+            'float': 'INFINITY', 'double': 'INFINITY'},
+    'max': {'uint': '0', 'int': 'INT_MIN', 'ulong': '0', 'long': 'LONG_MIN',
+            'float': '-INFINITY', 'double': '-INFINITY'},
+}
+scan_functions = {'add': 'ADD', 'min': 'min', 'max': 'max'}
+
+# How each group's values are scanned in local memory. 'sweep' is the plain up-sweep and
+# down-sweep, 'padded' spreads their strided accesses over local memory banks, and
+# 'subgroup' uses sub-group scans (which needs cl_khr_subgroups).
+group_scan_options = {'sweep': [], 'padded': ["-DSCAN_PADDING"],
+                      'subgroup': ["-DSCAN_SUBGROUPS"]}
+
+def group_scan_build_options(ctx, group_scan):
+    if group_scan not in group_scan_options:
+        raise ValueError("Invalid group scan: {}".format(group_scan))
+    if group_scan == 'subgroup' and not all(
+            'cl_khr_subgroups' in device.extensions.split() for device in ctx.devices
+    ):
+        raise ValueError("Sub-group scans need the cl_khr_subgroups extension")
+    return group_scan_options[group_scan]
+
+def group_scan_len(n, group_scan):
+    # Values of local memory to scan n values, as LOCAL_LEN in local_scan.cl
+    if group_scan == 'padded':
+        return n + (n >> 5)
+    if group_scan == 'subgroup':
+        return n + n // 2 + 1
+    return n
+
 class PrefixScanProgram(SimpleProgram):
     src = Path(__file__).parent / "scan.cl"
-    kernel_args = {'local_scan': [None, None, None],
-                   'block_scan': [None, None]}
+    kernel_args = {'local_scan': [None, None, None, dtype('uint32'), dtype('uint8')],
+                   'block_scan': [None, None, dtype('uint32')],
+                   'single_pass_scan': [None, None, None, None, None,
+                                        dtype('uint32'), dtype('uint8')]}
+
+    def __init__(self, ctx, value_dtype=dtype('uint32'), operator='add', group_scan='sweep'):
+        self.value_dtype = dtype(value_dtype)
+        self.operator = operator
+        self.group_scan = group_scan
+        if operator not in scan_functions:
+            raise ValueError("Invalid operator: {}".format(operator))
+        try:
+            identity = scan_identities[operator][dtype_decl(self.value_dtype)]
+        except (KeyError, ValueError):
+            raise ValueError("Invalid value dtype: {}".format(self.value_dtype))
+
+        super().__init__(ctx, [
+            "-DSCAN_TYPE={}".format(dtype_decl(self.value_dtype)),
+            "-DSCAN_OP={}".format(scan_functions[operator]),
+            "-DSCAN_IDENTITY={}".format(identity),
+            "-DSUB_GROUP_SCAN=sub_group_scan_exclusive_{}".format(operator),
+            "-DSUB_GROUP_REDUCE=sub_group_reduce_{}".format(operator),
+        ] + group_scan_build_options(ctx, group_scan))
 
 class PrefixScanner:
-    block_sums_dtype = dtype('uint32')
+    # Scans any number of values in-place, padding partial groups with the identity.
+    # single_pass uses one launch with decoupled look-back, which relies on forward
+    # progress between work-groups. Otherwise, groups are scanned level by level.
+    status_dtype = dtype('uint32')
 
-    def __init__(self, ctx, size, group_size, program=None):
+    def __init__(self, ctx, size, group_size, program=None, pool=None, single_pass=False):
         self.check_size(size, group_size)
         self.size = size
         self.group_size = group_size
+        self.single_pass = single_pass
 
         if program is None:
             program = PrefixScanProgram(ctx)
         elif program.context != ctx:
             raise ValueError("Scanner and program context must match")
         self.program = program
+        self.pool = pool or BufferPool(ctx)
 
-        self._block_sums_bufs = [cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            l * self.block_sums_dtype.itemsize
-        ) for l in self.block_lengths]
+        self._block_sums_bufs = []
+        self._status_buf = self._aggregates_buf = self._prefixes_buf = None
+        self._allocate()
 
     @staticmethod
     def check_size(size, group_size):
         if group_size != nextPowerOf2(group_size):
             raise ValueError("Group size ({}) must be a power of two".format(group_size))
-        if size % (group_size * 2):
-            raise ValueError("Size must be multiple of 2 * group_size ({})".format(group_size))
+        if size < 0:
+            raise ValueError("Invalid size ({})".format(size))
 
     def resize(self, size=None, group_size=None):
-        ctx = self.program.context
         if size is None:
             size = self.size
         if group_size is None:
             group_size = self.group_size
-        old_block_lengths = self.block_lengths
 
         self.check_size(size, group_size)
         self.size = size
         self.group_size = group_size
+        self._allocate()
+
+    def _allocate(self):
+        if self.single_pass:
+            self._status_buf = self.pool.allocate(
+                (self.num_partitions + 1) * self.status_dtype.itemsize, self._status_buf
+            )
+            self._aggregates_buf, self._prefixes_buf = (
+                self.pool.allocate(self.num_partitions * self.block_sums_dtype.itemsize, buf)
+                for buf in (self._aggregates_buf, self._prefixes_buf)
+            )
+            return
 
+        for buf in self._block_sums_bufs[len(self.block_lengths):]:
+            self.pool.release(buf)
+        old_bufs = self._block_sums_bufs + [None] * len(self.block_lengths)
         self._block_sums_bufs = [
-            old_buf if new_len == old_len else cl.Buffer(
-            ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.HOST_NO_ACCESS,
-            new_len * self.block_sums_dtype.itemsize
-            ) for new_len, old_len, old_buf in
-            zip_longest(self.block_lengths, old_block_lengths, self._block_sums_bufs)
-            if new_len is not None
+            self.pool.allocate(l * self.block_sums_dtype.itemsize, buf)
+            for l, buf in zip(self.block_lengths, old_bufs)
         ]
 
     @property
-    def block_lengths(self):
-        from math import ceil, log
+    def num_partitions(self):
+        return ceildiv(self.size, self.group_size * 2)
+
+    @property
+    def block_sums_dtype(self):
+        return self.program.value_dtype
 
+    @property
+    def block_lengths(self):
+        # One sum per group at each level, until a single group remains
         block_sizes = []
-        size = roundUp(ceildiv(self.size, self.group_size * 2), self.group_size * 2)
+        size = self.size
         while size > self.group_size * 2:
-            size = roundUp(size, self.group_size * 2)
-            block_sizes.append(size)
             size = ceildiv(size, self.group_size * 2)
-        block_sizes.append(nextPowerOf2(size))
+            block_sizes.append(size)
         return tuple(block_sizes)
 
-    def prefix_sum(self, cq, values_buf, wait_for=None):
-        local_size = self.group_size * 2 * self.block_sums_dtype.itemsize
-        e = self.program.kernels['local_scan'](
-            cq, (self.size // 2,), (self.group_size,),
-            values_buf, cl.LocalMemory(local_size), self._block_sums_bufs[0],
-            wait_for=wait_for
-        )
-
-        bufs = tee(self._block_sums_bufs, 2)
-        next(bufs[1])
-        for size, in_buf, out_buf in zip(self.block_lengths, *bufs):
-            e = self.program.kernels['local_scan'](
-                cq, (size // 2,), (self.group_size,),
-                in_buf, cl.LocalMemory(local_size), out_buf,
-                wait_for=[e]
+    def prefix_sum(self, cq, values_buf, wait_for=None, inclusive=False):
+        # Exclusive unless inclusive is set, using the program's operator
+        if self.size == 0:
+            return cl.enqueue_marker(cq, wait_for=wait_for)
+
+        local_size = (group_scan_len(self.group_size * 2, self.program.group_scan)
+                      * self.block_sums_dtype.itemsize)
+        if self.single_pass:
+            clear_status = cl.enqueue_fill_buffer(
+                cq, self._status_buf, zeros(1, dtype=self.status_dtype),
+                0, (self.num_partitions + 1) * self.status_dtype.itemsize
             )
-
-        local_size = self.block_lengths[-1] * self.block_sums_dtype.itemsize
-        e = self.program.kernels['local_scan'](
-            cq, (1,), (self.block_lengths[-1] // 2,),
-            self._block_sums_bufs[-1], cl.LocalMemory(local_size), None,
-            g_times_l=True, wait_for=[e]
-        )
-
-        bufs = tee(reversed(self._block_sums_bufs), 2)
-        next(bufs[1])
-        for size, in_buf, out_buf in zip(reversed(self.block_lengths[:-1]), *bufs):
-            e = self.program.kernels['block_scan'](
-                cq, (size // 2,), (self.group_size,),
-                out_buf, in_buf,
-                wait_for=[e]
+            return self.program.kernels['single_pass_scan'](
+                cq, (self.num_partitions * self.group_size,), (self.group_size,),
+                values_buf, cl.LocalMemory(local_size), self._status_buf,
+                self._aggregates_buf, self._prefixes_buf, self.size, inclusive,
+                wait_for=[clear_status] + (wait_for or [])
             )
 
-        return self.program.kernels['block_scan'](
-            cq, (self.size // 2,), (self.group_size,),
-            values_buf, self._block_sums_bufs[0],
-            wait_for=[e]
-        )
+        lengths = (self.size,) + self.block_lengths
+        bufs = [values_buf] + self._block_sums_bufs
+        e = wait_for
+        for level, (length, buf) in enumerate(zip(lengths, bufs)):
+            block_sums_buf = bufs[level + 1] if level + 1 < len(bufs) else None
+            e = [self.program.kernels['local_scan'](
+                cq, (ceildiv(length, self.group_size * 2) * self.group_size,),
+                (self.group_size,),
+                buf, cl.LocalMemory(local_size), block_sums_buf, length,
+                inclusive and level == 0, wait_for=e
+            )]
+
+        for length, buf, block_sums_buf in reversed(list(zip(lengths, bufs, bufs[1:]))):
+            e = [self.program.kernels['block_scan'](
+                cq, (ceildiv(length, self.group_size * 2) * self.group_size,),
+                (self.group_size,),
+                buf, block_sums_buf, length, wait_for=e
+            )]
+        return e[0]
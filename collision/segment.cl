@@ -0,0 +1,14 @@
+// Segment of element i, where segment s spans [offsets[s], offsets[s+1]) and
+// offsets[n_segments] is the total. Empty segments are skipped.
+unsigned int findSegment(const global unsigned int * const offsets,
+                         const unsigned int n_segments, const unsigned int i) {
+    unsigned int lo = 0, hi = n_segments;
+    while (hi - lo > 1) {
+        const unsigned int mid = lo + (hi - lo) / 2;
+        if (offsets[mid] <= i)
+            lo = mid;
+        else
+            hi = mid;
+    }
+    return lo;
+}
@@ -15,9 +15,12 @@ def reduce(cq, reducer, *args):
 
 
 # Use size large enough that t > 100*μs
-@pytest.mark.parametrize("size, ngroups,group_size,rounds", [
-    (1536000, 64, 128, 800),
-    (3072000, 64, 128, 400),
+@pytest.mark.parametrize("ngroups", [None, 24, 64, 1000], ids=lambda n: "ngroups={}".format(n))
+@pytest.mark.parametrize("size,group_size,rounds", [
+    (307200, 128, 800),
+    (1536000, 128, 800),
+    (3072000, 128, 400),
+    (30720000, 128, 40),
 ])
 def test_reducer(cl_env, reduce_program, size, ngroups, group_size, rounds, benchmark):
     ctx, cq = cl_env
@@ -39,3 +42,74 @@ def test_reducer(cl_env, reduce_program, size, ngroups, group_size, rounds, benc
         wait_for=[], is_blocking=True
     )
     np.testing.assert_equal(output_map[..., :3], expected[..., :3])
+
+
+def reduce_each(cq, reducers, size, values_bufs, output_bufs):
+    cl.wait_for_events([reducer.reduce(cq, size, values_buf, output_buf)
+                        for reducer, values_buf, output_buf
+                        in zip(reducers, values_bufs, output_bufs)])
+
+
+@pytest.mark.parametrize("fused", [False, True], ids=["separate", "fused"])
+@pytest.mark.parametrize("size,ngroups,group_size,rounds", [(3072000, None, 128, 100)])
+def test_statistics(cl_env, size, ngroups, group_size, rounds, fused, benchmark):
+    from collision.reduce import make_reducer
+    ctx, cq = cl_env
+
+    # Bounds, mass-weighted position and total mass
+    coords = np.random.uniform(0.0, 1.0, size=(size, 4)).astype('float32')
+    masses = np.random.uniform(1.0, 2.0, size=size).astype('float32')
+    coords_buf, masses_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [coords, masses]
+    )
+    accumulators = [[("INFINITY", "min"), ("-INFINITY", "max")],
+                    [("0", "ADD", "x0 * x1")], [("0", "ADD", "x1")]]
+
+    if fused:
+        reducers = [make_reducer(ctx, ngroups, group_size, sum(accumulators, []),
+                                 ('float32', 4), extra_dtypes=['float32'])]
+    else:
+        reducers = [make_reducer(ctx, ngroups, group_size, accumulator,
+                                 ('float32', 4), extra_dtypes=['float32'])
+                    for accumulator in accumulators]
+    output_bufs = [cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 4 * coords[0].nbytes)
+                   for _ in reducers]
+    values_bufs = [(coords_buf, masses_buf)] * len(reducers)
+
+    benchmark.pedantic(reduce_each, (cq, reducers, size, values_bufs, output_bufs),
+                       rounds=rounds, warmup_rounds=10)
+
+
+# Separate runs two passes for the sphere bounds, then one for the largest radius
+@pytest.mark.parametrize("variant", ["points", "spheres", "separate"])
+@pytest.mark.parametrize("size,ngroups,group_size,rounds", [(3072000, None, 128, 100)])
+def test_sphere_bounds(cl_env, size, ngroups, group_size, rounds, variant, benchmark):
+    from collision.bounds import SphereBounds
+    from collision.reduce import make_reducer
+    ctx, cq = cl_env
+
+    coords = np.random.uniform(0.0, 1.0, size=(size, 4)).astype('float32')
+    radii = np.random.uniform(0.0, 0.01, size=size).astype('float32')
+    coords_buf, radii_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [coords, radii]
+    )
+
+    if variant == 'spheres':
+        reducers = [SphereBounds(ctx, ngroups, group_size)]
+        values_bufs = [(coords_buf, radii_buf)]
+    elif variant == 'separate':
+        accumulators = [[("INFINITY", "min", "x0 - x1")], [("-INFINITY", "max", "x0 + x1")],
+                        [("0", "max", "x1")]]
+        reducers = [make_reducer(ctx, ngroups, group_size, accumulator,
+                                 ('float32', 3), extra_dtypes=['float32'])
+                    for accumulator in accumulators]
+        values_bufs = [(coords_buf, radii_buf)] * len(reducers)
+    else:
+        reducers = [Bounds(ctx, ngroups, group_size)]
+        values_bufs = [coords_buf]
+    output_bufs = [cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 3 * coords[0].nbytes)
+                   for _ in reducers]
+    benchmark.pedantic(reduce_each, (cq, reducers, size, values_bufs, output_bufs),
+                       rounds=rounds, warmup_rounds=10)
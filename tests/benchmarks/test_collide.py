@@ -1,7 +1,7 @@
 import numpy as np
 import pyopencl as cl
 import pytest
-from collision.collision import CollisionProgram, Collider
+from collision.collision import CollisionProgram, Collider, BatchedCollider
 
 
 @pytest.fixture(scope='module')
@@ -21,12 +21,14 @@ def collide(cq, collider, *args):
 
 
 # Use size large enough that t > 100*μs
+@pytest.mark.parametrize("stackless", [False, True], ids=["stack", "ropes"])
+@pytest.mark.parametrize("ordered", [False, True], ids=["atomic", "ordered"])
 @pytest.mark.parametrize("npoints,rmax,ngroups,group_size,rounds", [
     (307200, 0.06, 8, 128, 10),
     (307201, 0.06, 8, 128, 10), # Uneven npoints
 ])
 def test_collide(cl_env, collision_programs, npoints, rmax,
-                 ngroups, group_size, rounds, benchmark):
+                 ngroups, group_size, rounds, ordered, stackless, benchmark):
     ctx, cq = cl_env
 
     coords = np.random.uniform(-1.0, 1.0, (npoints, 3)).astype(dtype='float32')
@@ -48,9 +50,168 @@ def test_collide(cl_env, collision_programs, npoints, rmax,
                                  np.dtype('int32').itemsize)
 
 
-    collider = Collider(ctx, len(coords), ngroups, group_size, coord_dtype=coords.dtype)
+    collider = Collider(ctx, len(coords), ngroups, group_size, coord_dtype=coords.dtype,
+                        ordered=ordered, stackless=stackless)
     benchmark.pedantic(collide, (cq, collider, coords_buf, radii_buf,
                                  n_collisions_buf, None, 0),
                        rounds=rounds, warmup_rounds=10)
 
     # No expected, as full set is too large
+
+
+def rebuild_traverse(cq, collider, coords_buf, radii_buf, *args):
+    e = collider.build(cq, coords_buf, radii_buf)
+    cl.wait_for_events([collider.traverse(cq, *args, wait_for=[e])])
+
+
+def rebuild_previous_traverse(cq, collider, coords_buf, radii_buf, *args):
+    # Reuses the last frame's scene bounds, skipping a pass over the coordinates
+    e = collider.build(cq, coords_buf, radii_buf, scene_bounds='previous')
+    cl.wait_for_events([collider.traverse(cq, *args, wait_for=[e])])
+
+
+def refit_traverse(cq, collider, coords_buf, radii_buf, *args):
+    e = collider.refit(cq, coords_buf, radii_buf)
+    cl.wait_for_events([collider.traverse(cq, *args, wait_for=[e])])
+
+
+@pytest.mark.parametrize("update", [rebuild_traverse, rebuild_previous_traverse,
+                                    refit_traverse],
+                         ids=["rebuild", "rebuild_previous", "refit"])
+@pytest.mark.parametrize("npoints,rmax,ngroups,group_size,rounds", [
+    (307200, 0.06, 8, 128, 10),
+])
+def test_update(cl_env, collision_programs, update, npoints, rmax,
+                ngroups, group_size, rounds, benchmark):
+    ctx, cq = cl_env
+
+    coords = np.random.uniform(-1.0, 1.0, (npoints, 3)).astype(dtype='float32')
+    radii = np.random.uniform(0.1*rmax, rmax, (len(coords), 1)).astype(coords.dtype)
+    # Next frame, particles have moved slightly
+    moved = coords + np.random.normal(0.0, 0.1*rmax, coords.shape).astype(coords.dtype)
+
+    coords_bufs = []
+    for c in [coords, moved]:
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY, len(c) * 4 * c.dtype.itemsize
+        )
+        (coords_map, _) = cl.enqueue_map_buffer(
+            cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, (len(c), 4), c.dtype,
+            is_blocking=True
+        )
+        coords_map[..., :3] = c
+        del coords_map
+        coords_bufs.append(coords_buf)
+    radii_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                          hostbuf=radii)
+    n_collisions_buf = cl.Buffer(ctx, cl.mem_flags.HOST_READ_ONLY | cl.mem_flags.READ_WRITE,
+                                 np.dtype('int32').itemsize)
+
+    collider = Collider(ctx, len(coords), ngroups, group_size, coord_dtype=coords.dtype)
+    cl.wait_for_events([collider.build(cq, coords_bufs[0], radii_buf)])
+    benchmark.pedantic(update, (cq, collider, coords_bufs[1], radii_buf,
+                                n_collisions_buf, None, 0),
+                       rounds=rounds, warmup_rounds=10)
+
+
+def build(cq, collider, coords_buf, radii_buf, *args):
+    cl.wait_for_events([collider.build(cq, coords_buf, radii_buf)])
+
+
+def traverse(cq, collider, coords_buf, radii_buf, *args):
+    cl.wait_for_events([collider.traverse(cq, *args)])
+
+
+# Treelet optimisation trades build time for traversal time
+@pytest.mark.parametrize("phase", [build, traverse], ids=["build", "traverse"])
+@pytest.mark.parametrize("optimize_treelets", [False, True], ids=["lbvh", "treelets"])
+@pytest.mark.parametrize("clustered", [False, True], ids=["uniform", "clustered"])
+@pytest.mark.parametrize("npoints,rmax,ngroups,group_size,rounds", [
+    (307200, 0.06, 8, 128, 10),
+])
+def test_optimize_treelets(cl_env, collision_programs, clustered, optimize_treelets, phase,
+                           npoints, rmax, ngroups, group_size, rounds, benchmark):
+    ctx, cq = cl_env
+
+    if clustered:
+        # Dense clusters, with radii scaled to give a similar number of collisions
+        centres = np.random.uniform(-1.0, 1.0, (32, 3))
+        coords = centres[np.random.randint(len(centres), size=npoints)]
+        coords += np.random.normal(0.0, 0.05, coords.shape)
+        coords = coords.astype('float32')
+        rmax *= 0.3
+    else:
+        coords = np.random.uniform(-1.0, 1.0, (npoints, 3)).astype(dtype='float32')
+    radii = np.random.uniform(0.1*rmax, rmax, (len(coords), 1)).astype(coords.dtype)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coords.dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coords.dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    radii_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                          hostbuf=radii)
+    n_collisions_buf = cl.Buffer(ctx, cl.mem_flags.HOST_READ_ONLY | cl.mem_flags.READ_WRITE,
+                                 np.dtype('int32').itemsize)
+
+    program, sorter_programs, reducer_program = collision_programs
+    collider = Collider(ctx, len(coords), ngroups, group_size, coord_dtype=coords.dtype,
+                        program=program, sorter_programs=sorter_programs,
+                        reducer_program=reducer_program, optimize_treelets=optimize_treelets)
+    cl.wait_for_events([collider.build(cq, coords_buf, radii_buf)])
+    benchmark.extra_info['tree_cost'] = collider.tree_cost(cq)
+    benchmark.pedantic(phase, (cq, collider, coords_buf, radii_buf,
+                               n_collisions_buf, None, 0),
+                       rounds=rounds, warmup_rounds=2)
+
+
+def collide_each(cq, colliders, coords_bufs, radii_bufs, *args):
+    cl.wait_for_events([collider.get_collisions(cq, coords_buf, radii_buf, *args)
+                        for collider, coords_buf, radii_buf
+                        in zip(colliders, coords_bufs, radii_bufs)])
+
+
+@pytest.mark.parametrize("batched", [False, True], ids=["loop", "batched"])
+@pytest.mark.parametrize("nscenes,npoints,rmax,ngroups,group_size,rounds", [
+    (256, 128, 0.06, 8, 32, 10),
+])
+def test_collide_scenes(cl_env, collision_programs, nscenes, npoints, rmax,
+                        ngroups, group_size, rounds, batched, benchmark):
+    ctx, cq = cl_env
+
+    size = nscenes * npoints
+    coords = np.random.uniform(-1.0, 1.0, (size, 4)).astype(dtype='float32')
+    radii = np.random.uniform(0.1*rmax, rmax, size).astype(coords.dtype)
+    n_collisions_buf = cl.Buffer(ctx, cl.mem_flags.HOST_READ_ONLY | cl.mem_flags.READ_WRITE,
+                                 np.dtype('int32').itemsize)
+
+    if batched:
+        offsets = np.arange(0, size + 1, npoints, dtype='uint32')
+        coords_buf, radii_buf, offsets_buf = (
+            cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+            for a in [coords, radii, offsets]
+        )
+        collider = BatchedCollider(ctx, size, ngroups, group_size)
+        benchmark.pedantic(collide, (cq, collider, coords_buf, radii_buf, offsets_buf,
+                                     nscenes, n_collisions_buf, None, 0),
+                           rounds=rounds, warmup_rounds=2)
+    else:
+        program, sorter_programs, reducer_program = collision_programs
+        colliders = [Collider(ctx, npoints, ngroups, group_size, program=program,
+                              sorter_programs=sorter_programs,
+                              reducer_program=reducer_program)
+                     for _ in range(nscenes)]
+        coords_bufs, radii_bufs = (
+            [cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                       hostbuf=a[i:i+npoints]) for i in range(0, size, npoints)]
+            for a in [coords, radii]
+        )
+        benchmark.pedantic(collide_each, (cq, colliders, coords_bufs, radii_bufs,
+                                          n_collisions_buf, None, 0),
+                           rounds=rounds, warmup_rounds=2)
@@ -3,7 +3,7 @@ import pyopencl as cl
 import pytest
 from inspect import signature
 from functools import partial
-from collision.radix import RadixProgram, RadixSorter
+from collision.radix import RadixProgram, RadixSorter, OnesweepSorter
 
 from .test_scan import scan_program
 
@@ -19,12 +19,16 @@ def pytest_generate_tests(metafunc):
         ]), ids=str, scope='module')
     elif 'value_dtype' in metafunc.fixturenames:
         metafunc.parametrize("value_dtype", [np.dtype('uint32')], scope='module')
+    if 'group_scan' in params:
+        metafunc.parametrize("group_scan", ['sweep', 'padded'], scope='module')
+    elif 'group_scan' in metafunc.fixturenames:
+        metafunc.parametrize("group_scan", ['sweep'], scope='module')
 
 
 @pytest.fixture(scope='module')
-def radix_program(cl_env, key_dtype, value_dtype):
+def radix_program(cl_env, key_dtype, value_dtype, group_scan):
     ctx, cq = cl_env
-    return RadixProgram(ctx, key_dtype, value_dtype)
+    return RadixProgram(ctx, key_dtype, value_dtype, group_scan=group_scan)
 
 
 def radix_sort_setup(cq, bufs, values):
@@ -48,18 +52,24 @@ def radix_sort(cq, sorter, *args):
     cl.wait_for_events([sorter.sort(cq, *args)])
 
 
+def make_sorter(onesweep, ctx, size, group_size, radix_program, scan_program, **kwargs):
+    if onesweep:
+        return OnesweepSorter(ctx, size, group_size, program=radix_program, **kwargs)
+    return RadixSorter(ctx, size, group_size, program=radix_program,
+                       scan_program=scan_program, **kwargs)
+
+
+@pytest.mark.parametrize("onesweep", [False, True], ids=["radix", "onesweep"])
 @pytest.mark.parametrize("size,gen,group_size,rounds", [
     (307200, partial(np.random.randint, 0, 1000), 128, 100),
     (307200, partial(np.random.randint, 0, 307200), 128, 100),
     (307200, np.arange, 128, 100),
 ])
-def test_radix_sort(cl_env, radix_program, scan_program, key_dtype,
-                    size, gen, group_size, rounds, benchmark):
+def test_radix_sort(cl_env, radix_program, scan_program, key_dtype, group_scan,
+                    size, gen, group_size, rounds, onesweep, benchmark):
     ctx, cq = cl_env
-    sorter = RadixSorter(
-        ctx, size, group_size, key_dtype=key_dtype,
-        program=radix_program, scan_program=scan_program
-    )
+    sorter = make_sorter(onesweep, ctx, size, group_size, radix_program, scan_program,
+                         key_dtype=key_dtype)
 
     keys = gen(size, dtype=key_dtype)
     expected = np.sort(keys)
@@ -81,18 +91,17 @@ def test_radix_sort(cl_env, radix_program, scan_program, key_dtype,
     np.testing.assert_equal(out_map, expected)
 
 
+@pytest.mark.parametrize("onesweep", [False, True], ids=["radix", "onesweep"])
 @pytest.mark.parametrize("size,gen,group_size,rounds", [
     (307200, partial(np.random.randint, 0, 1000), 128, 100),
     (307200, partial(np.random.randint, 0, 307200), 128, 100),
     (307200, np.arange, 128, 100),
 ])
 def test_sort_values(cl_env, radix_program, scan_program, key_dtype, value_dtype,
-                     size, gen, group_size, rounds, benchmark):
+                     size, gen, group_size, rounds, onesweep, benchmark):
     ctx, cq = cl_env
-    sorter = RadixSorter(
-        ctx, size, group_size, key_dtype=key_dtype, value_dtype=value_dtype,
-        program=radix_program, scan_program=scan_program
-    )
+    sorter = make_sorter(onesweep, ctx, size, group_size, radix_program, scan_program,
+                         key_dtype=key_dtype, value_dtype=value_dtype)
 
     keys = gen(size, dtype=key_dtype)
     values = np.random.uniform(-1000, 1000, size=(size,) + value_dtype.shape)
@@ -137,3 +146,32 @@ def test_sort_values(cl_env, radix_program, scan_program, key_dtype, value_dtype
     else:
         out_values = out_values_map
     np.testing.assert_equal(out_values, expected_values)
+
+
+@pytest.mark.parametrize("skip_constant", [False, True], ids=["all", "skip"])
+@pytest.mark.parametrize("size,gen,group_size,rounds", [
+    (307200, partial(np.random.randint, 0, 1000), 128, 100),
+    (307200, partial(np.random.randint, 0, 2 ** 30), 128, 100),
+])
+def test_skip_constant(cl_env, radix_program, scan_program,
+                       size, gen, group_size, rounds, skip_constant, benchmark):
+    ctx, cq = cl_env
+    sorter = RadixSorter(ctx, size, group_size, program=radix_program,
+                         scan_program=scan_program, skip_constant=skip_constant)
+
+    keys = gen(size, dtype='uint32')
+    expected = np.sort(keys)
+
+    keys_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY, keys.nbytes)
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, keys.nbytes)
+
+    benchmark.pedantic(radix_sort, (cq, sorter, keys_buf, out_buf),
+                       setup=partial(radix_sort_setup, cq, [keys_buf], [keys]),
+                       rounds=rounds, warmup_rounds=10)
+
+    (out_map, _) = cl.enqueue_map_buffer(
+        cq, out_buf, cl.map_flags.READ,
+        0, keys.shape, keys.dtype,
+        wait_for=[], is_blocking=True
+    )
+    np.testing.assert_equal(out_map, expected)
@@ -1,14 +1,23 @@
 import numpy as np
 import pyopencl as cl
 import pytest
+from inspect import signature
 from functools import partial
 from collision.radix import PrefixScanProgram, PrefixScanner
 
 
+def pytest_generate_tests(metafunc):
+    params = signature(metafunc.function).parameters
+    if 'group_scan' in params:
+        metafunc.parametrize("group_scan", ['sweep', 'padded'], scope='module')
+    elif 'group_scan' in metafunc.fixturenames:
+        metafunc.parametrize("group_scan", ['sweep'], scope='module')
+
+
 @pytest.fixture(scope='module')
-def scan_program(cl_env):
+def scan_program(cl_env, group_scan):
     ctx, cq = cl_env
-    return PrefixScanProgram(ctx)
+    return PrefixScanProgram(ctx, group_scan=group_scan)
 
 
 def prefix_sum_setup(cq, values_buf, values):
@@ -26,23 +35,29 @@ def prefix_sum(cq, scanner, values_buf):
 
 
 # Use size large enough that t > 100*μs
+@pytest.mark.parametrize("single_pass", [False, True], ids=["levels", "single_pass"])
 @pytest.mark.parametrize("size,group_size,rounds", [
     (307200, 128, 4000),
     (1536000, 128, 800),
     (3072000, 128, 400),
+    (2 ** 20, 128, 400),
+    (10 * 2 ** 20, 128, 40),
+    (100 * 2 ** 20, 128, 4),
 ])
-def test_scanner(cl_env, scan_program, size, group_size, rounds, benchmark):
+def test_scanner(cl_env, scan_program, group_scan, size, group_size, rounds, single_pass,
+                 benchmark):
     ctx, cq = cl_env
-    scanner = PrefixScanner(ctx, size, group_size, program=scan_program)
+    scanner = PrefixScanner(ctx, size, group_size, program=scan_program,
+                            single_pass=single_pass)
 
     values = np.random.randint(0, 128, size=size, dtype='uint32')
-    expected = np.cumsum(values)
+    expected = np.cumsum(values, dtype=values.dtype)
 
     values_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, values.nbytes)
 
     calc_scan = benchmark.pedantic(prefix_sum, (cq, scanner, values_buf),
                                    setup=partial(prefix_sum_setup, cq, values_buf, values),
-                                   rounds=rounds, warmup_rounds=10)
+                                   rounds=rounds, warmup_rounds=min(rounds, 10))
 
     (values_map, _) = cl.enqueue_map_buffer(
         cq, values_buf, cl.map_flags.READ,
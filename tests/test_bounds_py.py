@@ -46,7 +46,9 @@ def test_negative_bounds(cl_env, program, coord_dtype):
         expected = expected[..., :3]
     np.testing.assert_equal(out_buf, expected)
 
-@pytest.mark.parametrize("size,ngroups,group_size", [(24,2,4), (100, 4, 8)])
+@pytest.mark.parametrize("size,ngroups,group_size", [
+    (24,2,4), (100, 4, 8), (100, 5, 8), (1000, 3, 4), (1000, 37, 16), (1000, None, 8)
+])
 def test_bounds(cl_env, program, coord_dtype, size, ngroups, group_size):
     ctx, cq = cl_env
 
@@ -79,7 +81,9 @@ def test_bounds(cl_env, program, coord_dtype, size, ngroups, group_size):
         expected = expected[..., :3]
     np.testing.assert_equal(out_buf, expected)
 
-@pytest.mark.parametrize("size,old_shape,new_shape", [(100,(2,4),(4, 8))])
+@pytest.mark.parametrize("size,old_shape,new_shape", [
+    (100,(2,4),(4, 8)), (100, (4, 8), (7, 4)), (100, (2, 8), (13, None))
+])
 def test_bounds_resized(cl_env, program, coord_dtype, size, old_shape, new_shape):
     ctx, cq = cl_env
 
@@ -146,3 +150,49 @@ def test_auto_program(cl_env, size, ngroups, group_size, coord_dtype):
         out_buf = out_buf[..., :3]
         expected = expected[..., :3]
     np.testing.assert_equal(out_buf, expected)
+
+@pytest.mark.parametrize("ngroups,group_size", [(0, 4), (4, 6)])
+def test_bounds_errs(cl_env, program, coord_dtype, ngroups, group_size):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        Bounds(ctx, ngroups, group_size, coord_dtype, program)
+    reducer = Bounds(ctx, 4, 4, coord_dtype, program)
+    with pytest.raises(ValueError):
+        reducer.resize(ngroups, group_size)
+
+
+def test_default_ngroups(cl_env, program, coord_dtype):
+    ctx, cq = cl_env
+    reducer = Bounds(ctx, None, 8, coord_dtype, program)
+    compute_units = min(device.max_compute_units for device in ctx.devices)
+    assert reducer.ngroups == Bounds.groups_per_compute_unit * compute_units
+
+
+@pytest.mark.parametrize("size,ngroups,group_size", [(24, 2, 4), (1000, 5, 16)])
+def test_sphere_bounds(cl_env, coord_dtype, size, ngroups, group_size):
+    ctx, cq = cl_env
+    reducer = SphereBounds(ctx, ngroups, group_size, coord_dtype)
+    if coord_dtype.shape == (3,):
+        value_dtype = dtype((coord_dtype.base, 4))
+    else:
+        value_dtype = coord_dtype
+    values = np.random.normal(size=(size,) + value_dtype.shape).astype(value_dtype.base)
+    radii = np.random.uniform(0, 2, size=size).astype(value_dtype.base)
+
+    values_buf, radii_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [values, radii]
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 3 * dtype_sizeof(coord_dtype))
+
+    calc_reduce = reducer.reduce(cq, size, (values_buf, radii_buf), out_buf)
+    out = np.empty((3,) + value_dtype.shape, dtype=value_dtype.base)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[calc_reduce])
+
+    radii = radii.reshape((-1,) + (1,) * len(value_dtype.shape))
+    expected = np.stack([(values - radii).min(axis=0), (values + radii).max(axis=0),
+                         np.full(value_dtype.shape, radii.max())])
+    if coord_dtype.shape == (3,):
+        out = out[..., :3]
+        expected = expected[..., :3]
+    np.testing.assert_equal(out, expected)
@@ -0,0 +1,98 @@
+import numpy as np
+import pyopencl as cl
+import pytest
+from collision.cache import *
+
+src = """
+#include "value.cl"
+kernel void fill(global unsigned int * const out) {
+    out[get_global_id(0)] = VALUE;
+}
+"""
+
+@pytest.fixture
+def include_dir(tmp_path):
+    path = tmp_path / "include"
+    path.mkdir()
+    (path / "value.cl").write_text("#define VALUE 42\n")
+    return path
+
+
+def run_fill(ctx, cq, program):
+    out = np.zeros(4, dtype='uint32')
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, out.nbytes)
+    e = program.fill(cq, out.shape, None, out_buf)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[e])
+    return out
+
+
+def test_resolve_includes(include_dir):
+    (include_dir / "nested.cl").write_text('#include "value.cl"\n')
+    includes = resolve_includes('#include "nested.cl"\n#include <stdio.h>\n', [include_dir])
+    assert set(includes) == {include_dir / "nested.cl", include_dir / "value.cl"}
+
+
+def test_key(cl_env, tmp_path, include_dir):
+    ctx, cq = cl_env
+    device, *_ = ctx.devices
+    cache = ProgramCache(tmp_path / "cache")
+
+    key = cache.key(src, "", [include_dir], device)
+    assert key == cache.key(src, "", [include_dir], device)
+    assert key != cache.key(src + "\n", "", [include_dir], device)
+    assert key != cache.key(src, "-DFOO", [include_dir], device)
+
+    (include_dir / "value.cl").write_text("#define VALUE 43\n")
+    assert key != cache.key(src, "", [include_dir], device)
+
+
+def test_build(cl_env, monkeypatch, tmp_path, include_dir):
+    ctx, cq = cl_env
+    cache = ProgramCache(tmp_path / "cache")
+    options = "-I {}".format(include_dir)
+
+    program = cache.build(ctx, src, options, [include_dir])
+    np.testing.assert_equal(run_fill(ctx, cq, program), 42)
+    entries = list(cache.path.iterdir())
+    assert len(entries) == len(ctx.devices)
+
+    def store(*args):
+        raise AssertionError("Program was rebuilt from source")
+    monkeypatch.setattr(cache, "store", store)
+    program = cache.build(ctx, src, options, [include_dir])
+    np.testing.assert_equal(run_fill(ctx, cq, program), 42)
+
+
+def test_corrupt(cl_env, tmp_path, include_dir):
+    ctx, cq = cl_env
+    cache = ProgramCache(tmp_path / "cache")
+    options = "-I {}".format(include_dir)
+
+    cache.build(ctx, src, options, [include_dir])
+    for entry in cache.path.iterdir():
+        entry.write_bytes(b"garbage")
+    program = cache.build(ctx, src, options, [include_dir])
+    np.testing.assert_equal(run_fill(ctx, cq, program), 42)
+
+
+def test_evict(tmp_path):
+    cache = ProgramCache(tmp_path / "cache", max_size=100)
+    cache.store("a", bytes(60))
+    cache.store("b", bytes(60))
+    assert cache.load("a") is None
+    assert cache.load("b") == bytes(60)
+
+    cache.store("c", bytes(30))
+    assert cache.load("b") == bytes(60)
+    assert cache.load("c") == bytes(30)
+
+
+def test_default(monkeypatch, tmp_path):
+    monkeypatch.setenv("COLLISION_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("COLLISION_CACHE_SIZE", "1024")
+    cache = ProgramCache.default()
+    assert cache.path == tmp_path
+    assert cache.max_size == 1024
+
+    monkeypatch.setenv("COLLISION_NO_CACHE", "1")
+    assert ProgramCache.default() is None
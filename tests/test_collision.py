@@ -14,6 +14,8 @@ kernel_args = {'generateBVH': [None, None, np.dtype('uint32')],
                'leafBounds': [None, None, None, None, np.dtype('uint32')],
                'internalBounds': [None, None, None, np.dtype('uint32')],
                'calculateCodes': [None, None, None, np.dtype('uint32')],
+               'surfaceAreas': [None, None, np.dtype('uint32')],
+               'calculateRopes': [None, None, np.dtype('uint32')],
                'traverse': [None, None, np.dtype('uint32'),
                             None, None, np.dtype('uint32')],}
 
@@ -27,15 +29,38 @@ def pytest_generate_tests(metafunc):
         metafunc.parametrize(
             "coord_dtype", map(np.dtype, ['float32']), scope='module'
         )
+    if 'code_dtype' in params:
+        metafunc.parametrize(
+            "code_dtype", map(np.dtype, ['uint32', 'uint64']), scope='module'
+        )
+    elif 'code_dtype' in metafunc.fixturenames:
+        metafunc.parametrize(
+            "code_dtype", map(np.dtype, ['uint32']), scope='module'
+        )
+
+
+def morton(coords, coord_range, code_dtype):
+    bits = code_dtype.itemsize * 8 // 3
+    scale = (1 << bits) - 1
+    pos = (coords - coord_range[0]) / (coord_range[1] - coord_range[0])
+    pos = np.clip(pos * scale, 0, scale).astype(code_dtype)
+
+    codes = np.zeros(len(coords), dtype=code_dtype)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((pos[:, axis] >> bit) & 1) << (3 * bit + 2 - axis)
+    return codes
 
 
 @pytest.fixture(scope='module')
-def kernels(cl_env, coord_dtype):
+def kernels(cl_env, coord_dtype, code_dtype):
     ctx, cq = cl_env
 
-    buildopts = ["-DDTYPE={}".format(dtype_decl(coord_dtype))]
-
     src = Path(__file__).parent / ".." / "collision"/ "collision.cl"
+    buildopts = ["-DDTYPE={}".format(dtype_decl(coord_dtype)),
+                 "-DCODE_BITS={}".format(code_dtype.itemsize * 8),
+                 "-I {}".format(src.parent)]
+
     with src.open("r") as f:
         program = cl.Program(ctx, f.read()).build(buildopts)
         kernels = {name: getattr(program, name) for name in kernel_args}
@@ -75,12 +100,12 @@ def test_fill_internal(cl_env, kernels):
     np.testing.assert_equal(nodes_map['right_edge'], np.arange(n))
 
 
-def test_generate_bvh(cl_env, kernels):
+def test_generate_bvh(cl_env, kernels, code_dtype):
     ctx, cq = cl_env
 
     # From Figure 3
     codes = np.array([0b00001, 0b00010, 0b00100, 0b00101,
-                      0b10011, 0b11000, 0b11001, 0b11110], dtype='uint32')
+                      0b10011, 0b11000, 0b11001, 0b11110], dtype=code_dtype)
     ids = np.arange(len(codes), dtype='uint32')
     n_nodes = len(codes) * 2 - 1
 
@@ -128,12 +153,60 @@ def test_generate_bvh(cl_env, kernels):
     np.testing.assert_equal(nodes_map['data'][leaf:, 0], np.arange(len(codes)))
 
 
-def test_generate_odd_bvh(cl_env, kernels):
+def test_ropes(cl_env, kernels):
+    ctx, cq = cl_env
+
+    # From Figure 3
+    codes = np.array([0b00001, 0b00010, 0b00100, 0b00101,
+                      0b10011, 0b11000, 0b11001, 0b11110], dtype='uint32')
+    ids = np.arange(len(codes), dtype='uint32')
+    n_nodes = len(codes) * 2 - 1
+
+    codes_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=codes
+    )
+    nodes_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, n_nodes * Node.itemsize
+    )
+    ids_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=ids
+    )
+    ropes_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, n_nodes * np.dtype('uint32').itemsize
+    )
+
+    fill_internal = kernels['fillInternal'](
+        cq, (roundUp(len(codes), 32),), None,
+        nodes_buf, ids_buf, len(codes),
+    )
+    generate_bvh = kernels['generateBVH'](
+        cq, (roundUp(len(codes) - 1, 32),), None,
+        codes_buf, nodes_buf, len(codes),
+        wait_for=[fill_internal]
+    )
+    calc_ropes = kernels['calculateRopes'](
+        cq, (roundUp(n_nodes, 32),), None,
+        ropes_buf, nodes_buf, len(codes),
+        wait_for=[generate_bvh]
+    )
+    (ropes_map, _) = cl.enqueue_map_buffer(
+        cq, ropes_buf, cl.map_flags.READ,
+        0, n_nodes, np.dtype('uint32'),
+        wait_for=[calc_ropes], is_blocking=True
+    )
+
+    leaf = len(codes) - 1
+    expected = np.array([NO_NODE, 2, 4, 4, NO_NODE, NO_NODE, leaf+7,
+                         leaf+1, 2, leaf+3, 4, 5, leaf+6, leaf+7, NO_NODE])
+    np.testing.assert_equal(ropes_map, expected)
+
+
+def test_generate_odd_bvh(cl_env, kernels, code_dtype):
     ctx, cq = cl_env
 
     # From Figure 3
     codes = np.array([0b00001, 0b00010, 0b00100, 0b00101,
-                      0b10011, 0b11000, 0b11001], dtype='uint32')
+                      0b10011, 0b11000, 0b11001], dtype=code_dtype)
     ids = np.arange(len(codes), dtype='uint32')
     n_nodes = len(codes) * 2 - 1
 
@@ -248,6 +321,43 @@ def test_compute_bounds(cl_env, kernels, coord_dtype):
     np.testing.assert_equal(bounds_map[:, :, :3], expected)
 
 
+def test_surface_areas(cl_env, kernels, coord_dtype):
+    ctx, cq = cl_env
+
+    bounds = np.array([[[-6.0,-7.0,-2.0], [ 5.0, 2.0, 9.0]],
+                       [[-6.0,-1.0,-2.0], [ 5.0, 2.0, 9.0]],
+                       [[-1.0, 0.0, 2.0], [ 5.0, 2.0, 9.0]],
+                       [[-5.0,-7.0, 2.0], [-3.0,-5.0, 4.0]]], dtype=coord_dtype)
+    n = len(bounds)
+
+    bounds_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(bounds) * 2 * 4 * coord_dtype.itemsize
+    )
+    (bounds_map, _) = cl.enqueue_map_buffer(
+        cq, bounds_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(bounds), 2, 4), coord_dtype,
+        is_blocking=True
+    )
+    bounds_map[..., :3] = bounds
+    del bounds_map
+    areas_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, (n - 1) * coord_dtype.itemsize
+    )
+    calc_areas = kernels['surfaceAreas'](
+        cq, (roundUp(n - 1, 32),), None,
+        areas_buf, bounds_buf, n,
+    )
+    (areas_map, _) = cl.enqueue_map_buffer(
+        cq, areas_buf, cl.map_flags.READ,
+        0, n - 1, coord_dtype,
+        wait_for=[calc_areas], is_blocking=True
+    )
+
+    d = bounds[:, 1] - bounds[:, 0]
+    areas = (d * np.roll(d, 1, axis=-1)).sum(axis=-1)
+    np.testing.assert_allclose(areas_map, areas[:n-1] / areas[0], rtol=1e-6)
+
+
 def test_codes(cl_env, kernels, coord_dtype):
     ctx, cq = cl_env
 
@@ -296,6 +406,52 @@ def test_codes(cl_env, kernels, coord_dtype):
         wait_for=[calc_codes], is_blocking=True
     )
     np.testing.assert_equal(codes_map, expected)
+    np.testing.assert_equal(codes_map, morton(coords, coord_range, np.dtype('uint32')))
+    del codes_map
+
+
+def test_codes_reference(cl_env, kernels, code_dtype):
+    ctx, cq = cl_env
+    coord_dtype = np.dtype('float32')
+
+    # Exactly representable, after scaling
+    coords = (np.random.randint(0, 2 ** 10, (64, 3)) / 2 ** 10).astype(coord_dtype)
+    coord_range = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]], dtype=coord_dtype)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coord_dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    range_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, 2 * 4 * coord_dtype.itemsize
+    )
+    (range_map, _) = cl.enqueue_map_buffer(
+        cq, range_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coord_range), 4), coord_dtype,
+        is_blocking=True
+    )
+    range_map[..., :3] = coord_range
+    del range_map
+    codes_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, len(coords) * code_dtype.itemsize
+    )
+    calc_codes = kernels['calculateCodes'](
+        cq, (roundUp(len(coords), 32),), None,
+        codes_buf, coords_buf, range_buf, len(coords),
+    )
+
+    (codes_map, _) = cl.enqueue_map_buffer(
+        cq, codes_buf, cl.map_flags.READ,
+        0, (len(coords),), code_dtype,
+        wait_for=[calc_codes], is_blocking=True
+    )
+    np.testing.assert_equal(codes_map, morton(coords, coord_range, code_dtype))
     del codes_map
 
 
@@ -422,7 +578,7 @@ def test_traverse(cl_env, kernels, coord_dtype):
     assert set(map(tuple, collisions_map)) == expected
 
 
-def test_problem_codes(cl_env, kernels, coord_dtype):
+def test_problem_codes(cl_env, kernels, coord_dtype, code_dtype):
     from .test_collision_py import find_collisions
     ctx, cq = cl_env
 
@@ -446,7 +602,7 @@ def test_problem_codes(cl_env, kernels, coord_dtype):
                       0b00110110110110110110110110110110,
                       0b00111111111111111111111111111111,
                       0b00111111111111111111111111111111,
-                      0b00111111111111111111111111111111], dtype='uint32')
+                      0b00111111111111111111111111111111], dtype=code_dtype)
     ids = np.arange(len(codes), dtype='uint32')
     n_nodes = 2 * len(codes) - 1
 
@@ -12,16 +12,22 @@ def pytest_generate_tests(metafunc):
         )
     elif 'coord_dtype' in metafunc.fixturenames:
         metafunc.parametrize("coord_dtype", [dtype('float32')], scope='module')
+    if 'code_dtype' in params:
+        metafunc.parametrize(
+            "code_dtype", map(dtype, ['uint32', 'uint64']), scope='module'
+        )
+    elif 'code_dtype' in metafunc.fixturenames:
+        metafunc.parametrize("code_dtype", [dtype('uint32')], scope='module')
 
 
 @pytest.fixture(scope='module')
-def collision_programs(cl_env, coord_dtype):
+def collision_programs(cl_env, coord_dtype, code_dtype):
     from collision.radix import RadixProgram, PrefixScanProgram
     from collision.bounds import BoundsProgram
 
     ctx, cq = cl_env
-    program = CollisionProgram(ctx, coord_dtype)
-    radix_program = RadixProgram(ctx)
+    program = CollisionProgram(ctx, coord_dtype, code_dtype)
+    radix_program = RadixProgram(ctx, code_dtype)
     scan_program = PrefixScanProgram(ctx)
     reducer_program = BoundsProgram(ctx, (coord_dtype, 3))
     return program, (radix_program, scan_program), reducer_program
@@ -100,9 +106,11 @@ def test_collision(cl_env, coord_dtype, collision_programs):
 @pytest.mark.parametrize("size,ngroups,group_size", [
     (120, 5, 8), (256, 4, 32), (317, 4, 16), (341, 4, 64)
 ])
-def test_random_collision(cl_env, coord_dtype, collision_programs, size, ngroups, group_size):
+def test_random_collision(cl_env, coord_dtype, code_dtype, collision_programs,
+                          size, ngroups, group_size):
     ctx, cq = cl_env
-    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                        code_dtype=code_dtype)
 
     np.random.seed(4)
     coords = np.random.random((size, 3)).astype(coord_dtype)
@@ -258,10 +266,43 @@ def test_auto_program(cl_env, coord_dtype, size, ngroups, group_size):
     assert collisions == expected
 
 
+def test_deep_tree(cl_env, code_dtype, collision_programs):
+    ctx, cq = cl_env
+    # Points halving towards the origin along each axis, duplicated, give a chain of
+    # internal nodes one code bit apart, then index bits apart, deeper than 64 levels
+    coords = np.zeros((3, 22, 3), dtype='float32')
+    for axis in range(3):
+        coords[axis, :, axis] = 2.0 ** -np.arange(22)
+    coords = np.repeat(np.concatenate([coords.reshape(-1, 3), np.ones((1, 3))]), 4, axis=0)
+    coords = coords.astype('float32')
+    size = len(coords)
+    collider = Collider(ctx, size, 4, 8, 'float32', *collision_programs, code_dtype=code_dtype)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.pad(coords, ((0, 0), (0, 1)))
+    )
+    # Everything collides, so every level of the tree is traversed
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.full(size, 2.0, dtype='float32')
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+    e = collider.get_collisions(cq, coords_buf, radii_buf, n_collisions_buf, None, 0)
+    n_collisions = np.empty(1, dtype=collider.counter_dtype)
+    cl.enqueue_copy(cq, n_collisions, n_collisions_buf, wait_for=[e])
+    assert n_collisions[0] == size * (size - 1) // 2
+
+
+@pytest.mark.parametrize("ordered", [False, True])
 @pytest.mark.parametrize("size, ngroups, group_size", [(100, 10, 8)])
-def test_count_only(cl_env, coord_dtype, collision_programs, size, ngroups, group_size):
+def test_count_only(cl_env, coord_dtype, collision_programs, size, ngroups, group_size,
+                    ordered):
     ctx, cq = cl_env
-    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                        ordered=ordered)
 
     np.random.seed(4)
     coords = np.random.random((size, 3)).astype(coord_dtype)
@@ -334,3 +375,916 @@ def test_collider_dtype(cl_env, dt):
     collider = Collider(ctx, 100, 5, 8, coord_dtype=dt)
     assert collider.program.coord_dtype == np.dtype(dt)
     assert collider.reducer.program.value_dtype == np.dtype((dt, 3))
+
+
+def test_code_dtype(cl_env, collision_programs):
+    ctx, cq = cl_env
+    collider = Collider(ctx, 100, 5, 8, code_dtype='uint64')
+    assert collider.program.code_dtype == np.dtype('uint64')
+    assert collider.sorter.program.key_dtype == np.dtype('uint64')
+
+    with pytest.raises(ValueError):
+        Collider(ctx, 100, 5, 8, code_dtype='uint16')
+    with pytest.raises(ValueError):
+        # Programs are built for uint32 codes
+        Collider(ctx, 100, 5, 8, 'float32', *collision_programs, code_dtype='uint64')
+
+
+@pytest.mark.parametrize("size,ngroups,group_size", [(120, 5, 8), (317, 4, 16)])
+def test_refit(cl_env, coord_dtype, collision_programs, size, ngroups, group_size):
+    ctx, cq = cl_env
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radius = 1 / (size ** 0.5) # Keep number of collisions under control
+    radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+    moved = (coords + np.random.normal(0, 0.01, coords.shape)).astype(coord_dtype)
+    expected = find_collisions(moved, radii)
+
+    coords_bufs = []
+    for c in [coords, moved]:
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY, len(c) * 4 * coord_dtype.itemsize
+        )
+        (coords_map, _) = cl.enqueue_map_buffer(
+            cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, (len(c), 4), coord_dtype,
+            is_blocking=True
+        )
+        coords_map[..., :3] = c
+        del coords_map
+        coords_bufs.append(coords_buf)
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, len(expected) * 2 * collider.id_dtype.itemsize
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    with pytest.raises(ValueError):
+        collider.refit(cq, coords_bufs[1], radii_buf)
+
+    e = collider.build(cq, coords_bufs[0], radii_buf)
+    e = collider.refit(cq, coords_bufs[1], radii_buf, wait_for=[e])
+    e = collider.traverse(cq, n_collisions_buf, collisions_buf, len(expected), wait_for=[e])
+
+    (n_collisions_map, _) = cl.enqueue_map_buffer(
+        cq, n_collisions_buf, cl.map_flags.READ,
+        0, 1, collider.counter_dtype,
+        wait_for=[e], is_blocking=True
+    )
+    assert n_collisions_map[0] == len(expected)
+
+    (collisions_map, _) = cl.enqueue_map_buffer(
+        cq, collisions_buf, cl.map_flags.READ,
+        0, (n_collisions_map[0], 2), collider.id_dtype,
+        wait_for=[e], is_blocking=True
+    )
+
+    # Need to sort, order is undefined
+    collisions = set(map(tuple, np.sort(collisions_map, axis=1)))
+    assert collisions == expected
+
+
+@pytest.mark.parametrize("rebuild_interval,max_cost_ratio,shuffle,expected", [
+    (None, None, False, [True, False, False, False]),
+    (1, None, False, [True, True, True, True]),
+    (2, None, False, [True, False, True, False]),
+    (3, None, False, [True, False, False, True]),
+    (None, 2.0, False, [True, False, False, False]),
+    (None, 1.5, True, [True, True, True, True]),
+])
+def test_update(cl_env, coord_dtype, collision_programs,
+                rebuild_interval, max_cost_ratio, shuffle, expected):
+    ctx, cq = cl_env
+    size, ngroups, group_size = 100, 4, 8
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                        rebuild_interval=rebuild_interval, max_cost_ratio=max_cost_ratio)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radii = np.full(len(coords), 0.01, dtype=coord_dtype)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+
+    rebuilt = []
+    for _ in range(len(expected)):
+        (coords_map, _) = cl.enqueue_map_buffer(
+            cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, (len(coords), 4), coord_dtype,
+            is_blocking=True
+        )
+        coords_map[..., :3] = coords
+        del coords_map
+
+        e = collider.update(cq, coords_buf, radii_buf)
+        cl.wait_for_events([e])
+        rebuilt.append(collider._frames_since_build == 0)
+        if shuffle:
+            # Scrambles the Morton order, so refit trees degrade badly
+            coords = np.random.permutation(coords)
+
+    assert rebuilt == expected
+
+
+@pytest.mark.parametrize("refit", [False, True])
+def test_update_after_collide(cl_env, coord_dtype, collision_programs, refit):
+    ctx, cq = cl_env
+    size, ngroups, group_size = 100, 4, 8
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                        max_cost_ratio=2.0)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radii = np.full(len(coords), 0.01, dtype=coord_dtype)
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.pad(coords, ((0, 0), (0, 1)))
+    )
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+
+    # Built outside update(), so without a cost to compare refits against
+    e, _ = collider.collide(cq, coords_buf, radii_buf)
+    if refit:
+        e = collider.refit(cq, coords_buf, radii_buf, wait_for=[e])
+    cl.wait_for_events([collider.update(cq, coords_buf, radii_buf, wait_for=[e])])
+    # A refit tree of unknown build cost is rebuilt, otherwise the build is costed
+    assert (collider._frames_since_build == 0) == refit
+    cl.wait_for_events([collider.update(cq, coords_buf, radii_buf)])
+    assert collider._frames_since_build == (1 if refit else 2)
+
+
+def test_update_errs(cl_env, coord_dtype, collision_programs):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        Collider(ctx, 100, 4, 8, coord_dtype, *collision_programs, rebuild_interval=0)
+
+
+def test_tree_cost(cl_env, coord_dtype, collision_programs):
+    ctx, cq = cl_env
+    size, ngroups, group_size = 100, 4, 8
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radii = np.full(len(coords), 0.01, dtype=coord_dtype)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coord_dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+
+    e = collider.build(cq, coords_buf, radii_buf)
+    cost = collider.tree_cost(cq, [e])
+    # Root contributes 1, all others are smaller
+    assert 1.0 < cost < size - 1
+
+
+@pytest.mark.parametrize("stackless", [False, True])
+@pytest.mark.parametrize("ordered", [False, True])
+@pytest.mark.parametrize("clustered", [False, True])
+@pytest.mark.parametrize("size,ngroups,group_size", [(7, 1, 8), (120, 4, 8), (317, 3, 16)])
+def test_optimize_treelets(cl_env, coord_dtype, collision_programs, size, ngroups, group_size,
+                           clustered, ordered, stackless):
+    ctx, cq = cl_env
+
+    np.random.seed(4)
+    if clustered:
+        centres = np.random.random((4, 3))
+        coords = centres[np.random.randint(len(centres), size=size)]
+        coords += np.random.normal(0.0, 0.02, coords.shape)
+        coords = coords.astype(coord_dtype)
+    else:
+        coords = np.random.random((size, 3)).astype(coord_dtype)
+    radius = 1 / (size ** 0.5) # Keep number of collisions under control
+    radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+    expected = find_collisions(coords, radii)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coord_dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+
+    costs = []
+    for optimize_treelets in [False, True]:
+        collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                            ordered=ordered, stackless=stackless,
+                            optimize_treelets=optimize_treelets)
+        e, n_collisions = collider.collide(cq, coords_buf, radii_buf)
+        assert n_collisions == len(expected)
+        (collisions_map, _) = cl.enqueue_map_buffer(
+            cq, collider.collisions_buf, cl.map_flags.READ,
+            0, (n_collisions, 2), collider.id_dtype,
+            wait_for=[e], is_blocking=True
+        )
+        collisions = set(map(tuple, np.sort(collisions_map, axis=1)))
+        assert collisions == expected
+        del collisions_map
+
+        # Refits keep the restructured topology
+        e = collider.refit(cq, coords_buf, radii_buf)
+        costs.append(collider.tree_cost(cq, [e]))
+
+    # The original topology of each treelet is one of those considered
+    assert costs[1] <= costs[0] * (1 + 1e-5)
+
+
+@pytest.mark.parametrize("stackless", [False, True])
+@pytest.mark.parametrize("ordered", [False, True])
+@pytest.mark.parametrize("sizes,ngroups,group_size", [((120, 317, 100), 4, 8)])
+def test_collide(cl_env, coord_dtype, collision_programs, sizes, ngroups, group_size, ordered,
+                 stackless):
+    ctx, cq = cl_env
+    collider = Collider(ctx, sizes[0], ngroups, group_size, coord_dtype, *collision_programs,
+                        ordered=ordered, stackless=stackless)
+    assert collider.collisions_capacity == 0
+
+    np.random.seed(4)
+    capacity = 0
+    for size in sizes:
+        collider.resize(size)
+
+        coords = np.random.random((size, 3)).astype(coord_dtype)
+        radius = 1 / (size ** 0.5) # Keep number of collisions under control
+        radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+        expected = find_collisions(coords, radii)
+
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+        )
+        (coords_map, _) = cl.enqueue_map_buffer(
+            cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+            0, (len(coords), 4), coord_dtype,
+            is_blocking=True
+        )
+        coords_map[..., :3] = coords
+        del coords_map
+        radii_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+        )
+
+        e, n_collisions = collider.collide(cq, coords_buf, radii_buf)
+        assert n_collisions == len(expected)
+        # Grows exactly, but never shrinks
+        capacity = max(capacity, len(expected))
+        assert collider.collisions_capacity == capacity
+
+        (collisions_map, _) = cl.enqueue_map_buffer(
+            cq, collider.collisions_buf, cl.map_flags.READ,
+            0, (n_collisions, 2), collider.id_dtype,
+            wait_for=[e], is_blocking=True
+        )
+
+        # Need to sort, order is undefined
+        collisions = set(map(tuple, np.sort(collisions_map, axis=1)))
+        assert collisions == expected
+        del collisions_map
+
+
+@pytest.mark.parametrize("scene_bounds", [None, 'previous', [[0.0] * 3, [1.0] * 3],
+                                          [[0.2] * 3, [0.8] * 3]])
+@pytest.mark.parametrize("size,ngroups,group_size", [(120, 5, 8), (317, 3, 16)])
+def test_scene_bounds(cl_env, coord_dtype, collision_programs, size, ngroups, group_size,
+                      scene_bounds):
+    ctx, cq = cl_env
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+
+    np.random.seed(4)
+    radius = 1 / (size ** 0.5)
+    radii = np.random.uniform(0, radius, size).astype(coord_dtype)
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    # Frames move slightly, so earlier bounds are close but not exact
+    for frame in range(3):
+        coords = (coords + np.random.normal(0, 0.01, coords.shape)).astype(coord_dtype)
+        expected = find_collisions(coords, radii)
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=np.pad(coords, ((0, 0), (0, 1)))
+        )
+        collisions_buf = cl.Buffer(
+            ctx, cl.mem_flags.WRITE_ONLY, len(expected) * 2 * collider.id_dtype.itemsize
+        )
+
+        frame_bounds = None if scene_bounds == 'previous' and frame == 0 else scene_bounds
+        e = collider.get_collisions(cq, coords_buf, radii_buf, n_collisions_buf,
+                                    collisions_buf, len(expected), scene_bounds=frame_bounds)
+        n_collisions = np.empty(1, dtype=collider.counter_dtype)
+        cl.enqueue_copy(cq, n_collisions, n_collisions_buf, wait_for=[e])
+        assert n_collisions[0] == len(expected)
+        collisions = np.empty((len(expected), 2), dtype=collider.id_dtype)
+        cl.enqueue_copy(cq, collisions, collisions_buf, wait_for=[e])
+        assert set(map(tuple, np.sort(collisions, axis=1))) == expected
+
+        # Always left with the bounds of this frame, for the next
+        bounds = collider.get_scene_bounds(cq, [e])
+        np.testing.assert_equal(bounds, [coords.min(axis=0), coords.max(axis=0)])
+
+
+@pytest.mark.parametrize("scene_bounds", [None, 'previous'])
+@pytest.mark.parametrize("size,ngroups,group_size", [(120, 5, 8), (317, 3, 16)])
+def test_sphere_bounds(cl_env, coord_dtype, collision_programs, size, ngroups, group_size,
+                       scene_bounds):
+    from collision.bounds import SphereBoundsProgram
+
+    ctx, cq = cl_env
+    program, sorter_programs, reducer_program = collision_programs
+    with pytest.raises(ValueError):
+        Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                 sphere_bounds=True)
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, program,
+                        sorter_programs, SphereBoundsProgram(ctx, (coord_dtype, 3)),
+                        sphere_bounds=True)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    # A few large outliers
+    radii = np.random.uniform(0, 1 / (size ** 0.5), size).astype(coord_dtype)
+    radii[:3] = 0.5
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    for frame in range(2):
+        coords = (coords + np.random.normal(0, 0.01, coords.shape)).astype(coord_dtype)
+        expected = find_collisions(coords, radii)
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=np.pad(coords, ((0, 0), (0, 1)))
+        )
+        collisions_buf = cl.Buffer(
+            ctx, cl.mem_flags.WRITE_ONLY, len(expected) * 2 * collider.id_dtype.itemsize
+        )
+
+        e = collider.get_collisions(cq, coords_buf, radii_buf, n_collisions_buf,
+                                    collisions_buf, len(expected),
+                                    scene_bounds=scene_bounds if frame else None)
+        collisions = np.empty((len(expected), 2), dtype=collider.id_dtype)
+        cl.enqueue_copy(cq, collisions, collisions_buf, wait_for=[e])
+        assert set(map(tuple, np.sort(collisions, axis=1))) == expected
+
+        bounds = collider.get_scene_bounds(cq, [e])
+        np.testing.assert_allclose(bounds, [
+            (coords - radii[:, None]).min(axis=0), (coords + radii[:, None]).max(axis=0),
+            np.full(3, radii.max())
+        ])
+
+
+def test_scene_bounds_order(cl_env, coord_dtype, collision_programs):
+    from collision.host import create_queue
+
+    ctx, _ = cl_env
+    # Builds are enqueued without waiting on each other, possibly out of order
+    cq = create_queue(ctx)
+    size = 120
+    collider = Collider(ctx, size, 5, 8, coord_dtype, *collision_programs)
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.zeros(size, dtype=coord_dtype)
+    )
+
+    np.random.seed(4)
+    for scene_bounds in [None, [[0.0] * 3, [1.0] * 3], 'previous']:
+        coords = np.random.random((size, 3)).astype(coord_dtype)
+        coords_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=np.pad(coords, ((0, 0), (0, 1)))
+        )
+        collider.build(cq, coords_buf, radii_buf, scene_bounds=scene_bounds)
+    bounds = collider.get_scene_bounds(cq)
+    np.testing.assert_equal(bounds, [coords.min(axis=0), coords.max(axis=0)])
+
+
+def test_scene_bounds_errs(cl_env, coord_dtype, collision_programs):
+    ctx, cq = cl_env
+    size = 10
+    collider = Collider(ctx, size, 2, 8, coord_dtype, *collision_programs)
+    coords_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY, size * 4 * coord_dtype.itemsize)
+    radii_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY, size * coord_dtype.itemsize)
+
+    with pytest.raises(ValueError):
+        collider.get_scene_bounds(cq)
+    with pytest.raises(ValueError):
+        collider.build(cq, coords_buf, radii_buf, scene_bounds='previous')
+    with pytest.raises(ValueError):
+        collider.build(cq, coords_buf, radii_buf, scene_bounds='box')
+    with pytest.raises(ValueError):
+        collider.build(cq, coords_buf, radii_buf, scene_bounds=[0.0, 1.0, 2.0, 3.0])
+
+
+@pytest.mark.parametrize("size,ngroups,group_size", [
+    (120, 5, 8), (256, 4, 32), (317, 4, 16), (341, 4, 64)
+])
+@pytest.mark.parametrize("stackless", [False, True])
+def test_ordered_collision(cl_env, coord_dtype, collision_programs, size, ngroups, group_size,
+                           stackless):
+    ctx, cq = cl_env
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs,
+                        ordered=True, stackless=stackless)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radius = 1 / (size ** 0.5) # Keep number of collisions under control
+    radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+    expected = find_collisions(coords, radii)
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coord_dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, len(expected) * 2 * collider.id_dtype.itemsize
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    results = []
+    for _ in range(2):
+        e = collider.get_collisions(cq, coords_buf, radii_buf, n_collisions_buf,
+                                    collisions_buf, len(expected))
+
+        (n_collisions_map, _) = cl.enqueue_map_buffer(
+            cq, n_collisions_buf, cl.map_flags.READ,
+            0, 1, collider.counter_dtype,
+            wait_for=[e], is_blocking=True
+        )
+        assert n_collisions_map[0] == len(expected)
+
+        (collisions_map, _) = cl.enqueue_map_buffer(
+            cq, collisions_buf, cl.map_flags.READ,
+            0, (n_collisions_map[0], 2), collider.id_dtype,
+            wait_for=[e], is_blocking=True
+        )
+        results.append(collisions_map.copy())
+        del collisions_map
+
+    collisions = set(map(tuple, np.sort(results[0], axis=1)))
+    assert collisions == expected
+    np.testing.assert_equal(results[0], results[1])
+    # Sorted by query id, without sorting on the host
+    assert (np.diff(results[0][:, 0].astype('int64')) >= 0).all()
+
+
+def find_query_collisions(query_min, query_max, min_bounds, max_bounds):
+    collisions = ((query_max.reshape(-1, 1, 3) > min_bounds.reshape(1, -1, 3)) &
+                  (query_min.reshape(-1, 1, 3) < max_bounds.reshape(1, -1, 3)))
+    return set(zip(*np.nonzero(collisions.all(axis=-1))))
+
+
+@pytest.mark.parametrize("boxes", [False, True])
+@pytest.mark.parametrize("size,n_queries,ngroups,group_size", [
+    (120, 37, 5, 8), (317, 100, 4, 16),
+])
+def test_query(cl_env, coord_dtype, collision_programs, size, n_queries, ngroups, group_size,
+               boxes):
+    ctx, cq = cl_env
+    collider = Collider(ctx, size, ngroups, group_size, coord_dtype, *collision_programs)
+
+    np.random.seed(4)
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radius = 1 / (size ** 0.5) # Keep number of collisions under control
+    radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+    # Includes the built set itself, which must not be de-duplicated
+    query_coords = np.concatenate([coords[:n_queries // 2], np.random.random(
+        (n_queries - n_queries // 2, 3)
+    ).astype(coord_dtype)])
+    query_radii = np.random.uniform(0, radius, n_queries).astype(coord_dtype)
+    query_min = query_coords - query_radii.reshape(-1, 1)
+    query_max = query_coords + query_radii.reshape(-1, 1)
+    expected = find_query_collisions(query_min, query_max,
+                                     coords - radii.reshape(-1, 1),
+                                     coords + radii.reshape(-1, 1))
+    assert {(i, i) for i in range(n_queries // 2)} <= expected
+
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY, len(coords) * 4 * coord_dtype.itemsize
+    )
+    (coords_map, _) = cl.enqueue_map_buffer(
+        cq, coords_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, (len(coords), 4), coord_dtype,
+        is_blocking=True
+    )
+    coords_map[..., :3] = coords
+    del coords_map
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    if boxes:
+        query_bounds = np.zeros((n_queries, 2, 4), dtype=coord_dtype)
+        query_bounds[:, 0, :3] = query_min
+        query_bounds[:, 1, :3] = query_max
+        query_bufs = [cl.Buffer(
+            ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=query_bounds
+        )]
+        query = collider.query_bounds
+    else:
+        query_coords_4 = np.zeros((n_queries, 4), dtype=coord_dtype)
+        query_coords_4[:, :3] = query_coords
+        query_bufs = [
+            cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                      hostbuf=query_coords_4),
+            cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                      hostbuf=query_radii),
+        ]
+        query = collider.query
+    collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, len(expected) * 2 * collider.id_dtype.itemsize
+    )
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    with pytest.raises(ValueError):
+        query(cq, *query_bufs, n_queries, n_collisions_buf, collisions_buf, len(expected))
+
+    e = collider.build(cq, coords_buf, radii_buf)
+    # Build once, query repeatedly
+    for _ in range(2):
+        e = query(cq, *query_bufs, n_queries, n_collisions_buf, collisions_buf,
+                  len(expected), wait_for=[e])
+        (n_collisions_map, _) = cl.enqueue_map_buffer(
+            cq, n_collisions_buf, cl.map_flags.READ,
+            0, 1, collider.counter_dtype,
+            wait_for=[e], is_blocking=True
+        )
+        assert n_collisions_map[0] == len(expected)
+        del n_collisions_map
+
+        (collisions_map, _) = cl.enqueue_map_buffer(
+            cq, collisions_buf, cl.map_flags.READ,
+            0, (len(expected), 2), collider.id_dtype,
+            wait_for=[e], is_blocking=True
+        )
+        # Order is undefined, but pairs are (query, id)
+        assert set(map(tuple, collisions_map)) == expected
+        del collisions_map
+
+
+@pytest.mark.parametrize("radius,expected", [(0.5, 1), (0.1, 0)])
+def test_query_single(cl_env, coord_dtype, collision_programs, radius, expected):
+    ctx, cq = cl_env
+    # The root is the only leaf, with no children to traverse
+    collider = Collider(ctx, 1, 4, 8, coord_dtype, *collision_programs)
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.zeros((1, 4), dtype=coord_dtype)
+    )
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.full(1, 0.1, dtype=coord_dtype)
+    )
+    query_coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.array([[0.5, 0.0, 0.0, 0.0]], dtype=coord_dtype)
+    )
+    query_radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.full(1, radius, dtype=coord_dtype)
+    )
+    collisions_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 2 * collider.id_dtype.itemsize)
+    n_collisions_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, collider.counter_dtype.itemsize
+    )
+
+    e = collider.build(cq, coords_buf, radii_buf)
+    e = collider.query(cq, query_coords_buf, query_radii_buf, 1, n_collisions_buf,
+                       collisions_buf, 1, wait_for=[e])
+    n_collisions = np.empty(1, dtype=collider.counter_dtype)
+    cl.enqueue_copy(cq, n_collisions, n_collisions_buf, wait_for=[e])
+    assert n_collisions[0] == expected
+    if expected:
+        collisions = np.empty((1, 2), dtype=collider.id_dtype)
+        cl.enqueue_copy(cq, collisions, collisions_buf, wait_for=[e])
+        np.testing.assert_equal(collisions, [[0, 0]])
+
+
+@pytest.fixture
+def neighbour_problem(cl_env, coord_dtype):
+    ctx, cq = cl_env
+    np.random.seed(4)
+    coords = np.random.random((317, 3)).astype(coord_dtype)
+    radii = np.zeros(len(coords), dtype=coord_dtype)
+    # First half of the queries are the points themselves
+    query_coords = np.concatenate([coords[:50], np.random.random((50, 3))]).astype(coord_dtype)
+
+    bufs = []
+    for c in [coords, query_coords]:
+        c4 = np.zeros((len(c), 4), dtype=coord_dtype)
+        c4[:, :3] = c
+        bufs.append(cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                              hostbuf=c4))
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=radii
+    )
+    return coords, query_coords, bufs[0], bufs[1], radii_buf
+
+
+@pytest.mark.parametrize("exclude_self", [False, True])
+@pytest.mark.parametrize("radius", [0.0, 0.1, 0.25])
+@pytest.mark.parametrize("ngroups,group_size", [(4, 8), (4, 32)])
+def test_radius_neighbours(cl_env, coord_dtype, collision_programs, neighbour_problem,
+                           ngroups, group_size, radius, exclude_self):
+    ctx, cq = cl_env
+    coords, query_coords, coords_buf, query_coords_buf, radii_buf = neighbour_problem
+    n_queries = len(query_coords)
+    collider = Collider(ctx, len(coords), ngroups, group_size, coord_dtype,
+                        *collision_programs)
+
+    distances = np.linalg.norm(query_coords[:, None].astype('float64') - coords[None], axis=-1)
+    neighbours = distances < radius
+    if exclude_self:
+        np.fill_diagonal(neighbours, False)
+    expected_offsets = np.concatenate([[0], np.cumsum(neighbours.sum(axis=1))])
+
+    offsets_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, (n_queries + 1) * collider.counter_dtype.itemsize
+    )
+    e = collider.build(cq, coords_buf, radii_buf)
+    e = collider.count_neighbours(cq, coords_buf, query_coords_buf, n_queries, radius,
+                                  offsets_buf, exclude_self, wait_for=[e])
+    offsets = np.empty(n_queries + 1, dtype=collider.counter_dtype)
+    cl.enqueue_copy(cq, offsets, offsets_buf, wait_for=[e])
+    np.testing.assert_equal(offsets, expected_offsets)
+
+    n_indices = int(offsets[-1])
+    indices_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, max(n_indices, 1) * collider.id_dtype.itemsize
+    )
+    e = collider.write_neighbours(cq, coords_buf, query_coords_buf, n_queries, radius,
+                                  offsets_buf, indices_buf, n_indices, exclude_self,
+                                  wait_for=[e])
+    indices = np.empty(n_indices, dtype=collider.id_dtype)
+    cl.enqueue_copy(cq, indices, indices_buf, wait_for=[e])
+    for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        np.testing.assert_equal(np.sort(indices[start:end]), np.flatnonzero(neighbours[i]))
+
+
+@pytest.mark.parametrize("exclude_self", [False, True])
+@pytest.mark.parametrize("k", [1, 5, 32])
+def test_nearest_neighbours(cl_env, coord_dtype, collision_programs, neighbour_problem,
+                            k, exclude_self):
+    ctx, cq = cl_env
+    coords, query_coords, coords_buf, query_coords_buf, radii_buf = neighbour_problem
+    n_queries = len(query_coords)
+    collider = Collider(ctx, len(coords), 4, 16, coord_dtype, *collision_programs)
+
+    distances = np.linalg.norm(query_coords[:, None].astype('float64') - coords[None], axis=-1)
+    if exclude_self:
+        np.fill_diagonal(distances, np.inf)
+    expected = np.argsort(distances, axis=1)[:, :k]
+
+    indices_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, n_queries * k * collider.id_dtype.itemsize
+    )
+    distances_buf = cl.Buffer(
+        ctx, cl.mem_flags.WRITE_ONLY, n_queries * k * coord_dtype.itemsize
+    )
+
+    with pytest.raises(ValueError):
+        collider.nearest_neighbours(cq, coords_buf, query_coords_buf, n_queries, k,
+                                    indices_buf, distances_buf, exclude_self)
+    e = collider.build(cq, coords_buf, radii_buf)
+    with pytest.raises(ValueError):
+        collider.nearest_neighbours(cq, coords_buf, query_coords_buf, n_queries,
+                                    collider.program.max_k + 1, indices_buf, distances_buf)
+    e = collider.nearest_neighbours(cq, coords_buf, query_coords_buf, n_queries, k,
+                                    indices_buf, distances_buf, exclude_self, wait_for=[e])
+    indices = np.empty((n_queries, k), dtype=collider.id_dtype)
+    result_distances = np.empty((n_queries, k), dtype=coord_dtype)
+    cl.enqueue_copy(cq, indices, indices_buf, wait_for=[e])
+    cl.enqueue_copy(cq, result_distances, distances_buf, wait_for=[e])
+
+    np.testing.assert_equal(indices, expected)
+    np.testing.assert_allclose(result_distances,
+                               np.take_along_axis(distances, expected, axis=1), rtol=1e-5)
+
+
+def test_nearest_neighbours_missing(cl_env, coord_dtype, collision_programs):
+    ctx, cq = cl_env
+    collider = Collider(ctx, 4, 4, 8, coord_dtype, *collision_programs)
+
+    coords = np.zeros((4, 4), dtype=coord_dtype)
+    coords[:, 0] = np.arange(4)
+    coords_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=coords
+    )
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.zeros(4, dtype=coord_dtype)
+    )
+    k = 6
+    indices_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, k * collider.id_dtype.itemsize)
+    distances_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, k * coord_dtype.itemsize)
+
+    e = collider.build(cq, coords_buf, radii_buf)
+    e = collider.nearest_neighbours(cq, coords_buf, coords_buf, 1, k,
+                                    indices_buf, distances_buf, wait_for=[e])
+    indices = np.empty(k, dtype=collider.id_dtype)
+    distances = np.empty(k, dtype=coord_dtype)
+    cl.enqueue_copy(cq, indices, indices_buf, wait_for=[e])
+    cl.enqueue_copy(cq, distances, distances_buf, wait_for=[e])
+
+    np.testing.assert_equal(indices, [0, 1, 2, 3, NO_NODE, NO_NODE])
+    np.testing.assert_equal(distances, [0, 1, 2, 3, np.inf, np.inf])
+
+
+@pytest.fixture(scope='module')
+def batched_programs(cl_env, coord_dtype):
+    from collision.radix import RadixProgram, PrefixScanProgram
+    from collision.bounds import BoundsProgram
+
+    ctx, cq = cl_env
+    program = CollisionProgram(ctx, coord_dtype, 'uint64')
+    radix_program = RadixProgram(ctx, 'uint64')
+    scan_program = PrefixScanProgram(ctx)
+    reducer_program = BoundsProgram(ctx, (coord_dtype, 3))
+    return program, (radix_program, scan_program), reducer_program
+
+
+def subtree_leaves(nodes, idx):
+    n = (len(nodes) + 1) // 2
+    if idx >= n - 1:
+        return [nodes[idx]['data'][0]]
+    return [leaf for child in nodes[idx]['data'] for leaf in subtree_leaves(nodes, child)]
+
+
+@pytest.mark.parametrize("sizes,ngroups,group_size", [
+    ([10, 0, 1, 37, 2], 4, 8), ([40] * 30 + [500], 8, 32),
+])
+def test_batched_build(cl_env, coord_dtype, batched_programs, sizes, ngroups, group_size):
+    ctx, cq = cl_env
+    program, sorter_programs, reducer_program = batched_programs
+    offsets = np.cumsum([0] + sizes, dtype='uint32')
+    size = int(offsets[-1])
+
+    pool = BufferPool(ctx, cl.mem_flags.READ_WRITE)
+    collider = BatchedCollider(ctx, size, ngroups, group_size, coord_dtype, program,
+                               sorter_programs, reducer_program, pool=pool)
+
+    # Scenes overlap in space, so are only separated by scene ids
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radii = np.random.random(size).astype(coord_dtype) * 0.01
+    coords_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                           hostbuf=np.pad(coords, ((0, 0), (0, 1))))
+    radii_buf, offsets_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [radii, offsets]
+    )
+
+    with pytest.raises(ValueError):
+        collider.refit(cq, coords_buf, radii_buf)
+    with pytest.raises(ValueError):
+        collider.build(cq, coords_buf, radii_buf, offsets_buf, 0)
+
+    e = collider.build(cq, coords_buf, radii_buf, offsets_buf, len(sizes))
+    nodes = np.empty(collider.n_nodes, dtype=Node)
+    roots = np.empty(len(sizes), dtype='uint32')
+    cl.enqueue_copy(cq, nodes, collider._nodes_buf, wait_for=[e])
+    cl.enqueue_copy(cq, roots, collider._roots_buf, wait_for=[e])
+
+    for start, end, root in zip(offsets[:-1], offsets[1:], roots):
+        if start == end:
+            assert root == NO_NODE
+        else:
+            assert sorted(subtree_leaves(nodes, root)) == list(range(start, end))
+
+    bounds = np.empty((collider.n_nodes, 2, 4), dtype=coord_dtype)
+    e = collider.refit(cq, coords_buf, radii_buf)
+    cl.enqueue_copy(cq, bounds, collider._bounds_buf, wait_for=[e])
+    np.testing.assert_allclose(bounds[0, 0, :3], (coords - radii[:, None]).min(axis=0))
+    np.testing.assert_allclose(bounds[0, 1, :3], (coords + radii[:, None]).max(axis=0))
+
+
+@pytest.mark.parametrize("sizes,ngroups,group_size", [
+    ([10, 0, 1, 37, 2], 4, 8), ([40] * 30 + [317], 8, 32),
+])
+def test_batched_collisions(cl_env, coord_dtype, batched_programs, sizes, ngroups, group_size):
+    ctx, cq = cl_env
+    offsets = np.cumsum([0] + sizes, dtype='uint32')
+    size = int(offsets[-1])
+    collider = BatchedCollider(ctx, size, ngroups, group_size, coord_dtype,
+                               *batched_programs)
+
+    # Scenes overlap in space, so would collide with each other if not separated
+    coords = np.random.random((size, 3)).astype(coord_dtype)
+    radii = np.random.uniform(0, 0.1, size).astype(coord_dtype)
+    expected = set()
+    for scene, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        expected.update((scene, start + i, start + j)
+                        for i, j in find_collisions(coords[start:end], radii[start:end]))
+
+    coords_buf = cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                           hostbuf=np.pad(coords, ((0, 0), (0, 1))))
+    radii_buf, offsets_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [radii, offsets]
+    )
+    n_collisions_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, 4)
+    collisions_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, len(expected) * 3 * 4)
+
+    with pytest.raises(ValueError):
+        collider.traverse(cq, n_collisions_buf, collisions_buf, len(expected))
+    with pytest.raises(ValueError):
+        collider.get_collisions(cq, coords_buf, radii_buf, offsets_buf, len(sizes),
+                                n_collisions_buf, None, 1)
+
+    e = collider.get_collisions(cq, coords_buf, radii_buf, offsets_buf, len(sizes),
+                                n_collisions_buf, collisions_buf, len(expected))
+    n_collisions = np.empty(1, dtype='uint32')
+    collisions = np.empty((len(expected), 3), dtype='uint32')
+    cl.enqueue_copy(cq, n_collisions, n_collisions_buf, wait_for=[e])
+    cl.enqueue_copy(cq, collisions, collisions_buf, wait_for=[e])
+    assert n_collisions[0] == len(expected)
+
+    # Need to sort, order is undefined
+    collisions[:, 1:] = np.sort(collisions[:, 1:], axis=1)
+    assert set(map(tuple, collisions)) == expected
+
+
+def test_neighbours_single(cl_env, coord_dtype, collision_programs):
+    ctx, cq = cl_env
+    # The root is the only leaf, with no children to traverse
+    collider = Collider(ctx, 1, 4, 8, coord_dtype, *collision_programs)
+    coords = np.zeros((1, 4), dtype=coord_dtype)
+    query_coords = np.array([[0.5, 0.0, 0.0, 0.0], [2.0, 0.0, 0.0, 0.0]], dtype=coord_dtype)
+    coords_buf, query_coords_buf = (cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=c
+    ) for c in [coords, query_coords])
+    radii_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.zeros(1, dtype=coord_dtype)
+    )
+    e = collider.build(cq, coords_buf, radii_buf)
+
+    offsets_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, 3 * collider.counter_dtype.itemsize)
+    e = collider.count_neighbours(cq, coords_buf, query_coords_buf, 2, 1.0, offsets_buf,
+                                  wait_for=[e])
+    offsets = np.empty(3, dtype=collider.counter_dtype)
+    cl.enqueue_copy(cq, offsets, offsets_buf, wait_for=[e])
+    np.testing.assert_equal(offsets, [0, 1, 1])
+    indices_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, collider.id_dtype.itemsize)
+    e = collider.write_neighbours(cq, coords_buf, query_coords_buf, 2, 1.0, offsets_buf,
+                                  indices_buf, 1, wait_for=[e])
+    indices = np.empty(1, dtype=collider.id_dtype)
+    cl.enqueue_copy(cq, indices, indices_buf, wait_for=[e])
+    np.testing.assert_equal(indices, [0])
+
+    k = 2
+    indices_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 2 * k * collider.id_dtype.itemsize)
+    distances_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 2 * k * coord_dtype.itemsize)
+    e = collider.nearest_neighbours(cq, coords_buf, query_coords_buf, 2, k,
+                                    indices_buf, distances_buf, wait_for=[e])
+    indices = np.empty((2, k), dtype=collider.id_dtype)
+    distances = np.empty((2, k), dtype=coord_dtype)
+    cl.enqueue_copy(cq, indices, indices_buf, wait_for=[e])
+    cl.enqueue_copy(cq, distances, distances_buf, wait_for=[e])
+    np.testing.assert_equal(indices, [[0, NO_NODE], [0, NO_NODE]])
+    np.testing.assert_equal(distances, [[0.5, np.inf], [2.0, np.inf]])
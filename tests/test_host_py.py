@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from inspect import signature
+import collision
+from collision.host import *
+
+from .test_collision_py import find_collisions as expected_collisions
+
+def pytest_generate_tests(metafunc):
+    params = signature(metafunc.function).parameters
+    if 'coord_dtype' in params:
+        metafunc.parametrize(
+            "coord_dtype", map(dtype, ['float32', 'float64']), scope='module'
+        )
+
+
+@pytest.fixture(scope='module')
+def host_collider(cl_env):
+    ctx, cq = cl_env
+    return HostCollider(ctx, ngroups=4, group_size=8, cq=cq)
+
+
+def test_find_collisions(cl_env, coord_dtype):
+    ctx, cq = cl_env
+    collider = HostCollider(ctx, coord_dtype, 4, 8, cq)
+
+    np.random.seed(4)
+    for size in [120, 317, 100, 317]:
+        coords = np.random.random((size, 3)).astype(coord_dtype)
+        radius = 1 / (size ** 0.5) # Keep number of collisions under control
+        radii = np.random.uniform(0, radius, len(coords)).astype(coord_dtype)
+        expected = expected_collisions(coords, radii)
+
+        collisions = collider.find_collisions(coords, radii)
+        assert collisions.shape == (len(expected), 2)
+        assert set(map(tuple, np.sort(collisions, axis=1))) == expected
+    # Only ever grows
+    assert collider.capacity == 317
+
+
+def test_scalar_radius(host_collider):
+    coords = np.array([[ 0.0, 1.0, 3.0],
+                       [ 0.0, 1.0, 3.0],
+                       [ 4.0, 1.0, 8.0],
+                       [-4.0,-6.0, 3.0],
+                       [-5.0, 0.0,-1.0],
+                       [-5.0, 0.5,-0.5]])
+    collisions = host_collider.find_collisions(coords, 1.0)
+    assert set(map(tuple, np.sort(collisions, axis=1))) == {(0, 1), (4, 5)}
+
+
+@pytest.mark.parametrize("size", [0, 1])
+def test_trivial(host_collider, size):
+    collisions = host_collider.find_collisions(np.zeros((size, 3)), 1.0)
+    assert collisions.shape == (0, 2)
+
+
+def test_shape_err(host_collider):
+    with pytest.raises(ValueError):
+        host_collider.find_collisions(np.zeros((10, 4)), 1.0)
+
+
+def test_module_api(cl_env):
+    ctx, cq = cl_env
+    coords = np.array([[0.0, 0.0, 0.0], [0.5, 0.0, 0.0], [5.0, 0.0, 0.0]], dtype='float32')
+    collisions = collision.find_collisions(coords, 0.3, ctx=ctx)
+    assert set(map(tuple, np.sort(collisions, axis=1))) == {(0, 1)}
@@ -77,3 +77,58 @@ def test_scatter(cl_env, value_dtype, index_dtype):
     selection[indices] = True
     np.testing.assert_equal(values_map[indices], values)
     np.testing.assert_equal(values_map[~selection], 1.0)
+
+
+@pytest.mark.parametrize("size,group_size,p", [(1, 4, 1.0), (240, 4, 0.3), (12345, 32, 0.5),
+                                               (100, 8, 0.0)])
+def test_compact(cl_env, value_dtype, index_dtype, size, group_size, p):
+    ctx, cq = cl_env
+
+    compactor = Compactor(ctx, size, group_size, value_dtype, index_dtype)
+    values = (np.random.uniform(0, 1000, (size,) + value_dtype.shape)
+              .astype(value_dtype.base))
+    # Any non-zero flag keeps a value
+    flags = (np.random.random(size) < p) * np.random.randint(1, 5, size=size)
+    flags = flags.astype(compactor.flag_dtype)
+
+    values_buf, flags_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [values, flags]
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, size * value_dtype.itemsize)
+
+    e = compactor.compact(cq, values_buf, flags_buf, out_buf)
+    count = compactor.read_count(cq, wait_for=[e])
+    assert count == np.count_nonzero(flags)
+
+    out = np.empty((size,) + value_dtype.shape, dtype=value_dtype.base)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[e])
+    np.testing.assert_equal(out[:count], values[flags != 0])
+
+
+def test_compact_resized(cl_env):
+    ctx, cq = cl_env
+    compactor = Compactor(ctx, 100, 4)
+    compactor.resize(1000, 8)
+
+    values = np.arange(1000, dtype='uint32')
+    flags = (values % 3 == 0).astype('uint32')
+    values_buf, flags_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [values, flags]
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, values.nbytes)
+    count_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, 4)
+
+    e = compactor.compact(cq, values_buf, flags_buf, out_buf, count_buf)
+    assert compactor.read_count(cq, count_buf, wait_for=[e]) == 334
+    out = np.empty(334, dtype='uint32')
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[e])
+    np.testing.assert_equal(out, values[::3])
+
+
+def test_compact_errs(cl_env):
+    from collision.scan import PrefixScanProgram
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        Compactor(ctx, 100, 4, index_dtype='uint64', scan_program=PrefixScanProgram(ctx))
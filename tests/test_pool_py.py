@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from collision.pool import *
+
+
+def test_grow_only(cl_env):
+    ctx, cq = cl_env
+    pool = BufferPool(ctx)
+
+    buf = pool.allocate(1024)
+    assert buf.size == 1024
+    assert pool.allocate(512, buf) is buf
+    assert pool.allocate(1024, buf) is buf
+
+    bigger = pool.allocate(2048, buf)
+    assert bigger.size == 2048
+    # Released buffer may still be in use, so is not re-used until reclaimed
+    assert pool.pending_size == 1024
+    other = pool.allocate(100)
+    assert other is not buf
+    pool.release(other)
+    pool.reclaim(cq)
+    assert pool.pending_size == 0
+    assert pool.allocate(100) is other
+    assert pool.allocate(100) is buf
+    assert pool.free_size == 0
+
+
+def test_hysteresis(cl_env):
+    ctx, cq = cl_env
+    pool = BufferPool(ctx, shrink_factor=4, growth=2)
+
+    buf = pool.allocate(1000)
+    assert buf.size == 2000
+    assert pool.allocate(1500, buf) is buf
+    assert pool.allocate(500, buf) is buf
+
+    smaller = pool.allocate(400, buf)
+    assert smaller is not buf
+    assert smaller.size == 800
+    assert pool.pending_size == 2000
+    pool.reclaim(cq)
+    assert pool.free_size == 2000
+
+
+def test_best_fit(cl_env):
+    ctx, cq = cl_env
+    pool = BufferPool(ctx)
+
+    bufs = [pool.allocate(size) for size in [300, 100, 200]]
+    for buf in bufs:
+        pool.release(buf)
+    pool.reclaim(cq)
+    assert pool.allocate(150) is bufs[2]
+    assert pool.allocate(150) is bufs[0]
+    assert pool.allocate(150).size == 150
+
+    pool.release(pool.allocate(100))
+    pool.clear()
+    assert pool.free_size == 0
+    assert pool.pending_size == 0
+
+
+@pytest.mark.parametrize("shrink_factor,growth", [(1.5, 2), (2, 0.5)])
+def test_pool_errs(cl_env, shrink_factor, growth):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        BufferPool(ctx, shrink_factor=shrink_factor, growth=growth)
+
+
+def test_shared(cl_env):
+    from collision.collision import Collider
+    ctx, cq = cl_env
+    pool = BufferPool(ctx)
+
+    collider = Collider(ctx, 300, 4, 8, pool=pool)
+    assert collider.sorter.pool is pool
+    assert collider.sorter.scanner.pool is pool
+    assert collider.reducer.pool is pool
+
+    bufs = [collider._nodes_buf, collider._bounds_buf, *collider._codes_bufs,
+            collider.sorter._histogram_buf]
+    # Within capacity, resizing doesn't allocate
+    collider.resize(200)
+    assert [collider._nodes_buf, collider._bounds_buf, *collider._codes_bufs,
+            collider.sorter._histogram_buf] == bufs
+
+
+def test_reuse(cl_env):
+    from collision.host import HostCollider
+    ctx, cq = cl_env
+    host_collider = HostCollider(ctx, ngroups=4, group_size=8, cq=cq)
+
+    np.random.seed(4)
+    host_collider.find_collisions(np.random.random((300, 3)), 0.01)
+    collider = host_collider.collider
+    collider.pool.shrink_factor = 2
+
+    # Shrinking releases buffers, which are reclaimed once the collisions are read back
+    host_collider.find_collisions(np.random.random((50, 3)), 0.01)
+    assert collider.pool.pending_size == 0
+    free_size = collider.pool.free_size
+    assert free_size > 0
+    free = {buf.int_ptr for buf in collider.pool._free}
+
+    # Growing again re-uses them instead of allocating
+    host_collider.find_collisions(np.random.random((300, 3)), 0.01)
+    assert collider.pool.pending_size == 0
+    assert collider.pool.free_size < free_size
+    bufs = [collider._nodes_buf, collider._bounds_buf, *collider._codes_bufs]
+    assert {buf.int_ptr for buf in bufs} <= free
@@ -206,3 +206,338 @@ def test_auto_program(cl_env):
     group_size = 32
     size = group_size * 64
     sorter = RadixSorter(ctx, size, group_size)
+
+
+@pytest.mark.parametrize("size,group_size,bits", [
+    (32, 8, 4), (15360, 32, 4), (32, 16, 4), (15360, 128, 8), (1024, 8, 2)
+])
+def test_onesweep_sorter(cl_env, sort_program, key_dtype, size, group_size, bits):
+    ctx, cq = cl_env
+    sorter = OnesweepSorter(
+        ctx, size, group_size, bits, key_dtype=key_dtype, program=sort_program
+    )
+    data = np.random.randint(np.iinfo(key_dtype).max, size=size, dtype=key_dtype)
+    data_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=data
+    )
+    out_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, data.nbytes
+    )
+
+    calc_sort = sorter.sort(cq, data_buf, out_buf)
+
+    (out_map, _) = cl.enqueue_map_buffer(
+        cq, out_buf, cl.map_flags.READ,
+        0, data.shape, data.dtype,
+        wait_for=[calc_sort], is_blocking=True
+    )
+    np.testing.assert_equal(out_map, np.sort(data))
+
+
+@pytest.mark.parametrize("old_shape,new_shape", [
+    ((15360,32), (32,8)), ((32,8), (15360,32)),
+])
+def test_onesweep_resized(cl_env, sort_program, key_dtype, old_shape, new_shape):
+    ctx, cq = cl_env
+    sorter = OnesweepSorter(ctx, *old_shape, key_dtype=key_dtype, program=sort_program)
+    sorter.resize(*new_shape)
+
+    size = new_shape[0]
+    data = np.random.randint(500, size=size, dtype=key_dtype)
+    data_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=data
+    )
+    out_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, data.nbytes
+    )
+
+    calc_sort = sorter.sort(cq, data_buf, out_buf)
+
+    (out_map, _) = cl.enqueue_map_buffer(
+        cq, out_buf, cl.map_flags.READ,
+        0, data.shape, data.dtype,
+        wait_for=[calc_sort], is_blocking=True
+    )
+    np.testing.assert_equal(out_map, np.sort(data))
+
+
+@pytest.mark.parametrize("size,group_size", [(32, 8), (15360,32)])
+def test_onesweep_arg_sorter(cl_env, sort_program, key_dtype, value_dtype, size, group_size):
+    ctx, cq = cl_env
+    value_dtype = np.dtype(value_dtype)
+
+    sorter = OnesweepSorter(
+        ctx, size, group_size, key_dtype=key_dtype, value_dtype=value_dtype,
+        program=sort_program
+    )
+    keys = np.random.randint(500, size=size, dtype=key_dtype)
+    keys_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=keys
+    )
+
+    values = np.random.uniform(-1000, 1000, size=(size,) + value_dtype.shape)
+    values = values.astype(dtype=value_dtype.base)
+
+    if value_dtype.shape == (3,):
+        values_bytes = values.dtype.itemsize * size * 4
+        values_shape = (size, 4)
+    else:
+        values_bytes = values.nbytes
+        values_shape = values.shape
+    values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, values_bytes
+    )
+    (values_map, _) = cl.enqueue_map_buffer(
+        cq, values_buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+        0, values_shape, values.dtype, is_blocking=True
+    )
+    if value_dtype.shape == (3,):
+        values_map[:, :3] = values
+    else:
+        values_map[...] = values
+    del values_map
+
+    out_keys_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, keys.nbytes
+    )
+    out_values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE, values_bytes
+    )
+
+    calc_sort = sorter.sort(cq, keys_buf, out_keys_buf, values_buf, out_values_buf)
+
+    (out_keys_map, _) = cl.enqueue_map_buffer(
+        cq, out_keys_buf, cl.map_flags.READ,
+        0, keys.shape, keys.dtype,
+        wait_for=[calc_sort], is_blocking=True
+    )
+    np.testing.assert_equal(out_keys_map, np.sort(keys))
+
+    (out_values_map, _) = cl.enqueue_map_buffer(
+        cq, out_values_buf, cl.map_flags.READ,
+        0, values_shape, values.dtype,
+        wait_for=[calc_sort], is_blocking=True
+    )
+    if value_dtype.shape == (3,):
+        out_values = out_values_map[:, :3]
+    else:
+        out_values = out_values_map
+    np.testing.assert_equal(out_values, values[np.argsort(keys, kind='mergesort')])
+
+
+@pytest.mark.parametrize("onesweep", [False, True])
+@pytest.mark.parametrize("size,group_size", [(32, 8), (15360, 32)])
+def test_sort_in_place(cl_env, sort_program, scan_program, key_dtype, size, group_size,
+                       onesweep):
+    ctx, cq = cl_env
+    if onesweep:
+        sorter = OnesweepSorter(ctx, size, group_size, key_dtype=key_dtype,
+                                program=sort_program)
+    else:
+        sorter = RadixSorter(ctx, size, group_size, key_dtype=key_dtype,
+                             program=sort_program, scan_program=scan_program)
+    keys = np.random.randint(500, size=size, dtype=key_dtype)
+    values = np.arange(size, dtype='uint32')
+    bufs = [cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+            for a in [keys, np.zeros_like(keys), values, np.zeros_like(values)]]
+
+    calc_sort = sorter.sort(cq, *bufs, copy_result=False)
+    assert sorter.output_index == sorter.num_passes % 2
+
+    out_keys = np.empty_like(keys)
+    out_values = np.empty_like(values)
+    cl.enqueue_copy(cq, out_keys, bufs[sorter.output_index], wait_for=[calc_sort])
+    cl.enqueue_copy(cq, out_values, bufs[2 + sorter.output_index], wait_for=[calc_sort])
+    np.testing.assert_equal(out_keys, np.sort(keys))
+    np.testing.assert_equal(out_values, np.argsort(keys, kind='mergesort'))
+
+
+def test_key_range(cl_env, key_dtype):
+    ctx, cq = cl_env
+    key_range = KeyRange(ctx, 4, 8, key_dtype)
+
+    keys = (np.random.randint(0, 16, size=100, dtype=key_dtype) << 8) | 0b1010001
+    keys_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=keys
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 2 * keys.itemsize)
+
+    e = key_range.reduce(cq, len(keys), keys_buf, out_buf)
+    out = np.empty(2, dtype=key_dtype)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[e])
+    np.testing.assert_equal(out, [np.bitwise_or.reduce(keys), np.bitwise_and.reduce(keys)])
+
+
+@pytest.mark.parametrize("onesweep", [False, True])
+@pytest.mark.parametrize("high,expected", [(1, 0), (16, 1), (1000, 3), (2 ** 32 - 1, 8)])
+def test_skip_constant(cl_env, sort_program, scan_program, key_dtype, high, expected,
+                       onesweep):
+    ctx, cq = cl_env
+    size, group_size = 15360, 32
+    if onesweep:
+        sorter = OnesweepSorter(ctx, size, group_size, key_dtype=key_dtype,
+                                program=sort_program, skip_constant=True)
+    else:
+        sorter = RadixSorter(ctx, size, group_size, key_dtype=key_dtype, program=sort_program,
+                             scan_program=scan_program, skip_constant=True)
+
+    # Constant high bits, which are skipped when set as well
+    keys = np.random.randint(0, high, size=size, dtype=key_dtype) | (7 << 12)
+    if high == 2 ** 32 - 1:
+        keys[:] = np.random.randint(0, 2 ** 32 - 1, size=size, dtype=key_dtype)
+        keys[0], keys[1] = 0, 2 ** 32 - 1
+    values = np.arange(size, dtype='uint32')
+    bufs = [cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+            for a in [keys, np.zeros_like(keys), values, np.zeros_like(values)]]
+
+    passes = sorter.varying_passes(cq, bufs[0])
+    assert len(passes) == expected
+
+    calc_sort = sorter.sort(cq, *bufs, copy_result=False)
+    assert sorter.output_index == expected % 2
+    out_keys = np.empty_like(keys)
+    out_values = np.empty_like(values)
+    cl.enqueue_copy(cq, out_keys, bufs[sorter.output_index], wait_for=[calc_sort])
+    cl.enqueue_copy(cq, out_values, bufs[2 + sorter.output_index], wait_for=[calc_sort])
+    np.testing.assert_equal(out_keys, np.sort(keys))
+    np.testing.assert_equal(out_values, np.argsort(keys, kind='mergesort'))
+
+    calc_sort = sorter.sort(cq, *bufs)
+    cl.enqueue_copy(cq, out_keys, bufs[1], wait_for=[calc_sort])
+    np.testing.assert_equal(out_keys, np.sort(keys))
+
+
+@pytest.mark.parametrize("sizes,group_size", [
+    ([5, 0, 17, 1, 40], 8), ([100] * 50 + [3, 0, 0, 250], 32), ([0, 3, 0], 8),
+])
+def test_segmented_sorter(cl_env, scan_program, sizes, group_size):
+    ctx, cq = cl_env
+    offsets = np.cumsum([0] + sizes, dtype='uint32')
+    size = int(offsets[-1])
+    # Host-readable, to check the segmented keys
+    pool = BufferPool(ctx, cl.mem_flags.READ_WRITE)
+    sorter = SegmentedSorter(ctx, size, group_size, scan_program=scan_program,
+                             pool=pool)
+    padded_size = sorter.padded_size
+    assert padded_size % (2 * group_size) == 0
+
+    keys = np.random.randint(0, 2 ** 32 - 1, size=padded_size, dtype='uint32')
+    keys[:size:3] = 2 ** 32 - 1
+    values = np.arange(padded_size, dtype='uint32')
+    keys_buf, offsets_buf, values_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [keys, offsets, values]
+    )
+    out_keys_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, keys.nbytes)
+    out_values_buf = cl.Buffer(ctx, cl.mem_flags.READ_WRITE, values.nbytes)
+
+    calc_sort = sorter.sort(cq, keys_buf, out_keys_buf, offsets_buf, len(sizes),
+                            values_buf, out_values_buf)
+    out_keys = np.empty_like(keys)
+    out_values = np.empty_like(values)
+    cl.enqueue_copy(cq, out_keys, out_keys_buf, wait_for=[calc_sort])
+    cl.enqueue_copy(cq, out_values, out_values_buf, wait_for=[calc_sort])
+
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        order = np.argsort(keys[start:end], kind='mergesort') + start
+        np.testing.assert_equal(out_keys[start:end], keys[order])
+        np.testing.assert_equal(out_values[start:end], order)
+
+    segments = sorter.segmented_keys_buf
+    segmented = np.empty(padded_size, dtype='uint64')
+    cl.enqueue_copy(cq, segmented, segments)
+    np.testing.assert_equal(segmented[:size] & 0xFFFFFFFF, out_keys[:size])
+    np.testing.assert_equal(
+        segmented[:size] >> 32, np.repeat(np.arange(len(sizes)), sizes)
+    )
+    np.testing.assert_equal(segmented[size:] >> 32, len(sizes))
+
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("onesweep", [False, True])
+@pytest.mark.parametrize("skip_constant", [False, True])
+@pytest.mark.parametrize("ordered_dtype", ['int32', 'int64', 'float32', 'float64'])
+def test_ordered_keys(cl_env, scan_program, ordered_dtype, onesweep, descending,
+                      skip_constant):
+    ctx, cq = cl_env
+    size, group_size = 15360, 32
+
+    program = RadixProgram(ctx, ordered_dtype, descending=descending)
+    if onesweep:
+        sorter = OnesweepSorter(ctx, size, group_size, key_dtype=ordered_dtype,
+                                program=program, descending=descending,
+                                skip_constant=skip_constant)
+    else:
+        sorter = RadixSorter(ctx, size, group_size, key_dtype=ordered_dtype,
+                             program=program, scan_program=scan_program,
+                             descending=descending, skip_constant=skip_constant)
+
+    keys = np.random.uniform(-1000, 1000, size=size).astype(ordered_dtype)
+    if np.dtype(ordered_dtype).kind == 'f':
+        keys[:4] = [-np.inf, np.inf, 0.0, -1e-30]
+    values = np.arange(size, dtype='uint32')
+    bufs = [cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+            for a in [keys, np.zeros_like(keys), values, np.zeros_like(values)]]
+
+    calc_sort = sorter.sort(cq, *bufs)
+    out_keys = np.empty_like(keys)
+    out_values = np.empty_like(values)
+    cl.enqueue_copy(cq, out_keys, bufs[1], wait_for=[calc_sort])
+    cl.enqueue_copy(cq, out_values, bufs[3], wait_for=[calc_sort])
+
+    order = np.argsort(-keys if descending else keys, kind='mergesort')
+    np.testing.assert_equal(out_keys, keys[order])
+    np.testing.assert_equal(out_values, order)
+
+    if skip_constant:
+        # Sign varies, so no pass is constant
+        assert len(sorter.varying_passes(cq, bufs[0])) == sorter.num_passes
+        # Constant sign, and exponent for floats
+        keys[:] = np.random.uniform(1, 1.5, size=size) * 512
+        cl.enqueue_copy(cq, bufs[0], keys)
+        assert len(sorter.varying_passes(cq, bufs[0])) < sorter.num_passes
+        calc_sort = sorter.sort(cq, *bufs)
+        cl.enqueue_copy(cq, out_keys, bufs[1], wait_for=[calc_sort])
+        np.testing.assert_equal(out_keys, np.sort(keys)[::-1] if descending else np.sort(keys))
+
+
+def test_ordered_keys_errs(cl_env):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        RadixProgram(ctx, 'float16')
+    program = RadixProgram(ctx, 'int32', descending=True)
+    with pytest.raises(ValueError):
+        RadixSorter(ctx, 128, 8, key_dtype='int32', program=program)
+    with pytest.raises(ValueError):
+        OnesweepSorter(ctx, 128, 8, key_dtype='int32', program=program)
+
+
+@pytest.mark.parametrize("onesweep", [False, True])
+@pytest.mark.parametrize("size,group_size", [(32, 8), (15360, 32), (16384, 128)])
+def test_padded_group_scan(cl_env, key_dtype, size, group_size, onesweep):
+    ctx, cq = cl_env
+    program = RadixProgram(ctx, key_dtype, group_scan='padded')
+    if onesweep:
+        sorter = OnesweepSorter(ctx, size, group_size, key_dtype=key_dtype, program=program)
+    else:
+        scan_program = PrefixScanProgram(ctx, group_scan='padded')
+        sorter = RadixSorter(ctx, size, group_size, key_dtype=key_dtype, program=program,
+                             scan_program=scan_program)
+
+    keys = np.random.randint(np.iinfo(key_dtype).max, size=size, dtype=key_dtype)
+    values = np.arange(size, dtype='uint32')
+    keys_buf, values_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [keys, values]
+    )
+    out_keys_buf, out_values_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_WRITE, a.nbytes) for a in [keys, values]
+    )
+    calc_sort = sorter.sort(cq, keys_buf, out_keys_buf, values_buf, out_values_buf)
+
+    out_keys, out_values = np.empty_like(keys), np.empty_like(values)
+    cl.enqueue_copy(cq, out_keys, out_keys_buf, wait_for=[calc_sort])
+    cl.enqueue_copy(cq, out_values, out_values_buf, wait_for=[calc_sort])
+    order = np.argsort(keys, kind='stable')
+    np.testing.assert_equal(out_keys, keys[order])
+    np.testing.assert_equal(out_values, values[order])
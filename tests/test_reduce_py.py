@@ -0,0 +1,87 @@
+import numpy as np
+import pyopencl as cl
+import pytest
+
+from collision.reduce import *
+
+
+@pytest.mark.parametrize("value_dtype,accumulator_dtype", [
+    ('uint32', 'uint64'), (('uint32', 4), ('uint64', 4)), ('int32', 'float64'),
+])
+@pytest.mark.parametrize("size,ngroups,group_size", [(100, 4, 8), (1000, 5, 16)])
+def test_accumulator_dtype(cl_env, value_dtype, accumulator_dtype, size, ngroups, group_size):
+    ctx, cq = cl_env
+    value_dtype, accumulator_dtype = dtype(value_dtype), dtype(accumulator_dtype)
+    reducer = make_reducer(ctx, ngroups, group_size, [("0", "ADD")], value_dtype,
+                           accumulator_dtype)
+
+    # Sums overflow the value dtype
+    values = np.random.randint(2 ** 30, 2 ** 31, size=(size,) + value_dtype.shape)
+    values = values.astype(value_dtype.base)
+    values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=values
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, accumulator_dtype.itemsize)
+
+    calc_reduce = reducer.reduce(cq, size, values_buf, out_buf)
+    out = np.empty(accumulator_dtype.shape, dtype=accumulator_dtype.base)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[calc_reduce])
+    np.testing.assert_equal(out, values.sum(axis=0, dtype=accumulator_dtype.base))
+
+
+@pytest.mark.parametrize("size,ngroups,group_size", [(100, 4, 8), (1000, 7, 32)])
+def test_fused_statistics(cl_env, size, ngroups, group_size):
+    ctx, cq = cl_env
+    # Bounds, mass-weighted position and total mass of particles, in one pass
+    accumulator = [("INFINITY", "min"), ("-INFINITY", "max"),
+                   ("0", "ADD", "x0 * x1"), ("0", "ADD", "x1")]
+    reducer = make_reducer(ctx, ngroups, group_size, accumulator, ('float64', 4),
+                           extra_dtypes=['float64'])
+
+    coords = np.random.normal(size=(size, 4))
+    masses = np.random.uniform(1.0, 2.0, size=size)
+    coords_buf, masses_buf = (
+        cl.Buffer(ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=a)
+        for a in [coords, masses]
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 4 * coords[0].nbytes)
+
+    with pytest.raises(ValueError):
+        reducer.reduce(cq, size, coords_buf, out_buf)
+    calc_reduce = reducer.reduce(cq, size, (coords_buf, masses_buf), out_buf)
+    out = np.empty((4, 4), dtype=coords.dtype)
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[calc_reduce])
+
+    np.testing.assert_equal(out[0], coords.min(axis=0))
+    np.testing.assert_equal(out[1], coords.max(axis=0))
+    np.testing.assert_allclose(out[2], (coords * masses[:, None]).sum(axis=0))
+    np.testing.assert_allclose(out[3], masses.sum())
+
+
+def test_reduction_program_errs(cl_env):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        ReductionProgram(ctx, 'float32')
+    with pytest.raises(ValueError):
+        ReductionProgram(ctx, 'float32', [])
+    with pytest.raises(ValueError):
+        ReductionProgram(ctx, 'float32', [("0", "ADD", "x0", "x0")])
+
+
+@pytest.mark.parametrize("size", [0, 3, 17, 1000])
+def test_launch_groups(cl_env, size):
+    ctx, cq = cl_env
+    reducer = make_reducer(ctx, 64, 8, [("0", "ADD")], 'uint32')
+    # Never more groups than values, so a small input doesn't launch the full ngroups
+    ngroups = reducer.launch_groups(size)
+    assert ngroups == max(1, min(64, -(-size // 8)))
+
+    values = np.arange(max(size, 1), dtype='uint32')
+    values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=values
+    )
+    out_buf = cl.Buffer(ctx, cl.mem_flags.WRITE_ONLY, 4)
+    calc_reduce = reducer.reduce(cq, size, values_buf, out_buf)
+    out = np.empty((), dtype='uint32')
+    cl.enqueue_copy(cq, out, out_buf, wait_for=[calc_reduce])
+    assert out == values[:size].sum()
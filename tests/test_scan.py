@@ -7,7 +7,8 @@ from itertools import product as cartesian
 
 @pytest.fixture(scope='module')
 def scan_kernels(cl_env):
-    kernel_args = {'local_scan': [None, None, None], 'block_scan': [None, None]}
+    kernel_args = {'local_scan': [None, None, None, np.dtype('uint32'), np.dtype('uint8')],
+                   'block_scan': [None, None, np.dtype('uint32')]}
     ctx, cq = cl_env
 
     src = Path(__file__).parent / ".." / "collision" / "scan.cl"
@@ -40,6 +41,7 @@ def test_scan(cl_env, scan_kernels):
     calc_scan = scan_kernels['local_scan'](
         cq, (len(values) // 2,), (block_size,),
         values_buf, cl.LocalMemory(block_size * 2 * values.dtype.itemsize), block_sums_buf,
+        len(values), False
     )
 
     (values_map, _) = cl.enqueue_map_buffer(
@@ -77,7 +79,7 @@ def test_block_scan(cl_env, scan_kernels):
     calc_block_scan = scan_kernels['local_scan'](
         cq, (1,), (len(block_sums),),
         block_sums_buf, cl.LocalMemory(len(block_sums) * 2 * values.dtype.itemsize), None,
-        g_times_l=True
+        len(block_sums), False, g_times_l=True
     )
 
     (block_sums_map, _) = cl.enqueue_map_buffer(
@@ -90,7 +92,7 @@ def test_block_scan(cl_env, scan_kernels):
 
     calc_scan = scan_kernels['block_scan'](
         cq, (len(values) // 2,), (4,),
-        values_buf, block_sums_buf,
+        values_buf, block_sums_buf, len(values),
         wait_for=[calc_block_scan]
     )
     (values_map, _) = cl.enqueue_map_buffer(
@@ -12,7 +12,7 @@ def scan_program(cl_env):
     return PrefixScanProgram(ctx)
 
 
-@pytest.mark.parametrize("size,group_size", [(1023, 4), (20, 4), (96, 6)])
+@pytest.mark.parametrize("size,group_size", [(96, 6), (-1, 4)])
 def test_scanner_errs(cl_env, scan_program, size, group_size):
     ctx, cq = cl_env
     with pytest.raises(ValueError):
@@ -20,7 +20,7 @@ def test_scanner_errs(cl_env, scan_program, size, group_size):
 
 
 @pytest.mark.parametrize("old_shape,new_shape", [
-    ((1024, 4), (1023, 4)),
+    ((1024, 4), (1024, 3)),
 ])
 def test_scanner_resize_errs(cl_env, scan_program, old_shape, new_shape):
     ctx, cq = cl_env
@@ -31,11 +31,12 @@ def test_scanner_resize_errs(cl_env, scan_program, old_shape, new_shape):
 
 @pytest.mark.parametrize("size,group_size,expected", [
     (1024, 4, (128, 16, 2)),
-    (20, 2, (8, 2)),
-    (24, 4, (8,)),
-    (1032, 4, (136, 24, 4)),
-    (160, 4, (24, 4)),
-    (320, 4, (40, 8)),
+    (20, 2, (5, 2)),
+    (24, 4, (3,)),
+    (8, 4, ()),
+    (1032, 4, (129, 17, 3)),
+    (160, 4, (20, 3)),
+    (320, 4, (40, 5)),
 ])
 def test_block_levels(cl_env, scan_program, size, group_size, expected):
     ctx, cq = cl_env
@@ -43,10 +44,14 @@ def test_block_levels(cl_env, scan_program, size, group_size, expected):
     assert scanner.block_lengths == expected
 
 
-@pytest.mark.parametrize("size,group_size", [(20, 2), (24, 4), (1024, 4), (160, 4), (320, 4)])
-def test_prefix_sum(cl_env, scan_program, size, group_size):
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("size,group_size", [
+    (20, 2), (24, 4), (1024, 4), (160, 4), (320, 4), (1, 4), (7, 4), (1023, 4), (12345, 8),
+])
+def test_prefix_sum(cl_env, scan_program, size, group_size, single_pass):
     ctx, cq = cl_env
-    scanner = PrefixScanner(ctx, size, group_size, program=scan_program)
+    scanner = PrefixScanner(ctx, size, group_size, program=scan_program,
+                            single_pass=single_pass)
 
     values = np.random.randint(0, size, size=size, dtype='uint32')
     values_buf = cl.Buffer(
@@ -70,9 +75,10 @@ def test_prefix_sum(cl_env, scan_program, size, group_size):
     ((24, 2), (None, 4)),
     ((160, 4), (1024, None)),
 ])
-def test_scanner_resized(cl_env, scan_program, old_shape, new_shape):
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_scanner_resized(cl_env, scan_program, old_shape, new_shape, single_pass):
     ctx, cq = cl_env
-    scanner = PrefixScanner(ctx, *old_shape, program=scan_program)
+    scanner = PrefixScanner(ctx, *old_shape, program=scan_program, single_pass=single_pass)
     scanner.resize(*new_shape)
 
     size = new_shape[0] or old_shape[0]
@@ -90,3 +96,88 @@ def test_scanner_resized(cl_env, scan_program, old_shape, new_shape):
     )
     assert values_map[0] == 0
     np.testing.assert_equal(values_map[1:], expected[:-1])
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("inclusive", [False, True])
+@pytest.mark.parametrize("value_dtype,operator", [
+    ('uint32', 'add'), ('uint64', 'add'), ('int32', 'min'), ('int64', 'max'),
+    ('float32', 'max'), ('float64', 'min'),
+])
+@pytest.mark.parametrize("size,group_size", [(1, 4), (1000, 4), (12345, 32)])
+def test_scan_operators(cl_env, value_dtype, operator, inclusive, size, group_size,
+                        single_pass):
+    ctx, cq = cl_env
+    program = PrefixScanProgram(ctx, value_dtype, operator)
+    scanner = PrefixScanner(ctx, size, group_size, program=program, single_pass=single_pass)
+
+    values = np.random.randint(-1000, 1000, size=size)
+    if operator == 'add' or np.dtype(value_dtype).kind == 'u':
+        values = np.abs(values)
+    values = values.astype(value_dtype)
+    # Larger, to check writes stay within size
+    values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR,
+        hostbuf=np.concatenate([values, values[:1] + 7])
+    )
+    calc_scan = scanner.prefix_sum(cq, values_buf, inclusive=inclusive)
+
+    ufunc = {'add': np.add, 'min': np.minimum, 'max': np.maximum}[operator]
+    expected = ufunc.accumulate(values)
+    if not inclusive:
+        identity = {'add': 0, 'min': np.inf, 'max': -np.inf}[operator]
+        if np.dtype(value_dtype).kind in 'iu' and operator != 'add':
+            info = np.iinfo(value_dtype)
+            identity = info.max if operator == 'min' else info.min
+        expected = np.concatenate([[identity], expected[:-1]]).astype(value_dtype)
+
+    out = np.empty(size + 1, dtype=value_dtype)
+    cl.enqueue_copy(cq, out, values_buf, wait_for=[calc_scan])
+    np.testing.assert_equal(out[:-1], expected)
+    assert out[-1] == values[0] + 7
+
+
+def test_scan_program_errs(cl_env):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        PrefixScanProgram(ctx, 'uint32', 'mul')
+    with pytest.raises(ValueError):
+        PrefixScanProgram(ctx, 'float16')
+    with pytest.raises(ValueError):
+        PrefixScanProgram(ctx, ('float32', 3))
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+@pytest.mark.parametrize("inclusive", [False, True])
+@pytest.mark.parametrize("value_dtype,operator", [('uint32', 'add'), ('float64', 'min')])
+@pytest.mark.parametrize("size,group_size", [(7, 4), (12345, 32), (20000, 128)])
+def test_group_scans(cl_env, value_dtype, operator, inclusive, size, group_size,
+                     single_pass):
+    ctx, cq = cl_env
+    program = PrefixScanProgram(ctx, value_dtype, operator, group_scan='padded')
+    scanner = PrefixScanner(ctx, size, group_size, program=program, single_pass=single_pass)
+
+    values = np.random.randint(0, 1000, size=size).astype(value_dtype)
+    values_buf = cl.Buffer(
+        ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=values
+    )
+    calc_scan = scanner.prefix_sum(cq, values_buf, inclusive=inclusive)
+
+    ufunc = {'add': np.add, 'min': np.minimum}[operator]
+    expected = ufunc.accumulate(values)
+    if not inclusive:
+        identity = {'add': 0, 'min': np.inf}[operator]
+        expected = np.concatenate([[identity], expected[:-1]]).astype(value_dtype)
+
+    out = np.empty_like(values)
+    cl.enqueue_copy(cq, out, values_buf, wait_for=[calc_scan])
+    np.testing.assert_equal(out, expected)
+
+
+def test_group_scan_errs(cl_env):
+    ctx, cq = cl_env
+    with pytest.raises(ValueError):
+        PrefixScanProgram(ctx, group_scan='shuffle')
+    if not all('cl_khr_subgroups' in d.extensions.split() for d in ctx.devices):
+        with pytest.raises(ValueError):
+            PrefixScanProgram(ctx, group_scan='subgroup')